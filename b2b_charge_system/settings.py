@@ -30,7 +30,7 @@ ALLOWED_HOSTS = []
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'charge_management.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'charge_management.middleware.InstrumentationMiddleware',  # First, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -102,9 +103,20 @@ DATABASES = {
         'PASSWORD': 'yourpassword',
         'HOST': '127.0.0.1',
         'PORT': '3306',
+        'CONN_MAX_AGE': 60,  # Keep connections open across requests
+        'CONN_HEALTH_CHECKS': True,  # and check a reused connection before the request's first query
     }
 }
 
+# Read replica: the same server here, point HOST at a replica and list it in
+# CHARGE_MANAGEMENT['READ_REPLICAS'] to move read-only endpoints off the primary
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'TEST': {'MIRROR': 'default'},
+}
+
+DATABASE_ROUTERS = ['charge_management.replicas.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -16,12 +16,14 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.views import TokenRefreshView
+from charge_management.views import SellerTokenObtainPairView, metrics_view
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('charge_management.urls')),
-    path('o/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('o/token/', SellerTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('o/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics', metrics_view, name='metrics'),
 ]
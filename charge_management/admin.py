@@ -1,54 +1,187 @@
-from django.contrib import admin
-from .models import Seller, CreditRequest, Transaction, CreditLog, PhoneNumber
+import io
+from decimal import Decimal
+
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+
+from .handlers import CreditApprovalHandler, ShardedBalanceHandler
+from .models import Seller, CreditRequest, Transaction, CreditLog, PhoneNumber, DailyBalanceSnapshot
+from .phone_import import PhoneNumberImporter, read_csv
+from .replicas import ReplicaReadAdminMixin
 
 
 # Register Seller model
 @admin.register(Seller)
-class SellerAdmin(admin.ModelAdmin):
-    list_display = ['name', 'email', 'phone_number', 'credit', 'created_at', 'updated_at']
+class SellerAdmin(ReplicaReadAdminMixin, admin.ModelAdmin):
+    list_display = ['name', 'email', 'phone_number', 'credit', 'total_credit', 'credit_shards', 'created_at',
+                    'updated_at']
     search_fields = ['name', 'email', 'phone_number']
     list_filter = ['created_at', 'updated_at']
     ordering = ['-created_at']
+    readonly_fields = ['credit_shards']  # Use the set_credit_shards command to redistribute the credit
+
+    def get_queryset(self, request):
+        # credit is only the reserve of a sharded seller, list the total without a query per row
+        return super().get_queryset(request).annotate(
+            listed_total_credit=ShardedBalanceHandler.total_credit_expression())
+
+    @admin.display(description='total credit')
+    def total_credit(self, obj):
+        return obj.listed_total_credit.quantize(Decimal('0.01'))  # SQLite sums come back unrounded
+
+
+class ApprovalStatusFilter(admin.SimpleListFilter):
+    # Filters with is_approved IN (...), which every backend serves from creditrequest_approved_idx;
+    # the default filter's NOT is_approved cannot use an index on SQLite
+    title = 'is approved'
+    parameter_name = 'is_approved'
+
+    def lookups(self, request, model_admin):
+        return [('1', 'Yes'), ('0', 'No')]
+
+    def queryset(self, request, queryset):
+        if self.value() in ('0', '1'):
+            return queryset.filter(is_approved__in=[self.value() == '1'])
+        return queryset
 
 
 # Register CreditRequest model
 @admin.register(CreditRequest)
-class CreditRequestAdmin(admin.ModelAdmin):
+class CreditRequestAdmin(ReplicaReadAdminMixin, admin.ModelAdmin):
     list_display = ['seller', 'amount', 'is_approved', 'approved_by', 'created_at']
+    list_select_related = ['seller', 'approved_by']
     search_fields = ['seller__name', 'seller__email']
-    list_filter = ['is_approved', 'created_at']
+    list_filter = [ApprovalStatusFilter, 'created_at']
     ordering = ['-created_at']
+    show_full_result_count = False  # Counting the whole table is a full scan
     actions = ['approve_requests']
 
-    # Custom admin action to approve requests
+    # Custom admin action to approve requests, grouped per seller
     def approve_requests(self, request, queryset):
-        for credit_request in queryset.filter(is_approved=False):
-            credit_request.approve()  # Call the approve method in the model
-        self.message_user(request, "Selected requests have been approved successfully.")
+        ids = list(queryset.filter(is_approved=False).values_list('id', flat=True))
+        results = CreditApprovalHandler.approve_requests(ids, request.user)
+        approved = sum(1 for result in results if result['status'] == CreditApprovalHandler.APPROVED)
+        failed = sum(1 for result in results if result['status'] == CreditApprovalHandler.FAILED)
+        if failed:
+            self.message_user(request, f"Approved {approved} requests, {failed} failed.", messages.ERROR)
+        else:
+            self.message_user(request, f"Approved {approved} requests.")
 
     approve_requests.short_description = "Approve selected credit requests"
 
 
 # Register Transaction model
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
-    list_display = ['seller', 'phone_number', 'amount', 'created_at']
+class TransactionAdmin(ReplicaReadAdminMixin, admin.ModelAdmin):
+    list_display = ['seller', 'phone_number', 'amount', 'status', 'created_at']
+    list_select_related = ['seller']
     search_fields = ['seller__name', 'phone_number']
     list_filter = ['created_at']
     ordering = ['-created_at']
+    show_full_result_count = False  # Counting the whole table is a full scan
+
+    # Recharges are ledger entries: created by the API with their debit, settled by the dispatcher
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_search_results(self, request, queryset, search_term):
+        # A phone number is matched exactly, through the phone number index, instead of LIKE '%...%'
+        term = search_term.strip()
+        if term.isdigit():
+            return queryset.filter(phone_number=term), False
+        return super().get_search_results(request, queryset, search_term)
 
 
 # Register CreditLog model
 @admin.register(CreditLog)
-class CreditLogAdmin(admin.ModelAdmin):
+class CreditLogAdmin(ReplicaReadAdminMixin, admin.ModelAdmin):
     list_display = ['seller', 'amount', 'balance_snapshot', 'description', 'created_at']
+    list_select_related = ['seller']
     search_fields = ['seller__name', 'description']
     list_filter = ['created_at']
     ordering = ['-created_at']
+    show_full_result_count = False  # Counting the whole table is a full scan
+
+
+class PhoneNumberUploadForm(forms.Form):
+    IMPORT, DEACTIVATE, REACTIVATE = 'import', 'deactivate', 'reactivate'
+
+    file = forms.FileField(help_text="CSV with a phone_number column (and an optional description column), "
+                                     "or the numbers in the first column.")
+    mode = forms.ChoiceField(choices=[(IMPORT, "Register or reactivate the numbers"),
+                                      (DEACTIVATE, "Deactivate the numbers"),
+                                      (REACTIVATE, "Reactivate the numbers")])
 
 
 @admin.register(PhoneNumber)
-class ValidPhoneNumberAdmin(admin.ModelAdmin):
+class ValidPhoneNumberAdmin(ReplicaReadAdminMixin, admin.ModelAdmin):
     list_display = ('phone_number', 'is_active', 'added_at')
     list_filter = ('is_active',)
     search_fields = ('phone_number', 'description')
+    change_list_template = 'admin/charge_management/phonenumber/change_list.html'
+    actions = ['deactivate_numbers', 'reactivate_numbers']
+
+    def get_urls(self):
+        upload = path('upload/', self.admin_site.admin_view(self.upload_view),
+                      name='charge_management_phonenumber_upload')
+        return [upload] + super().get_urls()
+
+    def upload_view(self, request):
+        # Streams the uploaded file in chunks: large files are never read into memory at once
+        if not self.has_add_permission(request) or not self.has_change_permission(request):
+            raise PermissionDenied
+        form = PhoneNumberUploadForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            lines = io.TextIOWrapper(form.cleaned_data['file'], encoding='utf-8-sig', newline='')
+            rows = read_csv(lines)
+            mode = form.cleaned_data['mode']
+            if mode == PhoneNumberUploadForm.IMPORT:
+                stats = PhoneNumberImporter().import_rows(rows)
+            else:
+                stats = PhoneNumberImporter().set_active((number for number, _ in rows),
+                                                         active=mode == PhoneNumberUploadForm.REACTIVATE)
+            self.message_user(request, (
+                f"Read {stats['read']} numbers in {stats['seconds']:.1f}s: {stats['created']} created, "
+                f"{stats['updated']} updated, {stats['unchanged']} unchanged, {stats['duplicates']} duplicates, "
+                f"{stats['invalid']} invalid."))
+            return redirect('admin:charge_management_phonenumber_changelist')
+        context = {**self.admin_site.each_context(request), 'opts': self.model._meta, 'form': form,
+                   'title': "Upload phone numbers"}
+        return TemplateResponse(request, 'admin/charge_management/phonenumber/upload.html', context)
+
+    def _set_active(self, request, queryset, active):
+        numbers = queryset.values_list('phone_number', flat=True).iterator()
+        stats = PhoneNumberImporter().set_active(numbers, active, normalize=False)
+        self.message_user(request, f"{'Reactivated' if active else 'Deactivated'} {stats['updated']} numbers.")
+
+    def deactivate_numbers(self, request, queryset):
+        self._set_active(request, queryset, False)
+
+    def reactivate_numbers(self, request, queryset):
+        self._set_active(request, queryset, True)
+
+    deactivate_numbers.short_description = "Deactivate selected phone numbers"
+    reactivate_numbers.short_description = "Reactivate selected phone numbers"
+
+
+# Daily ledger rollups, written by the reconcile_ledger command only
+@admin.register(DailyBalanceSnapshot)
+class DailyBalanceSnapshotAdmin(ReplicaReadAdminMixin, admin.ModelAdmin):
+    list_display = ['seller', 'day', 'credited', 'debited', 'transaction_count', 'closing_balance']
+    list_select_related = ['seller']
+    search_fields = ['seller__name']
+    list_filter = ['day']
+    ordering = ['-day']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
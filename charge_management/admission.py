@@ -0,0 +1,233 @@
+import math
+import time
+from collections import namedtuple
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.exceptions import Throttled
+
+from .conf import get_setting
+from .instrumentation import record_admission
+from .models import Seller
+
+ADMITTED = 'admitted'
+RATE_LIMITED = 'rate_limited'
+CONCURRENCY_LIMITED = 'concurrency_limited'
+REJECTIONS = {
+    RATE_LIMITED: "Recharge rate limit exceeded for this seller.",
+    CONCURRENCY_LIMITED: "Too many recharges in flight for this seller.",
+}
+
+# holds_slot: an in-flight slot was taken and must be given back with release()
+Admission = namedtuple('Admission', ['outcome', 'retry_after', 'holds_slot'])
+
+
+class LocalAdmissionBackend:
+    """
+    Token buckets and in-flight counters in process memory: exact and lock-cheap, but each
+    worker process enforces the limits on its own.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, refilled_at]
+        self._in_flight = {}
+        self._lock = Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Take a token, return 0 when one was available or the seconds until there is one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, refilled_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - refilled_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = [tokens - 1, now]
+                return 0
+            self._buckets[key] = [tokens, now]
+            return (1 - tokens) / rate
+
+    def acquire(self, key, limit):
+        with self._lock:
+            if self._in_flight.get(key, 0) >= limit:
+                return False
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            count = self._in_flight.get(key, 0) - 1
+            if count > 0:
+                self._in_flight[key] = count
+            else:
+                self._in_flight.pop(key, None)
+
+
+class CacheAdmissionBackend:
+    """
+    Limits shared by every process through a Django cache with atomic incr (Redis,
+    Memcached). The bucket is approximated by counting the tokens spent in each refill
+    period of burst / rate seconds; in-flight counters expire after
+    ADMISSION_IN_FLIGHT_TIMEOUT in case a worker dies before releasing.
+    """
+    KEY_PREFIX = 'admission:'
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def take(self, key, rate, burst):
+        period = burst / rate
+        now = time.time()
+        window = int(now // period)
+        counter = f'{self.KEY_PREFIX}rate:{key}:{window}'
+        self.cache.add(counter, 0, timeout=math.ceil(period) + 1)
+        if self._incr(counter) <= burst:
+            return 0
+        return (window + 1) * period - now
+
+    def acquire(self, key, limit):
+        counter = f'{self.KEY_PREFIX}in-flight:{key}'
+        self.cache.add(counter, 0, timeout=get_setting('ADMISSION_IN_FLIGHT_TIMEOUT'))
+        if self._incr(counter) <= limit:
+            return True
+        self.release(key)
+        return False
+
+    def release(self, key):
+        try:
+            self.cache.decr(f'{self.KEY_PREFIX}in-flight:{key}')
+        except ValueError:
+            pass  # Expired meanwhile
+
+    def _incr(self, counter):
+        try:
+            return self.cache.incr(counter)
+        except ValueError:
+            # Evicted between add() and incr()
+            self.cache.add(counter, 1)
+            return 1
+
+
+class AdmissionController:
+    """
+    Per-seller admission control for recharges, checked right after authentication and
+    before any database work: a token-bucket rate limit and a cap on recharges in flight.
+    Limits come from the Seller's recharge_* fields, falling back to the RECHARGE_*
+    settings, and are kept in memory for ADMISSION_LIMITS_TTL seconds.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._limits = {}  # user_id -> ((rate, burst, max_in_flight), expires_at)
+        self._lock = Lock()
+
+    def admit(self, user_id):
+        """
+        Return an Admission; when it holds a slot the caller must release(user_id) once done.
+        """
+        limits = self.cached_limits(user_id)
+        if limits is None:
+            limits = self.load_limits(user_id)
+        return self._admit(user_id, limits)
+
+    async def aadmit(self, user_id):
+        limits = self.cached_limits(user_id)
+        if limits is None:
+            limits = await sync_to_async(self.load_limits)(user_id)
+        if isinstance(self.backend, LocalAdmissionBackend):
+            return self._admit(user_id, limits)
+        return await sync_to_async(self._admit, thread_sensitive=False)(user_id, limits)
+
+    def release(self, user_id):
+        self.backend.release(user_id)
+
+    async def arelease(self, user_id):
+        if isinstance(self.backend, LocalAdmissionBackend):
+            self.backend.release(user_id)
+        else:
+            await sync_to_async(self.backend.release, thread_sensitive=False)(user_id)
+
+    def _admit(self, user_id, limits):
+        rate, burst, max_in_flight = limits
+        if rate:
+            wait = self.backend.take(user_id, rate, burst or max(1, math.ceil(rate)))
+            if wait:
+                record_admission(RATE_LIMITED)
+                return Admission(RATE_LIMITED, wait, False)
+        if max_in_flight and not self.backend.acquire(user_id, max_in_flight):
+            record_admission(CONCURRENCY_LIMITED)
+            return Admission(CONCURRENCY_LIMITED, 1, False)
+        record_admission(ADMITTED)
+        return Admission(ADMITTED, 0, bool(max_in_flight))
+
+    def cached_limits(self, user_id):
+        with self._lock:
+            entry = self._limits.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def load_limits(self, user_id):
+        overrides = Seller.objects.filter(user_id=user_id).values_list(
+            'recharge_rate_limit', 'recharge_burst', 'recharge_max_in_flight').first() or (None, None, None)
+        defaults = (get_setting('RECHARGE_RATE_LIMIT'), get_setting('RECHARGE_BURST'),
+                    get_setting('RECHARGE_MAX_IN_FLIGHT'))
+        limits = tuple(default if override is None else override for override, default in zip(overrides, defaults))
+        with self._lock:
+            self._limits[user_id] = (limits, time.monotonic() + get_setting('ADMISSION_LIMITS_TTL'))
+        return limits
+
+    def forget(self, user_id):
+        with self._lock:
+            self._limits.pop(user_id, None)
+
+
+_controller = None
+
+
+def get_admission_controller():
+    global _controller
+    if _controller is None:
+        alias = get_setting('ADMISSION_CACHE_ALIAS')
+        _controller = AdmissionController(CacheAdmissionBackend(alias) if alias else LocalAdmissionBackend())
+    return _controller
+
+
+def forget_admission_limits(user_id):
+    if _controller is not None:
+        _controller.forget(user_id)
+
+
+@receiver(setting_changed)
+def reset_admission_controller(setting, **kwargs):
+    global _controller
+    if setting in ('CHARGE_MANAGEMENT', 'CACHES'):
+        _controller = None
+
+
+class AdmissionControlMixin:
+    """
+    Rejects a seller's recharge with 429 and Retry-After, before the view touches the
+    database, when it exceeds the seller's rate or in-flight limit.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if not get_setting('ADMISSION_CONTROL_ENABLED'):
+            return
+        controller = get_admission_controller()
+        admission = controller.admit(request.user.id)
+        if admission.outcome != ADMITTED:
+            raise Throttled(admission.retry_after, detail=REJECTIONS[admission.outcome])
+        if admission.holds_slot:
+            self._admission_slot = controller
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        controller = getattr(self, '_admission_slot', None)
+        if controller is not None:
+            self._admission_slot = None
+            controller.release(request.user.id)
+        return super().finalize_response(request, response, *args, **kwargs)
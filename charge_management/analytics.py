@@ -0,0 +1,206 @@
+import os
+import sys
+import zipfile
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from .conf import get_setting
+from .models import CreditLog, Transaction, LedgerCheckpoint
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+NATIVE = '<' if sys.byteorder == 'little' else '>'
+
+
+def _cents(value):
+    return int(value.scaleb(2))
+
+
+def _microseconds(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _npy(descr, count, data):
+    # A .npy v1.0 member: magic, version, little-endian header length, header padded to 64 bytes
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({count},), }}"
+    header += ' ' * (-(10 + len(header) + 1) % 64) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1') + data
+
+
+class LedgerExportHandler:
+    """
+    Incrementally copies CreditLog and Transaction rows past a stored high-water mark into
+    compressed column files under ANALYTICS_EXPORT_PATH/<table>/, one .npz per batch: int64
+    ids, amounts as int64 cents and timestamps as datetime64[us] UTC. Written with the
+    standard library only; LedgerAnalytics reads them back with NumPy.
+    """
+    CHECKPOINT = 'analytics_export'
+    # (field, column, NumPy dtype, encoder): fixed-width columns only
+    TABLES = {
+        'transactions': (Transaction, 'last_transaction_id', [
+            ('id', 'id', f'{NATIVE}i8', int),
+            ('seller_id', 'seller_id', f'{NATIVE}i8', int),
+            ('phone_number', 'phone_number', '|S15', None),
+            ('amount', 'amount_cents', f'{NATIVE}i8', _cents),
+            ('created_at', 'created_at', f'{NATIVE}M8[us]', _microseconds),
+        ]),
+        'credit_logs': (CreditLog, 'last_credit_log_id', [
+            ('id', 'id', f'{NATIVE}i8', int),
+            ('seller_id', 'seller_id', f'{NATIVE}i8', int),
+            ('amount', 'amount_cents', f'{NATIVE}i8', _cents),
+            ('balance_snapshot', 'balance_snapshot_cents', f'{NATIVE}i8', _cents),
+            ('created_at', 'created_at', f'{NATIVE}M8[us]', _microseconds),
+        ]),
+    }
+
+    def __init__(self, path=None):
+        self.path = path or get_setting('ANALYTICS_EXPORT_PATH')
+        if not self.path:
+            raise ImproperlyConfigured("Set CHARGE_MANAGEMENT['ANALYTICS_EXPORT_PATH'] to export ledger rows.")
+
+    def export(self, batch_size=None):
+        """
+        Export every settled row not exported yet, return the number of rows per table.
+        """
+        batch_size = batch_size or get_setting('ANALYTICS_EXPORT_BATCH_SIZE')
+        exported = {}
+        for table in self.TABLES:
+            exported[table] = 0
+            while True:
+                count = self.export_batch(table, batch_size)
+                exported[table] += count
+                if count < batch_size:
+                    break
+        return exported
+
+    def export_batch(self, table, batch_size):
+        model, attr, columns = self.TABLES[table]
+        with transaction.atomic():
+            checkpoint, _ = LedgerCheckpoint.objects.select_for_update().get_or_create(name=self.CHECKPOINT)
+            last_id = getattr(checkpoint, attr)
+            self._discard_uncommitted(table, last_id)
+
+            # Leave recent rows alone: a lower id may still be uncommitted and would be skipped forever
+            settled_before = timezone.now() - timedelta(seconds=get_setting('RECONCILIATION_SETTLE_SECONDS'))
+            rows = []
+            queryset = model.objects.filter(id__gt=last_id).order_by('id').values_list(
+                *(field for field, _, _, _ in columns))
+            for row in queryset[:batch_size]:
+                if row[-1] > settled_before:
+                    break
+                rows.append(row)
+            if not rows:
+                return 0
+
+            self._write_segment(table, columns, rows)
+            setattr(checkpoint, attr, rows[-1][0])
+            checkpoint.save()
+            return len(rows)
+
+    def _write_segment(self, table, columns, rows):
+        directory = os.path.join(self.path, table)
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, f'{rows[0][0]:012d}-{rows[-1][0]:012d}.npz')
+        with zipfile.ZipFile(f'{name}.tmp', 'w', zipfile.ZIP_DEFLATED) as segment:
+            for index, (_, column, descr, encode) in enumerate(columns):
+                if encode is None:
+                    width = int(descr[2:])
+                    data = b''.join(row[index].encode()[:width].ljust(width, b'\0') for row in rows)
+                else:
+                    data = array('q', (encode(row[index]) for row in rows)).tobytes()
+                segment.writestr(f'{column}.npy', _npy(descr, len(rows), data))
+        os.replace(f'{name}.tmp', name)
+
+    def segments(self, table):
+        # (first_id, path) of every committed or uncommitted segment, in id order
+        directory = os.path.join(self.path, table)
+        if not os.path.isdir(directory):
+            return []
+        return [(int(name.split('-')[0]), os.path.join(directory, name))
+                for name in sorted(os.listdir(directory)) if name.endswith('.npz')]
+
+    def _discard_uncommitted(self, table, last_id):
+        for first_id, path in self.segments(table):
+            if first_id > last_id:
+                os.remove(path)
+
+
+class LedgerAnalytics:
+    """
+    Vectorized aggregations over the exported column files, so finance queries never
+    touch the OLTP database. Requires NumPy, which the rest of the app does not.
+    """
+
+    def __init__(self, path=None):
+        try:
+            import numpy
+        except ImportError:
+            raise ImproperlyConfigured("LedgerAnalytics requires NumPy: pip install numpy")
+        self.np = numpy
+        self.exporter = LedgerExportHandler(path)
+        self._tables = {}
+
+    def load(self, table):
+        """
+        Return the committed rows of a table as a dict of column name to NumPy array.
+        """
+        if table not in self._tables:
+            attr = self.exporter.TABLES[table][1]
+            last_id = LedgerCheckpoint.objects.filter(name=self.exporter.CHECKPOINT).values_list(
+                attr, flat=True).first() or 0
+            parts = []
+            for first_id, path in self.exporter.segments(table):
+                if first_id <= last_id:  # Later segments belong to a batch that has not committed
+                    with self.np.load(path) as segment:
+                        parts.append({column: segment[column] for column in segment.files})
+            columns = [column for _, column, _, _ in self.exporter.TABLES[table][2]]
+            dtypes = {column: descr for _, column, descr, _ in self.exporter.TABLES[table][2]}
+            self._tables[table] = {
+                column: self.np.concatenate([part[column] for part in parts]) if parts
+                else self.np.empty(0, dtype=dtypes[column])
+                for column in columns
+            }
+        return self._tables[table]
+
+    def totals_by_seller(self, table='transactions', since=None, until=None):
+        columns, mask = self._select(table, None, since, until)
+        return self._group('seller_id', columns['seller_id'][mask], columns['amount_cents'][mask])
+
+    def totals_by_day(self, table='transactions', seller_id=None, since=None, until=None):
+        # Days in UTC, like the timestamps
+        columns, mask = self._select(table, seller_id, since, until)
+        days = columns['created_at'][mask].astype('datetime64[D]')
+        return self._group('day', days, columns['amount_cents'][mask], key=lambda day: day.item())
+
+    def totals_by_phone_prefix(self, length=4, seller_id=None, since=None, until=None):
+        columns, mask = self._select('transactions', seller_id, since, until)
+        prefixes = columns['phone_number'][mask].astype(f'S{length}')  # Truncates every number at once
+        return self._group('prefix', prefixes, columns['amount_cents'][mask], key=lambda prefix: prefix.decode())
+
+    def _select(self, table, seller_id, since, until):
+        columns = self.load(table)
+        mask = self.np.ones(len(columns['id']), dtype=bool)
+        if seller_id is not None:
+            mask &= columns['seller_id'] == seller_id
+        if since is not None:
+            mask &= columns['created_at'] >= self._datetime64(since)
+        if until is not None:
+            mask &= columns['created_at'] < self._datetime64(until)
+        return columns, mask
+
+    def _datetime64(self, value):
+        return self.np.datetime64(_microseconds(value), 'us')
+
+    def _group(self, name, keys, cents, key=lambda value: value.item()):
+        # Sum int64 cents per key exactly; float weights (bincount) would round large totals
+        unique, inverse, counts = self.np.unique(keys, return_inverse=True, return_counts=True)
+        totals = self.np.zeros(len(unique), dtype='i8')
+        self.np.add.at(totals, inverse, cents)
+        return [
+            {name: key(value), 'amount': Decimal(int(total)).scaleb(-2), 'count': int(count)}
+            for value, total, count in zip(unique, totals, counts)
+        ]
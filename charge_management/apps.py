@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChargeManagementConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'charge_management'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (connects the signal receivers)
@@ -0,0 +1,193 @@
+import gzip
+import json
+import os
+from decimal import Decimal
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .analytics import LedgerExportHandler
+from .conf import get_setting
+from .models import CreditLog, Transaction, LedgerCheckpoint
+from .reconciliation import LedgerReconciliationHandler
+
+
+class LedgerArchiveHandler:
+    """
+    Moves old CreditLog and Transaction rows out of the hot tables into gzipped NDJSON
+    segments under ARCHIVE_PATH/<table>/<YYYY-MM>/, one id range per file, and reads them
+    back for date-range queries. Only rows already rolled up into daily snapshots (and
+    exported for analytics, once that export has run) are archived, so reconciliation
+    (latest snapshot plus the logs after its checkpoint) never needs them again.
+    """
+    CHECKPOINT = 'archive'
+    TABLES = {
+        'credit_logs': (CreditLog, 'last_credit_log_id',
+                        ['id', 'seller_id', 'balance_snapshot', 'amount', 'description', 'created_at']),
+        'transactions': (Transaction, 'last_transaction_id',
+                         ['id', 'seller_id', 'phone_number', 'amount', 'status', 'created_at']),
+    }
+    DECIMAL_FIELDS = ('balance_snapshot', 'amount')
+
+    def __init__(self, path=None):
+        self.path = path or get_setting('ARCHIVE_PATH')
+        if not self.path:
+            raise ImproperlyConfigured("Set CHARGE_MANAGEMENT['ARCHIVE_PATH'] to archive ledger rows.")
+
+    @staticmethod
+    def enabled():
+        return bool(get_setting('ARCHIVE_PATH'))
+
+    def archive(self, before, batch_size=None):
+        """
+        Archive rows created before `before`, table by table and batch by batch, and return
+        the number of rows moved per table.
+        """
+        batch_size = batch_size or get_setting('ARCHIVE_BATCH_SIZE')
+        moved = {}
+        for table in self.TABLES:
+            moved[table] = 0
+            while True:
+                count = self.archive_batch(table, before, batch_size)
+                moved[table] += count
+                if count < batch_size:
+                    break
+        return moved
+
+    def archive_batch(self, table, before, batch_size):
+        """
+        Write one batch to its segment files, then delete it from the hot table and advance
+        the checkpoint in a short transaction. Segments past the checkpoint are leftovers of
+        a batch that never committed and are rewritten.
+        """
+        model, attr, fields = self.TABLES[table]
+        with transaction.atomic():
+            checkpoint, _ = LedgerCheckpoint.objects.select_for_update().get_or_create(name=self.CHECKPOINT)
+            last_id = getattr(checkpoint, attr)
+            self._discard_uncommitted(table, last_id)
+            # Rows must be rolled up, and exported for analytics when that export is in use
+            consumed = dict(LedgerCheckpoint.objects.filter(
+                name__in=[LedgerReconciliationHandler.CHECKPOINT, LedgerExportHandler.CHECKPOINT]
+            ).values_list('name', attr))
+            ceiling = consumed.get(LedgerReconciliationHandler.CHECKPOINT, 0)
+            if LedgerExportHandler.CHECKPOINT in consumed:
+                ceiling = min(ceiling, consumed[LedgerExportHandler.CHECKPOINT])
+
+            rows = []
+            queryset = model.objects.filter(id__gt=last_id, id__lte=ceiling).order_by('id').values(*fields)
+            for row in queryset[:batch_size]:
+                # Stop at the first recent row, the checkpoint must not move past rows left behind
+                if row['created_at'] >= before:
+                    break
+                rows.append(row)
+            if not rows:
+                return 0
+
+            for month, segment in self._by_month(rows).items():
+                self._write_segment(table, month, segment)
+            model.objects.filter(id__gt=last_id, id__lte=rows[-1]['id']).delete()
+            setattr(checkpoint, attr, rows[-1]['id'])
+            checkpoint.save()
+            return len(rows)
+
+    @staticmethod
+    def _by_month(rows):
+        months = {}
+        for row in rows:
+            months.setdefault(timezone.localtime(row['created_at']).strftime('%Y-%m'), []).append(row)
+        return months
+
+    def _write_segment(self, table, month, rows):
+        directory = os.path.join(self.path, table, month)
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, f"{rows[0]['id']:012d}-{rows[-1]['id']:012d}.ndjson.gz")
+        with gzip.open(f'{name}.tmp', 'wt', encoding='utf-8') as segment:
+            for row in rows:
+                segment.write(json.dumps(row, default=self._encode) + '\n')
+        os.replace(f'{name}.tmp', name)
+
+    @staticmethod
+    def _encode(value):
+        # Full-precision timestamps (DjangoJSONEncoder drops microseconds) keep keyset cursors exact
+        return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+    def _segments(self, table, months=None):
+        # (first_id, path) of every segment file, restricted to the given months
+        root = os.path.join(self.path, table)
+        if not os.path.isdir(root):
+            return []
+        segments = []
+        for month in sorted(os.listdir(root)):
+            if months is not None and month not in months:
+                continue
+            for name in sorted(os.listdir(os.path.join(root, month))):
+                if name.endswith('.ndjson.gz'):
+                    segments.append((int(name.split('-')[0]), os.path.join(root, month, name)))
+        return segments
+
+    def _discard_uncommitted(self, table, last_id):
+        for first_id, path in self._segments(table):
+            if first_id > last_id:
+                os.remove(path)
+
+    def rows(self, table, seller_id=None, created_after=None, created_before=None):
+        """
+        Yield archived rows of a table as dicts, optionally for one seller and within
+        [created_after, created_before). Only the month directories the range touches are read.
+        """
+        last_id = self._last_id(table)
+        for first_id, path in self._segments(table, self._months(table, created_after, created_before)):
+            if first_id > last_id:
+                continue  # Written by a batch that has not committed (yet)
+            yield from self._read(path, seller_id, created_after, created_before)
+
+    def rows_newest_first(self, table, seller_id=None, created_after=None, created_before=None, before=None):
+        """
+        Like rows(), newest first by (created_at, id) and only before the `before` key when
+        given, e.g. a page cursor. Months are read lazily, newest first and one at a time (a
+        month holds the rows created in it), so a reader that stops early, such as a page,
+        decompresses only the months it reaches and months after the cursor are skipped.
+        """
+        last_id = self._last_id(table)
+        months_before = created_before
+        if before is not None and (months_before is None or before[0] < months_before):
+            months_before = before[0]
+        for month in sorted(self._months(table, created_after, months_before), reverse=True):
+            month_rows = []
+            for first_id, path in self._segments(table, {month}):
+                if first_id > last_id:
+                    continue
+                month_rows.extend(row for row in self._read(path, seller_id, created_after, created_before)
+                                  if before is None or (row['created_at'], row['id']) < before)
+            month_rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+            yield from month_rows
+
+    def _last_id(self, table):
+        attr = self.TABLES[table][1]
+        return LedgerCheckpoint.objects.filter(name=self.CHECKPOINT).values_list(attr, flat=True).first() or 0
+
+    def _read(self, path, seller_id, created_after, created_before):
+        with gzip.open(path, 'rt', encoding='utf-8') as segment:
+            for line in segment:
+                row = json.loads(line)
+                if seller_id is not None and row['seller_id'] != seller_id:
+                    continue
+                row['created_at'] = parse_datetime(row['created_at'])
+                if created_after is not None and row['created_at'] < created_after:
+                    continue
+                if created_before is not None and row['created_at'] >= created_before:
+                    continue
+                for field in self.DECIMAL_FIELDS:
+                    if field in row:
+                        row[field] = Decimal(row[field])
+                yield row
+
+    def _months(self, table, created_after, created_before):
+        root = os.path.join(self.path, table)
+        if not os.path.isdir(root):
+            return set()
+        first = timezone.localtime(created_after).strftime('%Y-%m') if created_after else ''
+        last = timezone.localtime(created_before).strftime('%Y-%m') if created_before else '9999-12'
+        return {month for month in os.listdir(root) if first <= month <= last}
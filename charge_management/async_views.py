@@ -0,0 +1,231 @@
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.db.models import Sum
+from django.http import Http404, HttpResponse, JsonResponse
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+from .admission import ADMITTED, REJECTIONS, get_admission_controller
+from .authentication import AsyncJWTAuthentication
+from .balance_cache import BalanceCache
+from .conf import get_setting
+from .context import get_request_seller, get_request_seller_id
+from .idempotency import IdempotencyHandler
+from .models import Seller, Transaction, CreditLog, PhoneNumber
+from .pagination import KeysetPagination, after_keyset, decode_cursor, encode_cursor
+from .replicas import read_from_replica
+from .serializers import BulkTransactionItemSerializer, TransactionSerializer, CreditLogSerializer
+
+_pool = None
+_pool_lock = Lock()
+
+
+def _blocking_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=get_setting('ASYNC_DB_POOL_SIZE'),
+                                       thread_name_prefix='charge-db')
+        return _pool
+
+
+def _run_with_connection(func, *args):
+    # Pool threads outlive requests, so open and close their connections like a request would
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_blocking(func, *args):
+    """
+    Run a blocking, transactional section (locks, retries) on a bounded thread pool, so the
+    number of threads and database connections stays at ASYNC_DB_POOL_SIZE whatever the
+    number of concurrent requests. With a pool size of 0 it runs on Django's thread-sensitive
+    executor instead, like the async ORM itself.
+    """
+    if not get_setting('ASYNC_DB_POOL_SIZE'):
+        return await sync_to_async(func)(*args)
+    run = sync_to_async(_run_with_connection, thread_sensitive=False, executor=_blocking_pool())
+    return await run(func, *args)
+
+
+class AsyncAPIView(View):
+    """
+    Base of the async endpoints: JWT authentication with the async cache and ORM, the
+    user's seller loaded along, and JSON responses rendered like DRF's, without DRF's sync
+    request/response cycle.
+    """
+    authentication = AsyncJWTAuthentication()
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True  # Bearer token authentication, as with DRF's APIView
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            result = await self.authentication.aauthenticate(request)
+        except AuthenticationFailed as e:
+            return self.unauthorized(e.detail)
+        if result is None:
+            return self.unauthorized("Authentication credentials were not provided.")
+        request.user, request.auth = result
+        return await super().dispatch(request, *args, **kwargs)
+
+    def unauthorized(self, detail):
+        response = self.respond(detail if isinstance(detail, dict) else {"detail": detail},
+                                status=status.HTTP_401_UNAUTHORIZED)
+        response['WWW-Authenticate'] = self.authentication.authenticate_header(None)
+        return response
+
+    @staticmethod
+    def respond(data, status=status.HTTP_200_OK, headers=None):
+        return JsonResponse(data, status=status, headers=headers, encoder=JSONEncoder, safe=False)
+
+    @classmethod
+    def exception_response(cls, exc):
+        # Rendered like DRF's exception handler: the detail, and Retry-After from a throttle's wait
+        data = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+        headers = {'Retry-After': '%d' % exc.wait} if getattr(exc, 'wait', None) else None
+        return cls.respond(data, status=exc.status_code, headers=headers)
+
+
+# Async counterpart of CreditBalanceView
+class AsyncCreditBalanceView(AsyncAPIView):
+
+    async def get(self, request):
+        entry = await BalanceCache.aget(request.user.id)
+        if entry is None:
+            try:
+                seller = await Seller.objects.aget(user_id=request.user.id)
+            except Seller.DoesNotExist:
+                return self.respond({"error": "The Seller associated with this user was not found."},
+                                    status=status.HTTP_404_NOT_FOUND)
+            balance = seller.credit
+            if seller.credit_shards:
+                shards = await seller.balance_shards.aaggregate(total=Sum('credit'))
+                balance += shards['total'] or 0
+            entry = await BalanceCache.afill(request.user.id, seller.name, balance)
+
+        headers = {'ETag': entry['etag'], 'Cache-Control': 'private, no-cache'}
+        if BalanceCache.matches(entry, request.headers.get('If-None-Match', '')):
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return self.respond({
+            "seller_name": entry['seller_name'],
+            "current_balance": entry['current_balance']
+        }, headers=headers)
+
+
+# Async counterpart of TransactionCreateView
+class AsyncTransactionCreateView(AsyncAPIView):
+
+    async def post(self, request):
+        if not get_setting('ADMISSION_CONTROL_ENABLED'):
+            return await self.create(request)
+        controller = get_admission_controller()
+        admission = await controller.aadmit(request.user.id)
+        if admission.outcome != ADMITTED:
+            return self.respond({"detail": REJECTIONS[admission.outcome]}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                                headers={'Retry-After': str(math.ceil(admission.retry_after))})
+        try:
+            return await self.create(request)
+        finally:
+            if admission.holds_slot:
+                await controller.arelease(request.user.id)
+
+    async def create(self, request):
+        key = request.headers.get(IdempotencyHandler.HEADER)
+        if key and len(key) > 255:
+            return self.respond({"detail": f"{IdempotencyHandler.HEADER} must be at most 255 characters."},
+                                status=status.HTTP_400_BAD_REQUEST)
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return self.respond({"detail": "JSON parse error."}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = BulkTransactionItemSerializer(data=data)  # Same fields, no database access
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            seller = get_request_seller(request)  # Loaded with the user, its balance fields in the pool
+        except Http404 as e:
+            return self.respond({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+        phone_number, amount = serializer.validated_data['phone_number'], serializer.validated_data['amount']
+
+        if key:
+            # Claiming the key, the recharge and storing its response share the same hop
+            try:
+                response = await run_blocking(IdempotencyHandler.run, request, key,
+                                              lambda: self.idempotent_recharge(seller, phone_number, amount))
+            except APIException as e:
+                return self.exception_response(e)
+            headers = {name: response[name] for name in ('Idempotent-Replayed', 'Retry-After')
+                       if response.has_header(name)}
+            return self.respond(response.data, status=response.status_code, headers=headers)
+
+        # Transaction.objects.acreate() would run the debit on the single thread shared by the
+        # async ORM, so the whole phone check and debit go to the bounded pool in one hop
+        try:
+            errors, recharge = await run_blocking(self.recharge, seller, phone_number, amount)
+        except APIException as e:  # e.g. OutboxBackpressure
+            return self.exception_response(e)
+        if errors:
+            return self.respond(errors, status=status.HTTP_400_BAD_REQUEST)
+        return self.respond(TransactionSerializer(recharge).data, status=status.HTTP_201_CREATED)
+
+    @classmethod
+    def idempotent_recharge(cls, seller, phone_number, amount):
+        # Errors are raised, so IdempotencyHandler releases the key as it does for the sync view
+        errors, recharge = cls.recharge(seller, phone_number, amount)
+        if errors:
+            raise ValidationError(errors)
+        return Response(TransactionSerializer(recharge).data, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def recharge(seller, phone_number, amount):
+        if not PhoneNumber.is_valid_phone_number(phone_number):
+            return {"phone_number": ["The provided phone number is not registered or is inactive."]}, None
+        try:
+            return None, Transaction.objects.create(seller=seller, phone_number=phone_number, amount=amount)
+        except ValueError as e:
+            return {"amount": [str(e)]}, None
+
+
+# Async counterpart of CreditLogListView, keyset paginated
+class AsyncCreditLogListView(AsyncAPIView):
+
+    async def get(self, request):
+        try:
+            seller_id = get_request_seller_id(request)
+        except Http404 as e:
+            return self.respond({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+        page_size = KeysetPagination.clamp_page_size(request.GET.get(KeysetPagination.page_size_query_param))
+        queryset = CreditLog.objects.filter(seller_id=seller_id).order_by('-created_at', '-id')
+        cursor = request.GET.get(KeysetPagination.cursor_query_param)
+        if cursor:
+            try:
+                queryset = after_keyset(queryset, *decode_cursor(cursor))
+            except NotFound as e:
+                return self.respond({"detail": e.detail}, status=status.HTTP_404_NOT_FOUND)
+
+        with read_from_replica(seller_id):  # The async ORM's thread inherits the scope
+            rows = [log async for log in queryset[:page_size + 1]]
+        next_link = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_link = replace_query_param(request.build_absolute_uri(), KeysetPagination.cursor_query_param,
+                                            encode_cursor(rows[-1].created_at, rows[-1].id))
+        return self.respond({'next': next_link, 'results': CreditLogSerializer(rows, many=True).data})
@@ -0,0 +1,105 @@
+from django.core.cache import caches
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .conf import get_setting
+
+SELLER_ID_CLAIM = 'seller_id'
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that resolves the token's user, together with their seller, from a
+    cache for AUTH_CACHE_TTL seconds instead of querying the database on every request.
+    Entries are dropped by signals when the user or seller is saved or deleted.
+    """
+    KEY_PREFIX = 'jwt-user:'
+    # Identity fields only: the balance and limits are deferred, read fresh when a view needs them
+    SELLER_FIELDS = ['id', 'user', 'name', 'email', 'phone_number', 'created_at']
+
+    def get_user(self, validated_token):
+        user_id = self.get_user_id(validated_token)
+        user = self.cached_user(user_id)
+        if user is None:
+            user = self.load_user(user_id)
+            self.cache_user(user_id, user)
+        return self.check_user(user, validated_token)
+
+    @staticmethod
+    def get_user_id(validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+    def user_queryset(self, user_id):
+        # One query for the user and their seller; a user without seller gets a cached "no seller"
+        fields = [field.name for field in self.user_model._meta.concrete_fields]
+        fields += [f'seller__{field}' for field in self.SELLER_FIELDS]
+        return self.user_model.objects.select_related('seller').only(*fields).filter(
+            **{api_settings.USER_ID_FIELD: user_id})
+
+    def load_user(self, user_id):
+        try:
+            return self.user_queryset(user_id).get()
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed("User not found", code='user_not_found')
+
+    async def aload_user(self, user_id):
+        try:
+            return await self.user_queryset(user_id).aget()
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed("User not found", code='user_not_found')
+
+    @staticmethod
+    def check_user(user, validated_token):
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+                api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed("The user's password has been changed.", code='password_changed')
+        return user
+
+    @staticmethod
+    def _cache():
+        return caches[get_setting('AUTH_CACHE_ALIAS')]
+
+    @classmethod
+    def cached_user(cls, user_id):
+        if not get_setting('AUTH_CACHE_TTL'):
+            return None
+        return cls._cache().get(f'{cls.KEY_PREFIX}{user_id}')
+
+    @classmethod
+    def cache_user(cls, user_id, user):
+        if get_setting('AUTH_CACHE_TTL'):
+            cls._cache().set(f'{cls.KEY_PREFIX}{user_id}', user, get_setting('AUTH_CACHE_TTL'))
+
+    @classmethod
+    def invalidate(cls, user_id):
+        cls._cache().delete(f'{cls.KEY_PREFIX}{user_id}')
+
+
+class AsyncJWTAuthentication(CachedJWTAuthentication):
+    async def aauthenticate(self, request):
+        """
+        Return (user, validated_token), or None without credentials, with the async cache and ORM.
+        """
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        user_id = self.get_user_id(validated_token)
+        ttl = get_setting('AUTH_CACHE_TTL')
+        user = await self._cache().aget(f'{self.KEY_PREFIX}{user_id}') if ttl else None
+        if user is None:
+            user = await self.aload_user(user_id)
+            if ttl:
+                await self._cache().aset(f'{self.KEY_PREFIX}{user_id}', user, ttl)
+        return self.check_user(user, validated_token), validated_token
@@ -0,0 +1,85 @@
+import hashlib
+
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import parse_etags
+
+from .conf import get_setting
+
+
+class BalanceCache:
+    """
+    Cached CreditBalanceView responses keyed by user id, with an ETag derived from the
+    response body. Debit and credit paths write the new balance through once their
+    transaction commits; reads only fill missing entries, so they never overwrite a newer
+    balance written meanwhile.
+
+    Entries can be stale for at most BALANCE_CACHE_TTL seconds: after a change made without
+    these code paths (e.g. a queryset update), and when two writes of the same seller
+    commit in one order but publish in the other.
+    """
+    KEY_PREFIX = 'credit-balance:'
+
+    @staticmethod
+    def _cache():
+        return caches[get_setting('BALANCE_CACHE_ALIAS')]
+
+    @staticmethod
+    def etag(seller_name, balance):
+        digest = hashlib.blake2b(f"{seller_name}:{balance}".encode(), digest_size=8).hexdigest()
+        return f'"{digest}"'
+
+    @classmethod
+    def entry(cls, seller_name, balance):
+        return {'seller_name': seller_name, 'current_balance': balance, 'etag': cls.etag(seller_name, balance)}
+
+    @staticmethod
+    def matches(entry, if_none_match):
+        # Weak comparison, as If-None-Match requires
+        etags = {etag.removeprefix('W/') for etag in parse_etags(if_none_match)}
+        return '*' in etags or entry['etag'] in etags
+
+    @classmethod
+    def get(cls, user_id):
+        if not get_setting('BALANCE_CACHE_TTL'):
+            return None
+        return cls._cache().get(f"{cls.KEY_PREFIX}{user_id}")
+
+    @classmethod
+    def fill(cls, user_id, seller_name, balance):
+        # Read path: only add, a write-through of a newer balance wins
+        entry = cls.entry(seller_name, balance)
+        ttl = get_setting('BALANCE_CACHE_TTL')
+        if ttl:
+            cls._cache().add(f"{cls.KEY_PREFIX}{user_id}", entry, ttl)
+        return entry
+
+    @classmethod
+    async def aget(cls, user_id):
+        if not get_setting('BALANCE_CACHE_TTL'):
+            return None
+        return await cls._cache().aget(f"{cls.KEY_PREFIX}{user_id}")
+
+    @classmethod
+    async def afill(cls, user_id, seller_name, balance):
+        entry = cls.entry(seller_name, balance)
+        ttl = get_setting('BALANCE_CACHE_TTL')
+        if ttl:
+            await cls._cache().aadd(f"{cls.KEY_PREFIX}{user_id}", entry, ttl)
+        return entry
+
+    @classmethod
+    def write_through(cls, seller, balance):
+        """
+        Publish a seller's new balance once the current transaction commits, so a balance
+        that is rolled back is never served.
+        """
+        ttl = get_setting('BALANCE_CACHE_TTL')
+        if ttl:
+            entry = cls.entry(seller.name, balance)
+            transaction.on_commit(lambda: cls._cache().set(f"{cls.KEY_PREFIX}{seller.user_id}", entry, ttl))
+
+    @classmethod
+    def invalidate(cls, user_id):
+        if get_setting('BALANCE_CACHE_TTL'):
+            transaction.on_commit(lambda: cls._cache().delete(f"{cls.KEY_PREFIX}{user_id}"))
@@ -0,0 +1,359 @@
+import asyncio
+import json
+import math
+import platform
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from decimal import Decimal
+from threading import Lock, Thread
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .handlers import CreditTransactionHandler, ShardedBalanceHandler
+from .models import Seller, CreditRequest, Transaction, CreditLog, CreditLogOutbox, PhoneNumber
+from .operators import get_operator_dispatcher
+
+SCENARIOS = ('transactions', 'reservations', 'balance', 'approvals')
+INTERFACES = ('wsgi', 'asgi')
+# URL names per interface, approvals and reservations have no async endpoint and go through the sync views
+URL_NAMES = {
+    'wsgi': {'transactions': 'transaction-create', 'reservations': 'recharge-reserve',
+             'balance': 'credit_balance_view'},
+    'asgi': {'transactions': 'async-transaction-create', 'balance': 'async-credit-balance'},
+}
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values), max(1, math.ceil(fraction * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(sample['latency'] for sample in samples)
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample['status'])] = statuses.get(str(sample['status']), 0) + 1
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample['status'] >= 400),
+        'status_codes': statuses,
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        # Not counted under ASGI, where the ORM runs on other threads
+        'queries_per_request': (sum(sample['queries'] for sample in samples) / len(samples)
+                                if samples and None not in {sample['queries'] for sample in samples} else None),
+    }
+
+
+class BenchmarkRunner:
+    """
+    Drives the charge API in-process through the full Django stack with JWT authenticated
+    clients: recharges (direct or reserved and settled by the fake operator) and balance
+    polls from sellers picked with a Zipf skew, and credit approvals from an admin. Reports
+    throughput, latency percentiles and queries per request per scenario, then checks the
+    ledger invariants of the benchmark sellers.
+
+    The wsgi interface runs `concurrency` threads against the sync views, the asgi one
+    `concurrency` tasks on one event loop against the async views.
+    """
+
+    def __init__(self, requests=2000, concurrency=8, sellers=10, skew=1.0, mix=None, amount=Decimal('1.00'),
+                 seed=None, host='localhost', interface='wsgi', trace_memory=False, operator_latency=None,
+                 operator_failure_rate=None):
+        self.requests = requests
+        self.concurrency = concurrency
+        self.seller_count = sellers
+        self.skew = skew
+        self.mix = mix or {'transactions': 70, 'balance': 25, 'approvals': 5}
+        self.amount = amount
+        self.random = random.Random(seed)
+        self.host = host  # Must be in ALLOWED_HOSTS, localhost is allowed by default with DEBUG
+        self.interface = interface
+        self.trace_memory = trace_memory
+        # Fake operator behind the reservations, None = the FAKE_OPERATOR_* settings
+        self.operator_latency = operator_latency
+        self.operator_failure_rate = operator_failure_rate
+        self.peak_threads = 0
+        self.tag = uuid.uuid4().hex[:8]
+
+    def setup(self):
+        self.admin = User.objects.create_user(username=f"bench-admin-{self.tag}", is_staff=True)
+        self.sellers = []
+        for index in range(self.seller_count):
+            name = f"bench-{self.tag}-{index}"
+            user = User.objects.create_user(username=name)
+            seller = Seller.objects.create(user=user, name=name, email=f"{name}@example.com",
+                                           phone_number=f"{self.tag}{index}"[:15])
+            # Enough credit for every request to be a recharge, logged like any approval
+            CreditTransactionHandler.add_credit(seller.id, self.amount * self.requests)
+            self.sellers.append(seller)
+        self.tokens = {seller.id: str(AccessToken.for_user(seller.user)) for seller in self.sellers}
+        self.admin_token = str(AccessToken.for_user(self.admin))
+        self.phone_numbers = [f"09{self.tag[:4]}{index:05d}"[:15] for index in range(100)]
+        PhoneNumber.objects.bulk_create([PhoneNumber(phone_number=number) for number in self.phone_numbers],
+                                        ignore_conflicts=True)
+
+        # Zipf weights: seller i gets 1 / (i + 1)^skew of the traffic, skew=0 is uniform
+        weights = [1 / (index + 1) ** self.skew for index in range(self.seller_count)]
+        scenarios = [name for name in SCENARIOS if self.mix.get(name)]
+        self.plan = []
+        for _ in range(self.requests):
+            scenario = self.random.choices(scenarios, [self.mix[name] for name in scenarios])[0]
+            seller = self.random.choices(self.sellers, weights)[0]
+            self.plan.append((scenario, seller))
+        # Approvals need one pending request each
+        approvals = [seller for scenario, seller in self.plan if scenario == 'approvals']
+        CreditRequest.objects.bulk_create([CreditRequest(seller=seller, amount=self.amount) for seller in approvals])
+        # Re-read the ids: MySQL does not return primary keys from bulk INSERTs
+        self.pending_requests = list(CreditRequest.objects.filter(
+            seller__in=self.sellers, is_approved=False).values_list('id', flat=True))
+
+    def run(self):
+        self.setup()
+        try:
+            samples = {name: [] for name in SCENARIOS}
+            if self.trace_memory:
+                tracemalloc.start()
+            with override_settings(CHARGE_MANAGEMENT=self.operator_settings()):
+                started = time.perf_counter()
+                if self.interface == 'asgi':
+                    # The async test client always sends Host: testserver
+                    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                        asyncio.run(self.drive_async(samples))
+                else:
+                    self.drive(samples)
+                elapsed = time.perf_counter() - started
+                settlement = self.settle(started) if samples['reservations'] else None
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            every_sample = [sample for scenario in samples.values() for sample in scenario]
+            return {
+                'timestamp': timezone.now().isoformat(),
+                'environment': {
+                    'database': connection.vendor,
+                    'python': platform.python_version(),
+                },
+                'config': {
+                    'interface': self.interface,
+                    'requests': self.requests,
+                    'concurrency': self.concurrency,
+                    'sellers': self.seller_count,
+                    'skew': self.skew,
+                    'mix': self.mix,
+                    'operator_latency': self.operator_latency,
+                    'operator_failure_rate': self.operator_failure_rate,
+                },
+                'elapsed_seconds': elapsed,
+                'peak_threads': self.peak_threads,
+                'peak_memory_bytes': peak_memory,
+                'total': summarize(every_sample, elapsed),
+                'scenarios': {name: summarize(rows, elapsed) for name, rows in samples.items() if rows},
+                'settlement': settlement,
+                'invariants': self.check_invariants(),
+            }
+        finally:
+            self.teardown()
+
+    def operator_settings(self):
+        overrides = dict(getattr(settings, 'CHARGE_MANAGEMENT', {}))
+        if self.operator_latency is not None:
+            overrides['FAKE_OPERATOR_LATENCY'] = self.operator_latency
+        if self.operator_failure_rate is not None:
+            overrides['FAKE_OPERATOR_FAILURE_RATE'] = self.operator_failure_rate
+        return overrides
+
+    def settle(self, started):
+        # Wait for the operator to answer every reservation: settled recharges per second is the
+        # throughput that matters with a slow operator, not the rate of 202 responses
+        dispatcher = get_operator_dispatcher()
+        while True:
+            dispatcher.wait()
+            # Reservations a full dispatch queue turned away, as the dispatch_recharges command would
+            if not dispatcher.sweep(older_than=0)[1]:
+                break
+        elapsed = time.perf_counter() - started
+        # Direct recharges are captured without an operator reference
+        statuses = dict(Transaction.objects.filter(seller__in=self.sellers).exclude(
+            status=Transaction.CAPTURED, operator_reference='').values_list('status').annotate(count=Count('id')))
+        settled = statuses.get(Transaction.CAPTURED, 0) + statuses.get(Transaction.RELEASED, 0)
+        return {
+            'captured': statuses.get(Transaction.CAPTURED, 0),
+            'released': statuses.get(Transaction.RELEASED, 0),
+            'unsettled': statuses.get(Transaction.RESERVED, 0) + statuses.get(Transaction.DISPATCHED, 0),
+            'elapsed_seconds': elapsed,
+            'settled_per_second': settled / elapsed if elapsed else 0.0,
+        }
+
+    def drive(self, samples):
+        lock = Lock()
+        queue = list(self.plan)
+        approvals = list(self.pending_requests)
+
+        def worker(rng):
+            client = Client(HTTP_HOST=self.host)
+            counter = {'queries': 0}
+
+            def count_query(execute, sql, params, many, context):
+                counter['queries'] += 1
+                return execute(sql, params, many, context)
+
+            try:
+                with connection.execute_wrapper(count_query):
+                    while True:
+                        with lock:
+                            if not queue:
+                                return
+                            scenario, seller = queue.pop()
+                            request_id = approvals.pop() if scenario == 'approvals' else None
+                        counter['queries'] = 0
+                        started = time.perf_counter()
+                        status = self.send(client, rng, scenario, seller, request_id)
+                        sample = {'latency': time.perf_counter() - started, 'status': status,
+                                  'queries': counter['queries']}
+                        with lock:
+                            samples[scenario].append(sample)
+                            self.peak_threads = max(self.peak_threads, threading.active_count())
+            finally:
+                if self.concurrency > 1:
+                    connection.close()
+
+        # No generator shared between threads: each worker gets its own, seeded from the run's seed
+        rngs = [random.Random(self.random.getrandbits(64)) for _ in range(self.concurrency)]
+        if self.concurrency == 1:
+            worker(rngs[0])  # Inline, on the caller's connection and transaction
+        else:
+            threads = [Thread(target=worker, args=(rng,)) for rng in rngs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    async def drive_async(self, samples):
+        queue = list(self.plan)
+        approvals = list(self.pending_requests)
+
+        async def worker(rng):
+            client = AsyncClient()
+            # Single-threaded event loop: no lock needed around the shared queue
+            while queue:
+                scenario, seller = queue.pop()
+                request_id = approvals.pop() if scenario == 'approvals' else None
+                started = time.perf_counter()
+                status = await self.send_async(client, rng, scenario, seller, request_id)
+                samples[scenario].append({'latency': time.perf_counter() - started, 'status': status,
+                                          'queries': None})
+                self.peak_threads = max(self.peak_threads, threading.active_count())
+
+        await asyncio.gather(*(worker(random.Random(self.random.getrandbits(64))) for _ in range(self.concurrency)))
+
+    def send(self, client, rng, scenario, seller, request_id):
+        if scenario in ('transactions', 'reservations'):
+            response = client.post(reverse(URL_NAMES['wsgi'][scenario]), {
+                'phone_number': rng.choice(self.phone_numbers), 'amount': str(self.amount),
+            }, content_type='application/json', HTTP_AUTHORIZATION=f"Bearer {self.tokens[seller.id]}")
+        elif scenario == 'balance':
+            response = client.get(reverse(URL_NAMES['wsgi']['balance']),
+                                  HTTP_AUTHORIZATION=f"Bearer {self.tokens[seller.id]}")
+        else:
+            response = client.post(reverse('credit-request-approve', args=[request_id]),
+                                   HTTP_AUTHORIZATION=f"Bearer {self.admin_token}")
+        return response.status_code
+
+    async def send_async(self, client, rng, scenario, seller, request_id):
+        if scenario == 'approvals':
+            headers = {'Authorization': f"Bearer {self.admin_token}"}
+            response = await client.post(reverse('credit-request-approve', args=[request_id]), headers=headers)
+            return response.status_code
+        if scenario == 'reservations':
+            response = await client.post(reverse(URL_NAMES['wsgi']['reservations']), {
+                'phone_number': rng.choice(self.phone_numbers), 'amount': str(self.amount),
+            }, content_type='application/json', headers={'Authorization': f"Bearer {self.tokens[seller.id]}"})
+            return response.status_code
+        headers = {'Authorization': f"Bearer {self.tokens[seller.id]}"}
+        if scenario == 'transactions':
+            response = await client.post(reverse(URL_NAMES['asgi']['transactions']), {
+                'phone_number': rng.choice(self.phone_numbers), 'amount': str(self.amount),
+            }, content_type='application/json', headers=headers)
+        else:
+            response = await client.get(reverse(URL_NAMES['asgi']['balance']), headers=headers)
+        return response.status_code
+
+    def check_invariants(self):
+        """
+        For every benchmark seller: the balance is not negative, equals approved credit minus
+        recharges that were not released, equals the sum of its credit log (including pending
+        outbox entries), and the held amount equals its unsettled reservations.
+        """
+        violations = []
+        for seller in self.sellers:
+            balance = ShardedBalanceHandler.total_credit(seller.id)
+            credited = (CreditRequest.objects.filter(seller=seller, is_approved=True).aggregate(
+                total=Sum('amount'))['total'] or 0) + self.amount * self.requests
+            recharged = Transaction.objects.filter(seller=seller).exclude(status=Transaction.RELEASED).aggregate(
+                total=Sum('amount'))['total'] or 0
+            unsettled = Transaction.objects.filter(
+                seller=seller, status__in=[Transaction.RESERVED, Transaction.DISPATCHED]
+            ).aggregate(total=Sum('amount'))['total'] or 0
+            held = Seller.objects.filter(id=seller.id).values_list('held', flat=True).get()
+            logged = sum(model.objects.filter(seller=seller).aggregate(total=Sum('amount'))['total'] or 0
+                         for model in (CreditLog, CreditLogOutbox))
+            if balance < 0:
+                violations.append(f"{seller.name}: negative balance {balance}")
+            if balance != credited - recharged:
+                violations.append(f"{seller.name}: balance {balance} != credited {credited} - recharged {recharged}")
+            if balance != logged:
+                violations.append(f"{seller.name}: balance {balance} != credit log total {logged}")
+            if held != unsettled:
+                violations.append(f"{seller.name}: held {held} != unsettled reservations {unsettled}")
+        return {'ok': not violations, 'violations': violations}
+
+    def teardown(self):
+        # Cascades to the sellers, their requests, transactions and logs
+        User.objects.filter(username__startswith=f"bench-admin-{self.tag}").delete()
+        User.objects.filter(seller__in=self.sellers).delete()
+        PhoneNumber.objects.filter(phone_number__in=self.phone_numbers).delete()
+
+
+def compare(current, baseline):
+    """
+    Per-scenario relative change of throughput and p95 latency against a stored result.
+    """
+    changes = {}
+    for name, stats in current['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        changes[name] = {
+            'throughput_change': _relative(stats['throughput_rps'], previous['throughput_rps']),
+            'p95_change': _relative(stats['p95_ms'], previous['p95_ms']),
+            'queries_per_request': (previous['queries_per_request'], stats['queries_per_request']),
+        }
+    return changes
+
+
+def _relative(current, previous):
+    return (current - previous) / previous if previous else None
+
+
+def dump(result, path):
+    with open(path, 'w') as output:
+        json.dump(result, output, indent=2, default=str)
@@ -0,0 +1,94 @@
+from django.conf import settings
+
+
+# Defaults for the CHARGE_MANAGEMENT settings dict, override them in settings.py
+DEFAULTS = {
+    # Debit engine: attempts and jittered exponential backoff (seconds) on DatabaseError
+    'DEBIT_MAX_ATTEMPTS': 3,
+    'DEBIT_BACKOFF_BASE': 0.01,
+    'DEBIT_BACKOFF_MAX': 0.2,
+    # Bulk recharge: maximum items per request and rows per bulk INSERT
+    'BULK_TRANSACTION_MAX_ITEMS': 20000,
+    'BULK_CREATE_BATCH_SIZE': 1000,
+    # Bulk approval: maximum credit requests per request
+    'CREDIT_APPROVAL_MAX_ITEMS': 1000,
+    # Phone number validity cache: local LRU size, TTLs (seconds) and optional shared cache alias
+    'PHONE_CACHE_MAX_ENTRIES': 100000,
+    'PHONE_CACHE_TTL': 300,
+    'PHONE_CACHE_NEGATIVE_TTL': 30,
+    'PHONE_CACHE_ALIAS': None,
+    # Bloom filter prefilter of registered phone numbers, loaded from PHONE_INDEX_PATH when it exists
+    'PHONE_INDEX_ENABLED': False,
+    'PHONE_INDEX_PATH': None,
+    'PHONE_INDEX_ERROR_RATE': 0.01,
+    'PHONE_INDEX_REFRESH_INTERVAL': 60,
+    'PHONE_INDEX_REFRESH_OVERLAP': 1000,
+    # Phone number imports and bulk (de)activations: numbers per chunk, each handled in one transaction
+    'PHONE_IMPORT_CHUNK_SIZE': 5000,
+    # Ledger rows younger than this (seconds) are not rolled up yet, lower ids may still be uncommitted
+    'RECONCILIATION_SETTLE_SECONDS': 300,
+    # Ledger archive: directory of the monthly segment files (None = no archive) and rows per batch
+    'ARCHIVE_PATH': None,
+    'ARCHIVE_BATCH_SIZE': 5000,
+    # Analytics export: directory of the column files (None = no export) and rows per file
+    'ANALYTICS_EXPORT_PATH': None,
+    'ANALYTICS_EXPORT_BATCH_SIZE': 100000,
+    # Idempotency keys: lifetime, how long duplicates wait for the first request, and when an
+    # in-flight key counts as abandoned (seconds)
+    'IDEMPOTENCY_KEY_TTL': 86400,
+    'IDEMPOTENCY_WAIT_SECONDS': 5,
+    'IDEMPOTENCY_LOCK_TIMEOUT': 60,
+    # Write-behind credit logs: outbox on/off, backlog that triggers 503s on debits, seconds between backlog counts
+    'CREDIT_LOG_OUTBOX': False,
+    'OUTBOX_MAX_PENDING': 100000,
+    'OUTBOX_PENDING_CHECK_INTERVAL': 5,
+    # Instrumentation: metrics on/off, bearer token required by /metrics (None = staff or DEBUG only), and the
+    # slow-request log threshold (seconds, None = off) with the fraction of slow requests logged
+    'METRICS_ENABLED': True,
+    'METRICS_TOKEN': None,
+    'SLOW_REQUEST_THRESHOLD': None,
+    'SLOW_REQUEST_SAMPLE_RATE': 0.1,
+    # Balance reads: Django cache alias and how long (seconds) an entry may be served, 0 = no caching
+    'BALANCE_CACHE_ALIAS': 'default',
+    'BALANCE_CACHE_TTL': 30,
+    # Admission control of recharges: on/off, default per-seller token bucket (recharges per second,
+    # burst) and in-flight cap (None = no limit), cache alias shared by all processes (None = per
+    # process memory), seconds per-seller overrides are kept, and in-flight counter expiry (seconds)
+    'ADMISSION_CONTROL_ENABLED': False,
+    'RECHARGE_RATE_LIMIT': 20,
+    'RECHARGE_BURST': 40,
+    'RECHARGE_MAX_IN_FLIGHT': 4,
+    'ADMISSION_CACHE_ALIAS': None,
+    'ADMISSION_LIMITS_TTL': 60,
+    'ADMISSION_IN_FLIGHT_TIMEOUT': 60,
+    # JWT authentication: cache alias and seconds an authenticated user and seller are cached, 0 = off
+    'AUTH_CACHE_ALIAS': 'default',
+    'AUTH_CACHE_TTL': 60,
+    # Read replicas: database aliases read-only endpoints may use, the replication lag (seconds) past
+    # which a replica is skipped, seconds between lag and health checks, and the cache alias holding
+    # the read-your-writes pins of sellers that just wrote
+    'READ_REPLICAS': [],
+    'REPLICA_MAX_LAG': 5,
+    'REPLICA_CHECK_INTERVAL': 5,
+    'REPLICA_PIN_CACHE_ALIAS': 'default',
+    # Two-phase recharges: seconds a reservation holds the credit, operator client class, operator call
+    # timeout (seconds, keep it below the hold), dispatcher threads (0 = dispatch inline) and the number
+    # of reservations that may wait for one
+    'RECHARGE_HOLD_TIMEOUT': 60,
+    'OPERATOR_CLIENT': 'charge_management.operators.FakeOperatorClient',
+    'OPERATOR_TIMEOUT': 10,
+    'OPERATOR_POOL_SIZE': 16,
+    'OPERATOR_QUEUE_SIZE': 1000,
+    # Fake operator: mean answer time (seconds) and fraction of rejected top-ups
+    'FAKE_OPERATOR_LATENCY': 0.5,
+    'FAKE_OPERATOR_FAILURE_RATE': 0.0,
+    # Seller statistics: days in a period by default and at most
+    'SELLER_STATS_DEFAULT_DAYS': 30,
+    'SELLER_STATS_MAX_DAYS': 366,
+    # Async endpoints: threads (and database connections) for blocking sections, 0 = Django's shared thread
+    'ASYNC_DB_POOL_SIZE': 8,
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'CHARGE_MANAGEMENT', {}).get(name, DEFAULTS[name])
@@ -0,0 +1,36 @@
+from django.http import Http404
+
+from .authentication import SELLER_ID_CLAIM
+from .models import Seller
+
+# The user -> seller reverse one-to-one, whose cached value CachedJWTAuthentication loads with the user
+_SELLER_RELATION = Seller._meta.get_field('user').remote_field
+
+
+def get_request_seller(request):
+    """
+    The Seller of the authenticated user. The reverse one-to-one accessor caches it on the
+    request's user, so it is loaded with one query and then shared by the view, its
+    serializers and Transaction.save(). Raises Http404 when the user has no seller.
+    """
+    try:
+        return request.user.seller
+    except (Seller.DoesNotExist, AttributeError):  # AnonymousUser has no seller either
+        raise Http404("The Seller associated with this user was not found.")
+
+
+def get_request_seller_id(request):
+    """
+    The id of the authenticated user's Seller, read from the token's seller_id claim when it
+    carries one, so views that only filter by seller need no seller lookup. The claim is only
+    trusted while it matches the seller loaded with the user: a seller moved to another user
+    or replaced since the token was issued falls back to the user's current seller.
+    """
+    token = getattr(request, 'auth', None)
+    if token is not None and SELLER_ID_CLAIM in token:
+        user = getattr(request, 'user', None)
+        if user is not None and _SELLER_RELATION.is_cached(user):
+            seller = _SELLER_RELATION.get_cached_value(user)
+            if seller is not None and seller.id == token[SELLER_ID_CLAIM]:
+                return seller.id
+    return get_request_seller(request).id
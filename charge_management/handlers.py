@@ -1,5 +1,28 @@
-from django.db import transaction
-from .models import Seller, CreditLog
+import random
+from datetime import timedelta
+from decimal import Decimal, ROUND_DOWN
+from time import sleep
+
+from django.db import connection, transaction, DatabaseError
+from django.db.models import DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .balance_cache import BalanceCache
+from .conf import get_setting
+from .instrumentation import record_retry, stage
+from .models import Seller, SellerBalanceShard, CreditRequest, Transaction, CreditLog, PhoneNumber
+from .outbox import CreditLogWriter
+from .phone_cache import get_phone_cache
+from .phone_index import might_be_registered
+from .replicas import pin_to_primary
+from .seller_stats import SellerStatsRecorder
+
+
+def in_outer_transaction():
+    # Like Django's check for durable blocks: TestCase's own transactions do not count
+    blocks = connection.atomic_blocks
+    return bool(blocks) and not blocks[-1]._from_testcase
 
 
 class CreditTransactionHandler:
@@ -8,19 +31,28 @@ class CreditTransactionHandler:
         try:
             with transaction.atomic():
                 # Start a transaction and lock the seller row
-                seller = Seller.objects.select_for_update().get(id=seller_id)
+                with stage('lock_wait'):
+                    seller = Seller.objects.select_for_update().get(id=seller_id)
 
                 # Update seller's credit
                 seller.credit += amount
                 seller.save()
 
+                # Spread the new credit over the sub-balances of a sharded seller
+                balance = seller.credit
+                if seller.credit_shards:
+                    balance = ShardedBalanceHandler.rebalance(seller.id)
+
                 # Log the credit update
-                CreditLog.objects.create(
+                CreditLogWriter.write([CreditLog(
                     seller=seller,
                     amount=amount,
-                    balance_snapshot=seller.credit,
+                    balance_snapshot=balance,
                     description=f"Credit added via approval."
-                )
+                )])
+                SellerStatsRecorder.record_credit(seller.id, amount)
+                BalanceCache.write_through(seller, balance)
+                pin_to_primary(seller.id)
 
                 return {"success": True, "message": "Credit successfully added."}
 
@@ -28,3 +60,462 @@ class CreditTransactionHandler:
             return {"success": False, "message": "Seller does not exist."}
         except Exception as e:
             return {"success": False, "message": f"An error occurred: {e}"}
+
+
+class CreditApprovalHandler:
+    APPROVED = 'approved'
+    ALREADY_APPROVED = 'already_approved'
+    NOT_FOUND = 'not_found'
+    FAILED = 'failed'
+
+    @classmethod
+    def approve_requests(cls, request_ids, user):
+        """
+        Approve pending credit requests grouped by seller: one transaction per seller locks
+        it once, adds the summed amount and writes the CreditLog entries and approvals in
+        bulk. A failing seller does not affect the others. Returns one
+        {'id', 'status', 'seller_id', 'amount'} result per requested id, in request order.
+        """
+        request_ids = list(dict.fromkeys(request_ids))
+        found = {row['id']: row for row in CreditRequest.objects.filter(id__in=request_ids).values(
+            'id', 'seller_id', 'amount', 'is_approved')}
+        results = {}
+        groups = {}
+        for pk in request_ids:
+            row = found.get(pk)
+            if row is None:
+                results[pk] = {'id': pk, 'status': cls.NOT_FOUND, 'seller_id': None, 'amount': None}
+                continue
+            results[pk] = {'id': pk, 'status': cls.ALREADY_APPROVED if row['is_approved'] else None,
+                           'seller_id': row['seller_id'], 'amount': row['amount']}
+            if not row['is_approved']:
+                groups.setdefault(row['seller_id'], []).append(pk)
+
+        # Sellers are locked in id order, so concurrent batches cannot deadlock on each other
+        for seller_id in sorted(groups):
+            try:
+                approved = cls._approve_seller(seller_id, groups[seller_id], user)
+            except Exception as e:
+                for pk in groups[seller_id]:
+                    results[pk].update(status=cls.FAILED, detail=f"An error occurred: {e}")
+                continue
+            for pk in groups[seller_id]:
+                results[pk]['status'] = cls.APPROVED if pk in approved else cls.ALREADY_APPROVED
+        return [results[pk] for pk in request_ids]
+
+    @staticmethod
+    def _approve_seller(seller_id, request_ids, user):
+        with transaction.atomic():
+            seller = Seller.objects.select_for_update().get(id=seller_id)
+            # Approved meanwhile by a concurrent batch or single approval
+            pending = list(CreditRequest.objects.select_for_update().filter(
+                id__in=request_ids, is_approved=False).order_by('id').values_list('id', 'amount'))
+            if not pending:
+                return set()
+            total = sum(amount for _, amount in pending)
+            seller.credit += total
+            seller.save(update_fields=['credit', 'updated_at'])
+            balance = seller.credit
+            if seller.credit_shards:
+                balance = ShardedBalanceHandler.rebalance(seller.id)
+
+            logs = []
+            running = balance - total
+            for _, amount in pending:
+                running += amount
+                logs.append(CreditLog(seller=seller, amount=amount, balance_snapshot=running,
+                                      description=f"Credit added via approval."))
+            CreditLogWriter.write(logs)
+            SellerStatsRecorder.record_credit(seller.id, total, len(pending))
+            CreditRequest.objects.filter(id__in=[pk for pk, _ in pending]).update(
+                is_approved=True, approved_by=user, approved_at=timezone.now())
+            BalanceCache.write_through(seller, balance)
+            pin_to_primary(seller.id)
+            return {pk for pk, _ in pending}
+
+
+class DebitTransactionHandler:
+    @staticmethod
+    def backoff_delay(attempt):
+        # Full jitter: a random delay in [0, min(cap, base * 2^attempt)]
+        cap = get_setting('DEBIT_BACKOFF_MAX')
+        base = get_setting('DEBIT_BACKOFF_BASE')
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+    @staticmethod
+    def withdraw(seller_id, amount, shards=0):
+        """
+        Debit the seller with a single conditional UPDATE and return the new balance,
+        or None if the credit is insufficient. Must run inside a transaction.
+        """
+        if shards:
+            return ShardedBalanceHandler.withdraw(seller_id, amount, shards)
+        updated = Seller.objects.filter(id=seller_id, credit__gte=amount).update(
+            credit=F('credit') - amount,
+            updated_at=timezone.now()
+        )
+        if not updated:
+            return None
+        # The UPDATE holds the row until commit, so this read sees our own balance
+        return Seller.objects.filter(id=seller_id).values_list('credit', flat=True).get()
+
+    @classmethod
+    def run_with_retries(cls, operation):
+        """
+        Run operation() in a transaction and return its result, retrying on
+        DatabaseError (deadlocks, lock timeouts) with bounded jittered backoff. Inside the
+        caller's transaction it runs once: a deadlock rolls back the whole transaction (on
+        MySQL), so only the caller can retry, e.g. IdempotencyHandler.
+        """
+        if in_outer_transaction():
+            with transaction.atomic():
+                return operation()
+        max_attempts = get_setting('DEBIT_MAX_ATTEMPTS')
+        attempt = 0
+        while True:
+            try:
+                with transaction.atomic():
+                    return operation()
+            except DatabaseError:
+                attempt += 1
+                if attempt >= max_attempts:
+                    raise
+                record_retry('debit')
+                sleep(cls.backoff_delay(attempt))
+
+    @classmethod
+    def debit(cls, recharge, save_recharge):
+        """
+        Debit the seller of a recharge transaction, then persist it with save_recharge()
+        and write its CreditLog entry (or outbox row), all in one short database transaction.
+        """
+        is_new = recharge.pk is None
+
+        def operation():
+            if is_new:
+                # A rolled back attempt may have assigned a primary key
+                recharge.pk = None
+                recharge._state.adding = True
+            # The conditional UPDATE waits for the row lock, so this stage includes lock wait time
+            with stage('debit_update'):
+                balance = cls.withdraw(recharge.seller_id, recharge.amount, recharge.seller.credit_shards)
+            if balance is None:
+                raise ValueError("Insufficient credit for this transaction.")
+            if recharge.status == Transaction.RESERVED:
+                # Held until the operator confirms the top-up or the hold is released
+                Seller.objects.filter(id=recharge.seller_id).update(held=F('held') + recharge.amount)
+            with stage('transaction_insert'):
+                save_recharge()
+            CreditLogWriter.write([CreditLog(
+                seller_id=recharge.seller_id,
+                amount=-recharge.amount,
+                balance_snapshot=balance,
+                description=f"Recharge transaction to {recharge.phone_number}"
+            )], debit=True)
+            SellerStatsRecorder.record_debits(recharge.seller_id, timezone.localdate(recharge.created_at),
+                                              [(recharge.phone_number, recharge.amount)],
+                                              recharge.seller.credit_shards)
+            BalanceCache.write_through(recharge.seller, balance)
+            pin_to_primary(recharge.seller_id)
+            return balance
+
+        return cls.run_with_retries(operation)
+
+
+class RechargeReservationHandler:
+    """
+    Two-phase recharges: reserve() debits the available credit into the seller's held
+    amount without contacting the operator; once the operator answers, capture() settles
+    the hold or release() gives the amount back. Every transition is a conditional UPDATE
+    on the status, so a recharge is settled once whatever the number of workers.
+    """
+
+    @staticmethod
+    def reserve(seller, phone_number, amount):
+        recharge = Transaction(seller=seller, phone_number=phone_number, amount=amount,
+                               status=Transaction.RESERVED,
+                               hold_expires_at=timezone.now() + timedelta(seconds=get_setting('RECHARGE_HOLD_TIMEOUT')))
+        recharge.save()
+        return recharge
+
+    @staticmethod
+    def mark_dispatched(transaction_id):
+        """
+        Claim a reserved recharge for dispatch, return it or None when another worker has it,
+        its hold was released, or the hold would expire before the operator call times out
+        (such a recharge stays reserved until release_expired() gives its amount back).
+        """
+        claimed = Transaction.objects.filter(
+            id=transaction_id, status=Transaction.RESERVED,
+            hold_expires_at__gt=timezone.now() + timedelta(seconds=get_setting('OPERATOR_TIMEOUT'))
+        ).update(status=Transaction.DISPATCHED)
+        if not claimed:
+            return None
+        return Transaction.objects.get(id=transaction_id)
+
+    @staticmethod
+    def capture(recharge, reference):
+        # The credit left the available balance at reservation: only the hold is settled
+        with transaction.atomic():
+            captured = Transaction.objects.filter(id=recharge.id, status=Transaction.DISPATCHED).update(
+                status=Transaction.CAPTURED, operator_reference=reference)
+            if captured:
+                Seller.objects.filter(id=recharge.seller_id).update(held=F('held') - recharge.amount,
+                                                                    updated_at=timezone.now())
+            return bool(captured)
+
+    @staticmethod
+    def release(recharge, reason):
+        """
+        Give a reserved or dispatched recharge's amount back to the seller, return False when
+        it was settled meanwhile.
+        """
+        with transaction.atomic():
+            released = Transaction.objects.filter(
+                id=recharge.id, status__in=[Transaction.RESERVED, Transaction.DISPATCHED]
+            ).update(status=Transaction.RELEASED)
+            if not released:
+                return False
+            Seller.objects.filter(id=recharge.seller_id).update(
+                credit=F('credit') + recharge.amount, held=F('held') - recharge.amount, updated_at=timezone.now())
+            seller = Seller.objects.only('name', 'user').get(id=recharge.seller_id)
+            balance = ShardedBalanceHandler.total_credit(recharge.seller_id)
+            CreditLogWriter.write([CreditLog(
+                seller_id=recharge.seller_id,
+                amount=recharge.amount,
+                balance_snapshot=balance,
+                description=f"Released recharge to {recharge.phone_number}: {reason}"[:255]
+            )])
+            # Counted on the day it was reserved, so the day's spend ends up net of the release
+            SellerStatsRecorder.record_debits(recharge.seller_id, timezone.localdate(recharge.created_at),
+                                              [(recharge.phone_number, -recharge.amount)])
+            BalanceCache.write_through(seller, balance)
+            pin_to_primary(recharge.seller_id)
+            return True
+
+    @classmethod
+    def release_expired(cls, limit=1000):
+        """
+        Release holds past their expiry. Dispatched recharges get OPERATOR_TIMEOUT more
+        seconds, so a hold is never released while its operator call may still succeed.
+        Returns the number released.
+        """
+        now = timezone.now()
+        expired = Transaction.objects.filter(
+            Q(status=Transaction.RESERVED, hold_expires_at__lt=now)
+            | Q(status=Transaction.DISPATCHED,
+                hold_expires_at__lt=now - timedelta(seconds=get_setting('OPERATOR_TIMEOUT')))
+        ).order_by('hold_expires_at').only('id', 'seller_id', 'phone_number', 'amount', 'created_at')[:limit]
+        return sum(1 for recharge in list(expired) if cls.release(recharge, "hold expired"))
+
+    @staticmethod
+    def reserved_ids(older_than=0, limit=1000):
+        # Reservations still waiting for a worker, e.g. after a restart or a full dispatch queue
+        # Holds expire RECHARGE_HOLD_TIMEOUT after the reservation, so this stays on the status index
+        reserved_before = timezone.now() + timedelta(seconds=get_setting('RECHARGE_HOLD_TIMEOUT') - older_than)
+        return list(Transaction.objects.filter(
+            status=Transaction.RESERVED, hold_expires_at__lt=reserved_before
+        ).order_by('hold_expires_at').values_list('id', flat=True)[:limit])
+
+
+class BulkTransactionHandler:
+    ALL_OR_NOTHING = 'all_or_nothing'
+    BEST_EFFORT = 'best_effort'
+
+    @staticmethod
+    def valid_phone_numbers(phone_numbers):
+        cache = get_phone_cache()
+        valid = set()
+        missing = []
+        for phone_number in phone_numbers:
+            is_valid = cache.get(phone_number)
+            if is_valid is None:
+                if might_be_registered(phone_number):
+                    missing.append(phone_number)
+                else:
+                    cache.set(phone_number, False)
+            elif is_valid:
+                valid.add(phone_number)
+
+        # One query for the cache misses unless the backend limits the number of parameters
+        step = connection.features.max_query_params or len(missing) or 1
+        for start in range(0, len(missing), step):
+            chunk = missing[start:start + step]
+            found = set(PhoneNumber.objects.filter(
+                phone_number__in=chunk, is_active=True
+            ).order_by().values_list('phone_number', flat=True))
+            for phone_number in chunk:
+                cache.set(phone_number, phone_number in found)
+            valid |= found
+        return valid
+
+    @classmethod
+    def create_bulk(cls, seller, items, mode=ALL_OR_NOTHING):
+        """
+        Recharge a list of {'phone_number', 'amount'} items with one debit of the summed amount
+        and chunked bulk INSERTs of the Transaction and CreditLog rows.
+
+        In all-or-nothing mode any invalid phone number or a lack of credit rejects the whole
+        batch; in best-effort mode valid items are accepted in order while the credit lasts.
+        Returns (created, results), results holding a status per item in request order.
+        """
+        valid = cls.valid_phone_numbers({item['phone_number'] for item in items})
+        results = [{'index': index, 'phone_number': item['phone_number'], 'amount': item['amount'],
+                    'status': 'pending' if item['phone_number'] in valid else 'invalid_phone_number'}
+                   for index, item in enumerate(items)]
+        candidates = [result for result in results if result['status'] == 'pending']
+        if mode == cls.ALL_OR_NOTHING and len(candidates) < len(results):
+            return cls._reject(results, 'rejected')
+
+        def operation():
+            # In best-effort mode a concurrent debit can outrun the balance we read, so re-plan
+            for _ in range(get_setting('DEBIT_MAX_ATTEMPTS')):
+                accepted = candidates if mode == cls.ALL_OR_NOTHING else cls._affordable(seller, candidates)
+                if not accepted:
+                    return []
+                total = sum(result['amount'] for result in accepted)
+                balance = DebitTransactionHandler.withdraw(seller.id, total, seller.credit_shards)
+                if balance is not None:
+                    cls._write_rows(seller, accepted, balance + total)
+                    SellerStatsRecorder.record_debits(
+                        seller.id, timezone.localdate(),
+                        [(result['phone_number'], result['amount']) for result in accepted], seller.credit_shards)
+                    BalanceCache.write_through(seller, balance)
+                    pin_to_primary(seller.id)
+                    return accepted
+                if mode == cls.ALL_OR_NOTHING:
+                    return []
+            return []
+
+        accepted = DebitTransactionHandler.run_with_retries(operation)
+        if not accepted:
+            return cls._reject(results, 'insufficient_credit')
+        accepted_indexes = {result['index'] for result in accepted}
+        for result in results:
+            if result['status'] == 'pending':
+                result['status'] = 'created' if result['index'] in accepted_indexes else 'insufficient_credit'
+        return True, results
+
+    @staticmethod
+    def _affordable(seller, candidates):
+        # Accept items in order while they fit into the current balance
+        available = ShardedBalanceHandler.total_credit(seller.id)
+        accepted = []
+        for result in candidates:
+            if result['amount'] <= available:
+                available -= result['amount']
+                accepted.append(result)
+        return accepted
+
+    @staticmethod
+    def _reject(results, status):
+        for result in results:
+            if result['status'] == 'pending':
+                result['status'] = status
+        return False, results
+
+    @staticmethod
+    def _write_rows(seller, accepted, opening_balance):
+        batch_size = get_setting('BULK_CREATE_BATCH_SIZE')
+        for start in range(0, len(accepted), batch_size):
+            chunk = accepted[start:start + batch_size]
+            recharges = Transaction.objects.bulk_create([
+                Transaction(seller_id=seller.id, phone_number=result['phone_number'], amount=result['amount'])
+                for result in chunk
+            ])
+            logs = []
+            for result, recharge in zip(chunk, recharges):
+                # Some backends (MySQL) do not return primary keys from bulk INSERTs
+                result['transaction_id'] = recharge.pk
+                opening_balance -= result['amount']
+                logs.append(CreditLog(
+                    seller_id=seller.id,
+                    amount=-result['amount'],
+                    balance_snapshot=opening_balance,
+                    description=f"Recharge transaction to {result['phone_number']}"
+                ))
+            CreditLogWriter.write(logs, debit=True)
+
+
+class ShardedBalanceHandler:
+    """
+    Balance of a sharded seller: Seller.credit is a reserve that approvals credit, and
+    SellerBalanceShard rows carry the spendable credit that debits draw from.
+    """
+
+    @staticmethod
+    def total_credit_expression():
+        # Seller.credit plus the shards, to annotate seller querysets with one subquery per row
+        output_field = DecimalField(max_digits=12, decimal_places=2)
+        shard_total = SellerBalanceShard.objects.filter(seller_id=OuterRef('id')).values('seller_id').annotate(
+            total=Sum('credit')).values('total')
+        return F('credit') + Coalesce(Subquery(shard_total, output_field=output_field), Value(0),
+                                      output_field=output_field)
+
+    @staticmethod
+    def total_credit(seller_id):
+        credit, shard_total = Seller.objects.filter(id=seller_id).annotate(
+            shard_total=Sum('balance_shards__credit')
+        ).values_list('credit', 'shard_total').get()
+        return credit + (shard_total or 0)
+
+    @classmethod
+    def withdraw(cls, seller_id, amount, shards):
+        # Start on a random shard so concurrent debits land on different rows
+        start = random.randrange(shards)
+        for offset in range(shards):
+            updated = SellerBalanceShard.objects.filter(
+                seller_id=seller_id, index=(start + offset) % shards, credit__gte=amount
+            ).update(credit=F('credit') - amount)
+            if updated:
+                return cls.total_credit(seller_id)
+        # No single shard covers the debit: pool the reserve and every shard, then debit
+        return cls.rebalance(seller_id, debit=amount)
+
+    @staticmethod
+    def rebalance(seller_id, debit=0):
+        """
+        Lock the seller and its shards, take an optional debit out of the pooled credit
+        and split the rest evenly over the shards. Return the new total, or None if the
+        pool cannot cover the debit. Must run inside a transaction.
+        """
+        seller = Seller.objects.select_for_update().get(id=seller_id)
+        shards = list(SellerBalanceShard.objects.select_for_update().filter(seller_id=seller_id).order_by('index'))
+        pool = seller.credit + sum(shard.credit for shard in shards)
+        if pool < debit:
+            return None
+        pool -= debit
+
+        if shards:
+            share = (pool / len(shards)).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+            for shard in shards:
+                shard.credit = share
+            shards[0].credit += pool - share * len(shards)
+            SellerBalanceShard.objects.bulk_update(shards, ['credit'])
+            seller.credit = 0
+        else:
+            seller.credit = pool
+        seller.save(update_fields=['credit', 'updated_at'])
+        return pool
+
+    @classmethod
+    def configure(cls, seller_id, shards):
+        """
+        Switch a seller to `shards` sub-balances (0 for the single-row balance) and
+        redistribute its credit accordingly.
+        """
+        with transaction.atomic():
+            seller = Seller.objects.select_for_update().get(id=seller_id)
+            existing = list(SellerBalanceShard.objects.select_for_update().filter(seller_id=seller_id))
+            # Move the credit of dropped shards back into the reserve before deleting them
+            dropped = [shard for shard in existing if shard.index >= shards]
+            seller.credit += sum(shard.credit for shard in dropped)
+            SellerBalanceShard.objects.filter(id__in=[shard.id for shard in dropped]).delete()
+            present = {shard.index for shard in existing}
+            SellerBalanceShard.objects.bulk_create([
+                SellerBalanceShard(seller_id=seller_id, index=index)
+                for index in range(shards) if index not in present
+            ])
+            seller.credit_shards = shards
+            seller.save(update_fields=['credit', 'credit_shards', 'updated_at'])
+            return cls.rebalance(seller_id)
@@ -0,0 +1,135 @@
+import hashlib
+import time
+from datetime import timedelta
+
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .conf import get_setting
+from .handlers import DebitTransactionHandler
+from .instrumentation import record_retry
+from .models import IdempotencyKey
+
+
+class IdempotencyHandler:
+    """
+    Runs a request at most once per (user, Idempotency-Key). The unique key row is inserted
+    before the request runs, so concurrent duplicates collide on the constraint: they wait
+    for the first request's stored response, or get a 409 if it does not finish in time.
+    The request runs in one transaction with the write of its response.
+    """
+    HEADER = 'Idempotency-Key'
+    POLL_INTERVAL = 0.05
+
+    @classmethod
+    def run(cls, request, key, handle):
+        request_hash = hashlib.sha256(request.body).hexdigest()
+        record, created = cls._claim(request, key, request_hash)
+        if not created:
+            if record.endpoint != request.path or record.request_hash != request_hash:
+                return Response({"detail": f"This {cls.HEADER} was already used for a different request."},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            record = cls._wait_for(record)
+            if record is None:
+                return cls.run(request, key, handle)  # The first request failed, run it ourselves
+            if record.status_code is None:
+                return Response({"detail": f"A request with this {cls.HEADER} is still in progress."},
+                                status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+            return Response(record.response_body, status=record.status_code,
+                            headers={'Idempotent-Replayed': 'true'})
+
+        attempt = 0
+        while True:
+            try:
+                # The request's writes commit together with its stored response, or not at all, so a
+                # key without a response never hides a completed debit. The key row stays locked until
+                # then: a retry past IDEMPOTENCY_LOCK_TIMEOUT waits instead of taking it over
+                with transaction.atomic():
+                    list(IdempotencyKey.objects.select_for_update().filter(pk=record.pk).values_list('pk', flat=True))
+                    response = handle()
+                    if response.status_code >= 500:
+                        transaction.set_rollback(True)
+                    else:
+                        record.status_code = response.status_code
+                        record.response_body = response.data
+                        record.save(update_fields=['status_code', 'response_body'])
+                break
+            except DatabaseError:
+                # Debits do not retry inside this transaction, the whole unit is retried instead,
+                # backing off outside of it so the key row is not locked while we sleep
+                attempt += 1
+                if attempt < get_setting('DEBIT_MAX_ATTEMPTS'):
+                    record_retry('idempotent_request')
+                    time.sleep(DebitTransactionHandler.backoff_delay(attempt))
+                    continue
+                record.delete()
+                raise
+            except Exception:
+                record.delete()  # Let the client retry
+                raise
+        if response.status_code >= 500:
+            record.delete()
+        return response
+
+    @staticmethod
+    def _claim(request, key, request_hash):
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    user=request.user, key=key, endpoint=request.path, request_hash=request_hash,
+                    locked_until=now + timedelta(seconds=get_setting('IDEMPOTENCY_LOCK_TIMEOUT')),
+                    expires_at=now + timedelta(seconds=get_setting('IDEMPOTENCY_KEY_TTL')),
+                ), True
+        except IntegrityError:
+            pass
+        record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+        if record is None:
+            return IdempotencyHandler._claim(request, key, request_hash)  # Deleted meanwhile
+        if record.status_code is not None or record.locked_until >= now:
+            return record, False
+        # Take over a key whose first request died without storing a response
+        taken_over = IdempotencyKey.objects.filter(
+            pk=record.pk, status_code__isnull=True, locked_until__lt=now, request_hash=request_hash
+        ).update(locked_until=now + timedelta(seconds=get_setting('IDEMPOTENCY_LOCK_TIMEOUT')))
+        return record, bool(taken_over)
+
+    @classmethod
+    def _wait_for(cls, record):
+        # Returns the finished record, the still in-flight record on timeout, or None if it was deleted
+        deadline = time.monotonic() + get_setting('IDEMPOTENCY_WAIT_SECONDS')
+        while record.status_code is None and time.monotonic() < deadline:
+            time.sleep(cls.POLL_INTERVAL)
+            record = IdempotencyKey.objects.filter(pk=record.pk).first()
+            if record is None:
+                return None
+        return record
+
+    @staticmethod
+    def purge_expired(batch_size=1000):
+        # Delete in small batches so the purge never holds long locks
+        deleted = 0
+        while True:
+            expired = IdempotencyKey.objects.filter(expires_at__lt=timezone.now()).values_list('id', flat=True)
+            ids = list(expired[:batch_size])
+            if not ids:
+                return deleted
+            deleted += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
+
+
+class IdempotentViewMixin:
+    """
+    Makes POST requests carrying an Idempotency-Key header safe to retry.
+    """
+
+    def post(self, request, *args, **kwargs):
+        key = request.headers.get(IdempotencyHandler.HEADER)
+        if not key:
+            return super().post(request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({"detail": f"{IdempotencyHandler.HEADER} must be at most 255 characters."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return IdempotencyHandler.run(request, key, lambda: super(IdempotentViewMixin, self).post(
+            request, *args, **kwargs))
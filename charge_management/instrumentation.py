@@ -0,0 +1,188 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from .conf import get_setting
+
+# Upper bounds of the histogram buckets: seconds for timings, plain numbers for query counts
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    In-process histograms and counters, rendered in the Prometheus text format. Every
+    worker process keeps its own registry, so scrape each process (or run one per host).
+    """
+
+    def __init__(self):
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}  # (name, labels) -> value
+        self._lock = Lock()
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        with self._lock:
+            histograms = sorted((key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                                for key, histogram in self._histograms.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        typed = set()
+        for (name, labels), buckets, counts, total, count in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class RequestProfile:
+    """
+    Where the time of one request went: per-stage seconds, queries and their time, retries.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.retries = 0
+
+    def execute(self, execute, sql, params, many, context):
+        # connection.execute_wrapper() hook
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - started
+
+
+_registry = MetricsRegistry()
+_profile = ContextVar('charge_management_request_profile', default=None)
+
+
+def get_registry():
+    return _registry
+
+
+def current_profile():
+    return _profile.get()
+
+
+@contextmanager
+def profile_request():
+    profile = RequestProfile()
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block of the hot path into charge_stage_duration_seconds{stage=name}, and into
+    the profile of the current request if there is one.
+    """
+    if not get_setting('METRICS_ENABLED'):
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _registry.observe('charge_stage_duration_seconds', elapsed, stage=name)
+        profile = _profile.get()
+        if profile is not None:
+            profile.stages[name] = profile.stages.get(name, 0.0) + elapsed
+
+
+def record_retry(operation):
+    if not get_setting('METRICS_ENABLED'):
+        return
+    _registry.increment('charge_retries_total', operation=operation)
+    profile = _profile.get()
+    if profile is not None:
+        profile.retries += 1
+
+
+def record_admission(outcome):
+    if get_setting('METRICS_ENABLED'):
+        _registry.increment('charge_admission_total', outcome=outcome)
+
+
+def record_phone_cache(result):
+    # result: hit (process-local), shared_hit (filled from the shared backend) or miss
+    if get_setting('METRICS_ENABLED'):
+        _registry.increment('charge_phone_cache_lookups_total', result=result)
+
+
+def record_operator_call(outcome, elapsed):
+    # outcome: captured, rejected, timeout, error or late (succeeded after the hold was released)
+    if get_setting('METRICS_ENABLED'):
+        _registry.increment('charge_operator_calls_total', outcome=outcome)
+        _registry.observe('charge_operator_duration_seconds', elapsed)
@@ -0,0 +1,36 @@
+import time
+from datetime import timedelta
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from charge_management.archive import LedgerArchiveHandler
+from charge_management.conf import get_setting
+
+
+class Command(BaseCommand):
+    help = ("Move CreditLog and Transaction rows older than a cutoff into monthly gzipped archive files. "
+            "Only rows already rolled up by reconcile_ledger are moved.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=90, help="Archive rows older than this.")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Rows moved per transaction (default: ARCHIVE_BATCH_SIZE).")
+        parser.add_argument('--path', default=None, help="Archive directory (default: ARCHIVE_PATH).")
+
+    def handle(self, *args, **options):
+        if options['older_than_days'] < 0:
+            raise CommandError("--older-than-days must not be negative.")
+        try:
+            handler = LedgerArchiveHandler(options['path'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        before = timezone.now() - timedelta(days=options['older_than_days'])
+        started = time.perf_counter()
+        moved = handler.archive(before, options['batch_size'] or get_setting('ARCHIVE_BATCH_SIZE'))
+        self.stdout.write(
+            f"Archived {moved['credit_logs']} credit logs and {moved['transactions']} transactions created before "
+            f"{before:%Y-%m-%d %H:%M} in {time.perf_counter() - started:.2f}s."
+        )
@@ -0,0 +1,117 @@
+import time
+import uuid
+from decimal import Decimal
+from threading import Lock, Thread
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F
+
+from charge_management.handlers import ShardedBalanceHandler
+from charge_management.models import Seller, Transaction, CreditLog
+
+
+def legacy_debit(seller_id, phone_number, amount):
+    # Baseline: the previous select_for_update() + sleep(1) retry path of Transaction.save()
+    max_attempts = 2
+    attempt = 0
+    while attempt < max_attempts:
+        try:
+            with transaction.atomic():
+                seller = Seller.objects.select_for_update().get(id=seller_id)
+                if seller.credit < amount:
+                    raise ValueError("Insufficient credit for this transaction.")
+                balance = seller.credit - amount
+                Transaction.objects.bulk_create([
+                    Transaction(seller_id=seller_id, phone_number=phone_number, amount=amount)
+                ])
+                seller.credit = F('credit') - amount
+                seller.save()
+            break
+        except DatabaseError:
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            time.sleep(1)
+    CreditLog.objects.create(
+        seller_id=seller_id,
+        amount=-amount,
+        balance_snapshot=balance,
+        description=f"Recharge transaction to {phone_number}"
+    )
+
+
+def atomic_debit(seller_id, phone_number, amount):
+    Transaction.objects.create(seller_id=seller_id, phone_number=phone_number, amount=amount)
+
+
+ENGINES = {
+    'locking': legacy_debit,
+    'atomic': atomic_debit,
+}
+
+
+class Command(BaseCommand):
+    help = ("Benchmark N concurrent debits against a single seller for each debit engine, "
+            "and for the atomic engine with each requested number of balance shards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8, help="Number of worker threads.")
+        parser.add_argument('--debits', type=int, default=2000, help="Total number of debits per engine.")
+        parser.add_argument('--amount', type=Decimal, default=Decimal('1.00'), help="Amount of each debit.")
+        parser.add_argument('--engine', choices=['both', *ENGINES], default='both')
+        parser.add_argument('--shards', type=int, nargs='+', default=[0],
+                            help="Balance shard counts to run the atomic engine with, e.g. 0 2 4 8.")
+
+    def handle(self, *args, **options):
+        engines = list(ENGINES) if options['engine'] == 'both' else [options['engine']]
+        runs = [(name, shards) for name in engines for shards in (options['shards'] if name == 'atomic' else [0])]
+        for name, shards in runs:
+            result = self.run_engine(ENGINES[name], options['concurrency'], options['debits'], options['amount'],
+                                     shards)
+            self.stdout.write(
+                f"{name:8} shards={shards} concurrency={options['concurrency']} "
+                f"ok={result['ok']} failed={result['failed']} "
+                f"elapsed={result['elapsed']:.3f}s rps={result['rps']:.1f} final_credit={result['credit']}"
+            )
+
+    def run_engine(self, debit, concurrency, debits, amount, shards=0):
+        # Every run gets a throwaway seller with exactly enough credit, removed afterwards
+        tag = uuid.uuid4().hex[:12]
+        user = User.objects.create_user(username=f"bench-{tag}")
+        seller = Seller.objects.create(user=user, name=f"bench-{tag}", email=f"bench-{tag}@example.com",
+                                       phone_number=tag, credit=amount * debits)
+        if shards:
+            ShardedBalanceHandler.configure(seller.id, shards)
+        per_worker = [debits // concurrency + (1 if i < debits % concurrency else 0) for i in range(concurrency)]
+        counts = {'ok': 0, 'failed': 0}
+        lock = Lock()
+
+        def worker(n):
+            ok = failed = 0
+            try:
+                for _ in range(n):
+                    try:
+                        debit(seller.id, '09120000000', amount)
+                        ok += 1
+                    except (ValueError, DatabaseError):
+                        failed += 1
+            finally:
+                connection.close()
+            with lock:
+                counts['ok'] += ok
+                counts['failed'] += failed
+
+        threads = [Thread(target=worker, args=(n,)) for n in per_worker]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        credit = ShardedBalanceHandler.total_credit(seller.id)
+        result = dict(counts, elapsed=elapsed, rps=counts['ok'] / elapsed if elapsed else 0, credit=credit)
+        user.delete()  # Cascades to the seller, its transactions and logs
+        return result
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from charge_management.conf import get_setting
+from charge_management.phone_index import PhoneNumberIndex
+
+
+class Command(BaseCommand):
+    help = "Build the phone number bloom filter from the database and snapshot it for workers to mmap."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help="Snapshot path, defaults to the PHONE_INDEX_PATH setting.")
+        parser.add_argument('--capacity', type=int, help="Expected number of phone numbers, including growth.")
+        parser.add_argument('--error-rate', type=float, help="Target false positive rate.")
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Rows fetched per database round trip.")
+
+    def handle(self, *args, **options):
+        path = options['output'] or get_setting('PHONE_INDEX_PATH')
+        if not path:
+            raise CommandError("Pass --output or set PHONE_INDEX_PATH in CHARGE_MANAGEMENT.")
+
+        started = time.perf_counter()
+        bloom = PhoneNumberIndex.build(options['capacity'], options['error_rate'], options['chunk_size'])
+        bloom.save(path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {path}: {bloom.size_in_bytes} bytes, {bloom.num_hashes} hashes, "
+            f"up to id {bloom.high_water_id}, in {time.perf_counter() - started:.2f}s."
+        ))
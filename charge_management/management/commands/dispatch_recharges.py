@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from charge_management.operators import OperatorDispatcher
+
+
+class Command(BaseCommand):
+    help = ("Release expired recharge holds and send the reserved recharges no web process dispatched "
+            "to the operator.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5, help="Seconds between sweeps.")
+        parser.add_argument('--once', action='store_true', help="Sweep once, wait for the dispatches and exit.")
+
+    def handle(self, *args, **options):
+        dispatcher = OperatorDispatcher()
+        try:
+            while True:
+                released, queued = dispatcher.sweep()
+                if released or queued:
+                    self.stdout.write(f"Released {released} expired holds, dispatched {queued} reservations.")
+                if options['once']:
+                    dispatcher.wait()
+                    return
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dispatcher.shutdown()
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from charge_management.outbox import OutboxDrainer
+
+
+class Command(BaseCommand):
+    help = "Move credit log entries from the outbox into CreditLog on a background thread."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Entries moved per transaction.")
+        parser.add_argument('--poll-interval', type=float, default=0.5, help="Seconds to wait when caught up.")
+        parser.add_argument('--metrics-interval', type=float, default=10, help="Seconds between lag reports.")
+        parser.add_argument('--once', action='store_true', help="Drain the current backlog and exit.")
+
+    def handle(self, *args, **options):
+        drainer = OutboxDrainer(options['batch_size'], options['poll_interval'])
+        if options['once']:
+            self.stdout.write(f"Moved {drainer.drain()} credit log entries.")
+            return
+
+        drainer.start()
+        try:
+            while True:
+                time.sleep(options['metrics_interval'])
+                metrics = drainer.metrics()
+                self.stdout.write(
+                    f"pending={metrics['pending']} oldest_age={metrics['oldest_age_seconds']:.1f}s "
+                    f"drained={metrics['drained']} batches={metrics['batches']} "
+                    f"last_batch={metrics['last_batch_seconds'] * 1000:.1f}ms"
+                )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            drainer.stop()
@@ -0,0 +1,50 @@
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from charge_management.phone_import import PhoneNumberImporter, read_csv
+
+
+class Command(BaseCommand):
+    help = ("Stream a CSV of phone numbers into the registry: register new numbers and reactivate known ones, "
+            "or deactivate / reactivate the listed numbers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file, '-' for standard input. A header row may name the "
+                                         "phone_number and description columns.")
+        action = parser.add_mutually_exclusive_group()
+        action.add_argument('--deactivate', action='store_true', help="Deactivate the listed numbers.")
+        action.add_argument('--reactivate', action='store_true', help="Reactivate the listed numbers.")
+        parser.add_argument('--column', type=int, default=0,
+                            help="Position of the number in files without a header row.")
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Numbers per transaction (default: PHONE_IMPORT_CHUNK_SIZE).")
+        parser.add_argument('--encoding', default='utf-8-sig', help="Encoding of the file.")
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            lines = io.TextIOWrapper(sys.stdin.buffer, encoding=options['encoding'], newline='')
+        else:
+            try:
+                lines = open(options['path'], encoding=options['encoding'], newline='')
+            except OSError as e:
+                raise CommandError(str(e))
+
+        importer = PhoneNumberImporter(options['chunk_size'], progress=self.report)
+        with lines:
+            rows = read_csv(lines, options['column'])
+            if options['deactivate'] or options['reactivate']:
+                stats = importer.set_active((number for number, _ in rows), active=options['reactivate'])
+            else:
+                stats = importer.import_rows(rows)
+        self.stdout.write(self.style.SUCCESS(self.format(stats)))
+
+    def report(self, stats):
+        self.stderr.write(self.format(stats), ending='\r')
+
+    @staticmethod
+    def format(stats):
+        return (f"read={stats['read']} created={stats['created']} updated={stats['updated']} "
+                f"unchanged={stats['unchanged']} duplicates={stats['duplicates']} invalid={stats['invalid']} "
+                f"in {stats['seconds']:.1f}s ({stats['rows_per_second']:.0f} rows/s)")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from charge_management.idempotency import IdempotencyHandler
+
+
+class Command(BaseCommand):
+    help = "Delete expired idempotency keys, once or continuously with --loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Keys deleted per statement.")
+        parser.add_argument('--loop', action='store_true', help="Keep running in the background.")
+        parser.add_argument('--interval', type=float, default=300, help="Seconds between purges with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = IdempotencyHandler.purge_expired(options['batch_size'])
+            self.stdout.write(f"Deleted {deleted} expired idempotency keys.")
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
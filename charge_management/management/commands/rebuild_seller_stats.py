@@ -0,0 +1,34 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from charge_management.models import Seller
+from charge_management.seller_stats import SellerStatsRecorder
+
+
+class Command(BaseCommand):
+    help = ("Recompute the daily statistics counters of sellers from their recharges (archived ones included) "
+            "and approved credit requests, e.g. once for the history made before the counters existed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('seller_ids', nargs='*', type=int, help="Sellers to rebuild (default: all).")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Sellers rebuilt per transaction; the archive is read once per batch.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if options['seller_ids']:
+            missing = set(options['seller_ids']) - set(
+                Seller.objects.filter(id__in=options['seller_ids']).values_list('id', flat=True))
+            if missing:
+                raise CommandError(f"Seller(s) {', '.join(map(str, sorted(missing)))} do not exist.")
+            seller_ids = iter(sorted(set(options['seller_ids'])))
+        else:
+            seller_ids = Seller.objects.order_by('id').values_list('id', flat=True).iterator()
+        rebuilt = 0
+        while batch := list(islice(seller_ids, options['batch_size'])):
+            for seller_id, days in SellerStatsRecorder.rebuild(batch).items():
+                rebuilt += 1
+                self.stdout.write(f"Seller {seller_id}: {days} day(s).")
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the statistics of {rebuilt} seller(s)."))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from charge_management.reconciliation import LedgerReconciliationHandler
+
+
+class Command(BaseCommand):
+    help = ("Roll new CreditLog and Transaction rows into daily snapshots, then check every seller's "
+            "balance against its latest snapshot plus the logs written since.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help="Ledger rows rolled up per transaction.")
+        parser.add_argument('--skip-rollup', action='store_true', help="Only verify against the existing snapshots.")
+        parser.add_argument('--fail-on-drift', action='store_true', help="Exit with an error if any balance drifts.")
+
+    def handle(self, *args, **options):
+        if not options['skip_rollup']:
+            started = time.perf_counter()
+            consumed = LedgerReconciliationHandler.roll_up(options['batch_size'])
+            self.stdout.write(f"Rolled up {consumed} ledger rows in {time.perf_counter() - started:.2f}s.")
+
+        started = time.perf_counter()
+        drifts = LedgerReconciliationHandler.verify()
+        for drift in drifts:
+            self.stdout.write(self.style.WARNING(
+                f"Seller {drift['seller_id']}: balance {drift['actual']}, ledger {drift['expected']}, "
+                f"drift {drift['drift']}"
+            ))
+        self.stdout.write(f"Verified balances in {time.perf_counter() - started:.2f}s, {len(drifts)} drifting.")
+        if drifts and options['fail_on_drift']:
+            raise CommandError(f"{len(drifts)} seller balance(s) drift from the ledger.")
@@ -0,0 +1,107 @@
+import json
+import subprocess
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from charge_management.benchmark import INTERFACES, SCENARIOS, BenchmarkRunner, compare, dump
+
+
+def parse_mix(value):
+    # "transactions=70,balance=25,approvals=5" -> {'transactions': 70, ...}
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS or not weight.isdigit():
+            raise CommandError(f"Invalid mix entry {part!r}, expected one of {', '.join(SCENARIOS)} as name=weight.")
+        mix[name] = int(weight)
+    return mix
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Load test recharges, balance reads and credit approvals through the API against the configured "
+            "database, report latency percentiles and queries per request, and check the ledger invariants.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help="Total number of requests.")
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help="Number of worker threads (wsgi) or concurrent tasks (asgi).")
+        parser.add_argument('--interface', choices=INTERFACES, default='wsgi',
+                            help="Drive the sync views from threads or the async views from one event loop.")
+        parser.add_argument('--trace-memory', action='store_true',
+                            help="Report the peak memory allocated during the run, at some cost in speed.")
+        parser.add_argument('--sellers', type=int, default=10, help="Number of benchmark sellers.")
+        parser.add_argument('--skew', type=float, default=1.0,
+                            help="Zipf exponent of the seller distribution, 0 for uniform traffic.")
+        parser.add_argument('--mix', type=parse_mix, default='transactions=70,balance=25,approvals=5',
+                            help="Scenario weights, e.g. transactions=70,balance=25,approvals=5 "
+                                 "(reservations: two-phase recharges settled by the fake operator).")
+        parser.add_argument('--operator-latency', type=float,
+                            help="Mean answer time of the fake operator in seconds (default: FAKE_OPERATOR_LATENCY).")
+        parser.add_argument('--operator-failure-rate', type=float,
+                            help="Fraction of top-ups the fake operator rejects (default: FAKE_OPERATOR_FAILURE_RATE).")
+        parser.add_argument('--amount', type=Decimal, default=Decimal('1.00'), help="Amount of each recharge.")
+        parser.add_argument('--seed', type=int, help="Random seed, for a reproducible request plan.")
+        parser.add_argument('--host', default='localhost', help="Host header of the requests, must be allowed.")
+        parser.add_argument('--label', help="Name of the run, defaults to the current git commit.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+        parser.add_argument('--compare', help="JSON results of an earlier run to compare against.")
+
+    def handle(self, *args, **options):
+        runner = BenchmarkRunner(requests=options['requests'], concurrency=options['concurrency'],
+                                 sellers=options['sellers'], skew=options['skew'], mix=options['mix'],
+                                 amount=options['amount'], seed=options['seed'], host=options['host'],
+                                 interface=options['interface'], trace_memory=options['trace_memory'],
+                                 operator_latency=options['operator_latency'],
+                                 operator_failure_rate=options['operator_failure_rate'])
+        result = dict(label=options['label'] or current_commit(), **runner.run())
+
+        for name, stats in [*result['scenarios'].items(), ('total', result['total'])]:
+            self.stdout.write(
+                f"{name:12} n={stats['requests']} errors={stats['errors']} rps={stats['throughput_rps']:.1f} "
+                f"p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms "
+                f"queries/request={_number(stats['queries_per_request'])}"
+            )
+        settlement = result['settlement']
+        if settlement:
+            self.stdout.write(
+                f"{'settlement':12} captured={settlement['captured']} released={settlement['released']} "
+                f"unsettled={settlement['unsettled']} settled/s={settlement['settled_per_second']:.1f} "
+                f"in {settlement['elapsed_seconds']:.2f}s"
+            )
+        memory = result['peak_memory_bytes']
+        self.stdout.write(f"peak threads={result['peak_threads']}"
+                          + (f" peak memory={memory / 2 ** 20:.1f}MiB" if memory is not None else ''))
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                changes = compare(result, json.load(baseline))
+            for name, change in changes.items():
+                self.stdout.write(
+                    f"{name:12} vs baseline: throughput {_percent(change['throughput_change'])}, "
+                    f"p95 {_percent(change['p95_change'])}, queries/request "
+                    f"{_number(change['queries_per_request'][0])} -> {_number(change['queries_per_request'][1])}"
+                )
+        if options['output']:
+            dump(result, options['output'])
+            self.stdout.write(f"Results written to {options['output']}.")
+
+        for violation in result['invariants']['violations']:
+            self.stdout.write(self.style.ERROR(violation))
+        if not result['invariants']['ok']:
+            raise CommandError("Ledger invariants violated.")
+
+
+def _percent(change):
+    return 'n/a' if change is None else f"{change:+.1%}"
+
+
+def _number(value):
+    return 'n/a' if value is None else f"{value:.1f}"
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from charge_management.handlers import ShardedBalanceHandler
+from charge_management.models import Seller
+
+
+class Command(BaseCommand):
+    help = "Split a seller's credit over K sub-balance shards, or merge it back into one row with K=0."
+
+    def add_arguments(self, parser):
+        parser.add_argument('seller_id', type=int)
+        parser.add_argument('shards', type=int)
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError("The number of shards cannot be negative.")
+        try:
+            total = ShardedBalanceHandler.configure(options['seller_id'], options['shards'])
+        except Seller.DoesNotExist:
+            raise CommandError(f"Seller {options['seller_id']} does not exist.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Seller {options['seller_id']} now uses {options['shards']} shard(s), total credit {total}."
+        ))
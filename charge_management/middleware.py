@@ -0,0 +1,75 @@
+import json
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+
+from .conf import get_setting
+from .instrumentation import COUNT_BUCKETS, get_registry, profile_request
+
+slow_request_logger = logging.getLogger('charge_management.slow_requests')
+
+
+class InstrumentationMiddleware:
+    """
+    Records the duration, database queries and status of every request per view into the
+    metrics registry, together with the stages timed by the hot path, and logs a sample of
+    the requests slower than SLOW_REQUEST_THRESHOLD with their stage breakdown.
+
+    Under ASGI the ORM runs on other threads than the request, so queries are only counted
+    for sync requests.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not get_setting('METRICS_ENABLED'):
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        with profile_request() as profile, connection.execute_wrapper(profile.execute):
+            response = self.get_response(request)
+        self.record(request, response, profile, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not get_setting('METRICS_ENABLED'):
+            return await self.get_response(request)
+
+        started = time.perf_counter()
+        with profile_request() as profile:
+            response = await self.get_response(request)
+        self.record(request, response, profile, time.perf_counter() - started, count_queries=False)
+        return response
+
+    @staticmethod
+    def record(request, response, profile, elapsed, count_queries=True):
+        view = request.resolver_match.view_name if request.resolver_match else 'unmatched'
+        registry = get_registry()
+        registry.observe('charge_request_duration_seconds', elapsed, view=view, method=request.method)
+        if count_queries:
+            registry.observe('charge_request_db_seconds', profile.query_seconds, view=view, method=request.method)
+            registry.observe('charge_request_queries', profile.queries, buckets=COUNT_BUCKETS, view=view,
+                             method=request.method)
+        registry.increment('charge_requests_total', view=view, method=request.method, status=response.status_code)
+
+        threshold = get_setting('SLOW_REQUEST_THRESHOLD')
+        if threshold is not None and elapsed >= threshold and random.random() < get_setting('SLOW_REQUEST_SAMPLE_RATE'):
+            slow_request_logger.warning("Slow request %s %s: %s", request.method, request.path, json.dumps({
+                'view': view,
+                'status': response.status_code,
+                'seconds': round(elapsed, 6),
+                'queries': profile.queries if count_queries else None,
+                'db_seconds': round(profile.query_seconds, 6) if count_queries else None,
+                'retries': profile.retries,
+                'stages': {name: round(seconds, 6) for name, seconds in profile.stages.items()},
+            }))
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.17 on 2026-10-18 13:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0002_phonenumber'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seller',
+            name='credit_shards',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='SellerBalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('credit', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_shards', to='charge_management.seller')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='sellerbalanceshard',
+            constraint=models.UniqueConstraint(fields=('seller', 'index'), name='unique_seller_balance_shard'),
+        ),
+    ]
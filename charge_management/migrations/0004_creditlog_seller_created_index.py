@@ -0,0 +1,17 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0003_seller_balance_shards'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='creditlog',
+            index=models.Index(fields=['seller', 'created_at', 'id'], name='creditlog_seller_created_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0004_creditlog_seller_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('last_credit_log_id', models.BigIntegerField(default=0)),
+                ('last_transaction_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyBalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('credited', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('debited', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('log_count', models.PositiveIntegerField(default=0)),
+                ('transaction_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('transaction_count', models.PositiveIntegerField(default=0)),
+                ('closing_balance', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_snapshots', to='charge_management.seller')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailybalancesnapshot',
+            constraint=models.UniqueConstraint(fields=('seller', 'day'), name='unique_seller_daily_snapshot'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0006_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='creditlog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.CreateModel(
+            name='CreditLogOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('balance_snapshot', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('description', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='charge_management.seller')),
+            ],
+        ),
+    ]
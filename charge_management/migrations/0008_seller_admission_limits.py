@@ -0,0 +1,28 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0007_credit_log_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seller',
+            name='recharge_burst',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='recharge_max_in_flight',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='recharge_rate_limit',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0008_seller_admission_limits'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='creditrequest',
+            index=models.Index(fields=['is_approved', 'created_at'], name='creditrequest_approved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phonenumber',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['phone_number'], name='phonenumber_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['seller', 'created_at', 'id'], name='transaction_seller_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['phone_number', 'created_at'], name='transaction_phone_created_idx'),
+        ),
+    ]
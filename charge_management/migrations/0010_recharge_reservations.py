@@ -0,0 +1,37 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0009_ledger_access_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seller',
+            name='held',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='hold_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='operator_reference',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('reserved', 'Reserved'), ('dispatched', 'Dispatched'), ('captured', 'Captured'), ('released', 'Released')], default='captured', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'hold_expires_at'], name='transaction_status_hold_idx'),
+        ),
+    ]
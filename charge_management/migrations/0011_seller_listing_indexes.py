@@ -0,0 +1,25 @@
+# Generated by Django 4.2.17 on 2026-10-18 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0010_recharge_reservations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='seller',
+            index=models.Index(fields=['name'], name='seller_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='seller',
+            index=models.Index(fields=['credit', 'id'], name='seller_credit_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='seller',
+            index=models.Index(fields=['created_at', 'id'], name='seller_created_idx'),
+        ),
+    ]
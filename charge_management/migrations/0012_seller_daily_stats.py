@@ -0,0 +1,46 @@
+# Generated by Django 4.2.17 on 2026-10-18 15:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0011_seller_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SellerDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('slot', models.PositiveSmallIntegerField(default=0)),
+                ('spent', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('transaction_count', models.IntegerField(default=0)),
+                ('credited', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('credit_count', models.IntegerField(default=0)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='charge_management.seller')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SellerDailyPhoneStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('phone_number', models.CharField(max_length=15)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('transaction_count', models.IntegerField(default=0)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_phone_stats', to='charge_management.seller')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='sellerdailystats',
+            constraint=models.UniqueConstraint(fields=('seller', 'day', 'slot'), name='unique_seller_daily_stats'),
+        ),
+        migrations.AddConstraint(
+            model_name='sellerdailyphonestats',
+            constraint=models.UniqueConstraint(fields=('seller', 'day', 'phone_number'), name='unique_seller_daily_phone_stats'),
+        ),
+    ]
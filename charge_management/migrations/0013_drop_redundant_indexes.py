@@ -0,0 +1,23 @@
+# Generated by Django 4.2.17 on 2026-10-18 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0012_seller_daily_stats'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='phonenumber',
+            name='phonenumber_active_idx',
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='seller',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transactions', to='charge_management.seller'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.17 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charge_management', '0013_drop_redundant_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='seller',
+            index=models.Index(fields=['credit_shards', 'credit', 'id'], name='seller_shards_credit_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='seller',
+            name='seller_credit_idx',
+        ),
+    ]
@@ -1,9 +1,7 @@
-from time import sleep
-
-from django.db.models import F
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 
-from django.db import models, transaction, DatabaseError
+from django.db import models, transaction
 from django.contrib.auth.models import User  # To associate admin users approving credits
 
 
@@ -14,12 +12,58 @@ class Seller(models.Model):
     email = models.EmailField(unique=True)  # Unique email for the seller
     phone_number = models.CharField(max_length=15, unique=True)  # Unique phone number
     credit = models.DecimalField(max_digits=12, decimal_places=2, default=0)  # Seller's available credit
+    credit_shards = models.PositiveSmallIntegerField(default=0)  # Sub-balance rows for hot sellers, 0 = single row
+    held = models.DecimalField(max_digits=12, decimal_places=2, default=0)  # Reserved for recharges at the operator
+    # Admission control overrides, None = the RECHARGE_* defaults of the settings
+    recharge_rate_limit = models.FloatField(null=True, blank=True)  # Recharges per second
+    recharge_burst = models.PositiveIntegerField(null=True, blank=True)  # Recharges allowed at once after a pause
+    recharge_max_in_flight = models.PositiveIntegerField(null=True, blank=True)  # Concurrent recharges
     created_at = models.DateTimeField(auto_now_add=True)  # Timestamp when seller was created
     updated_at = models.DateTimeField(auto_now=True)  # Timestamp for the last update
 
+    class Meta:
+        indexes = [
+            # Seller listing: name prefix filter, credit range and sort (the credit of unsharded
+            # sellers, the few sharded ones are found by credit_shards > 0), newest first
+            models.Index(fields=['name'], name='seller_name_idx'),
+            models.Index(fields=['credit_shards', 'credit', 'id'], name='seller_shards_credit_idx'),
+            models.Index(fields=['created_at', 'id'], name='seller_created_idx'),
+        ]
+
     def __str__(self):
         return self.name  # String representation for Seller
 
+    @property
+    def total_credit(self):
+        # Sharded sellers keep most of their credit in SellerBalanceShard rows
+        self.load_balance()
+        if not self.credit_shards:
+            return self.credit
+        shard_total = self.balance_shards.aggregate(total=models.Sum('credit'))['total'] or 0
+        return self.credit + shard_total
+
+    def load_balance(self):
+        # Sellers cached by authentication defer the balance fields, read them in one query
+        deferred = self.get_deferred_fields() & {'credit', 'credit_shards'}
+        if deferred:
+            self.refresh_from_db(fields=sorted(deferred))
+
+
+# Sub-balance of a sharded seller, debits are spread over the shards instead of one hot row
+class SellerBalanceShard(models.Model):
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE,
+                               related_name='balance_shards')  # Seller owning the shard
+    index = models.PositiveSmallIntegerField()  # Shard number, 0 to credit_shards - 1
+    credit = models.DecimalField(max_digits=12, decimal_places=2, default=0)  # Credit held by this shard
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['seller', 'index'], name='unique_seller_balance_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.seller.name} shard {self.index} - {self.credit}"
+
 
 # Model to log credit requests and approvals
 class CreditRequest(models.Model):
@@ -32,56 +76,72 @@ class CreditRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)  # Timestamp when request was created
     approved_at = models.DateTimeField(null=True, blank=True)  # Timestamp when request was approved
 
+    class Meta:
+        indexes = [
+            # The pending (or approved) queue, newest first, as filtered in the admin
+            models.Index(fields=['is_approved', 'created_at'], name='creditrequest_approved_idx'),
+        ]
+
     def __str__(self):
         return f"{self.seller.name} - {self.amount}"
 
     def approve(self, user):
-        from charge_management.handlers import CreditTransactionHandler
+        from charge_management.handlers import CreditApprovalHandler
 
-        with transaction.atomic():
-            # Approve the request and update seller's credit
-            self.is_approved = True
-            self.approved_by = user
-            self.approved_at = timezone.now()
-
-            # Update seller's credit
-            result = CreditTransactionHandler.add_credit(seller_id=self.seller.id,
-                                                         amount=self.amount)
-            if result['success']:
-                self.save()
+        # Credit and approval are written in one transaction, or not at all
+        result = CreditApprovalHandler.approve_requests([self.pk], user)[0]
+        if result['status'] == CreditApprovalHandler.APPROVED:
+            self.refresh_from_db(fields=['is_approved', 'approved_by', 'approved_at'])
+        return result
 
 
 # Model to log transactions for recharge operations
 class Transaction(models.Model):
-    seller = models.ForeignKey(Seller, on_delete=models.CASCADE,
+    # Recharges sent to the operator go reserved -> dispatched -> captured or released
+    RESERVED = 'reserved'
+    DISPATCHED = 'dispatched'
+    CAPTURED = 'captured'
+    RELEASED = 'released'
+    STATUS_CHOICES = [
+        (RESERVED, 'Reserved'),
+        (DISPATCHED, 'Dispatched'),
+        (CAPTURED, 'Captured'),
+        (RELEASED, 'Released'),
+    ]
+
+    # No index of its own: transaction_seller_created_idx starts with seller and serves its lookups
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, db_index=False,
                                related_name='transactions')  # Seller performing the transaction
     phone_number = models.CharField(max_length=15)  # Phone number to recharge
     amount = models.DecimalField(max_digits=12, decimal_places=2)  # Amount of recharge
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=CAPTURED)  # Direct debits are final
+    hold_expires_at = models.DateTimeField(null=True, blank=True)  # Reserved amount released after this
+    operator_reference = models.CharField(max_length=64, blank=True)  # Operator's id of the top-up
     created_at = models.DateTimeField(auto_now_add=True)  # Timestamp of the transaction
 
+    class Meta:
+        indexes = [
+            # A seller's recharge history, newest first
+            models.Index(fields=['seller', 'created_at', 'id'], name='transaction_seller_created_idx'),
+            # Admin and support lookups of the recharges of one phone number
+            models.Index(fields=['phone_number', 'created_at'], name='transaction_phone_created_idx'),
+            # Holds to dispatch or expire
+            models.Index(fields=['status', 'hold_expires_at'], name='transaction_status_hold_idx'),
+        ]
+
     def __str__(self):
         return f"Transaction by {self.seller.name} to {self.phone_number} - {self.amount}"
 
     # Ensures credit deduction logic is handled correctly
     def save(self, *args, **kwargs):
-        max_attempts = 2
-        attempt = 0
-        while attempt < max_attempts:
-            try:
-                with transaction.atomic():
-                    seller = Seller.objects.select_for_update().get(id=self.seller.id)  # Lock the seller row
-                    if seller.credit < self.amount:
-                        raise ValueError("Insufficient credit for this transaction.")
-                    super().save(*args, **kwargs)
-                    # Deduct credit
-                    seller.credit = F('credit') - self.amount
-                    seller.save()
-                break  # Exit the loop if the transaction is successful
-            except DatabaseError as e:
-                attempt += 1
-                if attempt >= max_attempts:
-                    raise e  # Re-raise the exception if max attempts are reached
-                sleep(1)  # Wait for a second before retrying
+        from charge_management.handlers import DebitTransactionHandler
+
+        if not self._state.adding:
+            # Only a new recharge is debited; updates of an existing one never touch the balance
+            return super().save(*args, **kwargs)
+        # Conditional debit, INSERT and credit log in one short transaction, retried with backoff;
+        # a reserved recharge also moves its amount to the seller's held credit
+        DebitTransactionHandler.debit(self, lambda: super(Transaction, self).save(*args, **kwargs))
 
 
 # Model to log changes in seller's credit (credit history)
@@ -91,12 +151,30 @@ class CreditLog(models.Model):
     amount = models.DecimalField(max_digits=12, decimal_places=2)  # Change in credit (positive or negative)
     balance_snapshot = models.DecimalField(max_digits=10, decimal_places=2)  # Seller's inventory after change
     description = models.CharField(max_length=255)  # Description of the change
-    created_at = models.DateTimeField(auto_now_add=True)  # Timestamp when log was created
+    created_at = models.DateTimeField(default=timezone.now, editable=False)  # Timestamp of the credit change
+
+    class Meta:
+        indexes = [
+            # Keyset pagination and exports of a seller's logs, newest first
+            models.Index(fields=['seller', 'created_at', 'id'], name='creditlog_seller_created_idx'),
+        ]
 
     def __str__(self):
         return f"Log for {self.seller.name}: {self.amount} - {self.description}"
 
 
+# Credit log entries committed with the balance change, moved to CreditLog by the outbox drainer
+class CreditLogOutbox(models.Model):
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE)  # Seller associated with the log
+    amount = models.DecimalField(max_digits=12, decimal_places=2)  # Change in credit (positive or negative)
+    balance_snapshot = models.DecimalField(max_digits=10, decimal_places=2)  # Seller's inventory after change
+    description = models.CharField(max_length=255)  # Description of the change
+    created_at = models.DateTimeField(default=timezone.now)  # Timestamp of the credit change
+
+    def __str__(self):
+        return f"Pending log for seller {self.seller_id}: {self.amount} - {self.description}"
+
+
 class PhoneNumber(models.Model):
     phone_number = models.CharField(max_length=15, unique=True, verbose_name="Phone Number")
     is_active = models.BooleanField(default=True, verbose_name="Is Active")
@@ -110,11 +188,122 @@ class PhoneNumber(models.Model):
         verbose_name = "Valid Phone Number"
         verbose_name_plural = "Valid Phone Numbers"
         ordering = ['-added_at']
+        # Validity checks are served by the unique index on phone_number, is_active is read from its row
 
     @staticmethod
     def is_valid_phone_number(phone_number):
-        return PhoneNumber.objects.filter(phone_number=phone_number, is_active=True).exists()
+        from charge_management.instrumentation import stage
+        from charge_management.phone_cache import get_phone_cache
+        from charge_management.phone_index import might_be_registered
+
+        with stage('phone_lookup'):
+            cache = get_phone_cache()
+            is_valid = cache.get(phone_number)
+            if is_valid is None:
+                # The in-memory index rejects unknown numbers without a query
+                is_valid = (might_be_registered(phone_number)
+                            and PhoneNumber.objects.filter(phone_number=phone_number, is_active=True).exists())
+                cache.set(phone_number, is_valid)
+            return is_valid
 
     def deactivate(self):
+        from charge_management.phone_cache import get_phone_cache
+
         self.is_active = False
         self.save()
+        # Invalidate explicitly as well, a deactivated number must never be served from the cache;
+        # again once committed, a concurrent check may have cached the row as it was until then
+        get_phone_cache().invalidate(self.phone_number)
+        transaction.on_commit(lambda: get_phone_cache().invalidate(self.phone_number))
+
+
+# Per-seller, per-day rollup of the ledger, maintained incrementally by the reconciliation engine
+class DailyBalanceSnapshot(models.Model):
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE,
+                               related_name='daily_snapshots')  # Seller the rollup belongs to
+    day = models.DateField()  # Day the logs and transactions were created on (UTC)
+    credited = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Sum of positive log amounts
+    debited = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Sum of negative log amounts
+    log_count = models.PositiveIntegerField(default=0)  # Number of CreditLog rows of the day
+    transaction_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Recharged amount
+    transaction_count = models.PositiveIntegerField(default=0)  # Number of Transaction rows of the day
+    closing_balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Sum of all logs to date
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['seller', 'day'], name='unique_seller_daily_snapshot'),
+        ]
+
+    def __str__(self):
+        return f"{self.seller.name} {self.day}: {self.closing_balance}"
+
+
+# Per-seller, per-day spending counters, incremented in the transaction of each debit and credit.
+# Sharded sellers spread their increments over `slot` rows like their balance; readers sum the slots
+class SellerDailyStats(models.Model):
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE,
+                               related_name='daily_stats')  # Seller the counters belong to
+    day = models.DateField()  # Day of the recharges and credits
+    slot = models.PositiveSmallIntegerField(default=0)  # Counter row of a sharded seller, 0 otherwise
+    spent = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Recharged amount, net of releases
+    transaction_count = models.IntegerField(default=0)  # Recharges, net of releases
+    credited = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Credit added
+    credit_count = models.IntegerField(default=0)  # Credit additions
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['seller', 'day', 'slot'], name='unique_seller_daily_stats'),
+        ]
+
+    def __str__(self):
+        return f"{self.seller.name} {self.day}: {self.spent}"
+
+
+# Per-seller, per-day recharged amount of each phone number, for the top numbers of a period
+class SellerDailyPhoneStats(models.Model):
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE,
+                               related_name='daily_phone_stats')  # Seller the counters belong to
+    day = models.DateField()  # Day of the recharges
+    phone_number = models.CharField(max_length=15)  # Recharged phone number
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Recharged amount, net of releases
+    transaction_count = models.IntegerField(default=0)  # Recharges, net of releases
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['seller', 'day', 'phone_number'], name='unique_seller_daily_phone_stats'),
+        ]
+
+    def __str__(self):
+        return f"{self.seller.name} {self.day} {self.phone_number}: {self.amount}"
+
+
+# High-water marks of the ledger rows a background process has already consumed
+class LedgerCheckpoint(models.Model):
+    name = models.CharField(max_length=64, unique=True)  # Consumer of the checkpoint
+    last_credit_log_id = models.BigIntegerField(default=0)  # Highest CreditLog id consumed
+    last_transaction_id = models.BigIntegerField(default=0)  # Highest Transaction id consumed
+    updated_at = models.DateTimeField(auto_now=True)  # Timestamp of the last advance
+
+    def __str__(self):
+        return f"{self.name}: log {self.last_credit_log_id}, transaction {self.last_transaction_id}"
+
+
+# Stored outcome of a request sent with an Idempotency-Key header
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)  # Keys are scoped per user
+    key = models.CharField(max_length=255)  # Client supplied Idempotency-Key header
+    endpoint = models.CharField(max_length=255)  # Path the key was first used on
+    request_hash = models.CharField(max_length=64)  # SHA-256 of the first request body
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)  # Null while the request is in flight
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)  # Stored response data
+    locked_until = models.DateTimeField()  # An in-flight key older than this was abandoned
+    created_at = models.DateTimeField(auto_now_add=True)  # Timestamp of the first request
+    expires_at = models.DateTimeField(db_index=True)  # Purged after this timestamp
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_user_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.status_code or 'in flight'})"
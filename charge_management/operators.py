@@ -0,0 +1,181 @@
+import logging
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition
+
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .conf import get_setting
+from .handlers import RechargeReservationHandler
+from .instrumentation import record_operator_call
+
+logger = logging.getLogger(__name__)
+
+# reference: the operator's id of the top-up, detail: why it was rejected
+OperatorResult = namedtuple('OperatorResult', ['success', 'reference', 'detail'])
+
+
+class OperatorTimeout(Exception):
+    pass
+
+
+class OperatorClient:
+    """
+    Interface of the mobile operator integrations, chosen with OPERATOR_CLIENT. top_up()
+    runs on a dispatcher thread, must give up after `timeout` seconds by raising
+    OperatorTimeout, and receives a reference unique per recharge so the operator can
+    deduplicate retries.
+    """
+
+    def top_up(self, phone_number, amount, reference, timeout):
+        raise NotImplementedError
+
+
+class FakeOperatorClient(OperatorClient):
+    """
+    Local stand-in for an operator: answers after FAKE_OPERATOR_LATENCY seconds on average
+    (uniformly between half and one and a half times that) and rejects a
+    FAKE_OPERATOR_FAILURE_RATE fraction of the top-ups.
+    """
+
+    def __init__(self, latency=None, failure_rate=None, seed=None):
+        self.latency = get_setting('FAKE_OPERATOR_LATENCY') if latency is None else latency
+        self.failure_rate = get_setting('FAKE_OPERATOR_FAILURE_RATE') if failure_rate is None else failure_rate
+        self.random = random.Random(seed)
+
+    def top_up(self, phone_number, amount, reference, timeout):
+        delay = self.random.uniform(0.5, 1.5) * self.latency
+        if delay > timeout:
+            time.sleep(timeout)
+            raise OperatorTimeout(f"No answer from the operator within {timeout}s.")
+        time.sleep(delay)
+        if self.random.random() < self.failure_rate:
+            return OperatorResult(False, '', "Rejected by the operator.")
+        return OperatorResult(True, f'fake-{reference}', '')
+
+
+class OperatorDispatcher:
+    """
+    Sends reserved recharges to the operator from a pool of OPERATOR_POOL_SIZE threads,
+    so slow operator calls never hold a seller row lock nor a request thread. At most
+    OPERATOR_QUEUE_SIZE recharges wait for a worker; the others stay reserved until the
+    next sweep(). With a pool size of 0 recharges are dispatched inline by submit().
+    """
+
+    def __init__(self, client=None, pool_size=None, queue_size=None):
+        self.client = client or import_string(get_setting('OPERATOR_CLIENT'))()
+        self.pool_size = get_setting('OPERATOR_POOL_SIZE') if pool_size is None else pool_size
+        queue_size = get_setting('OPERATOR_QUEUE_SIZE') if queue_size is None else queue_size
+        self._executor = None
+        if self.pool_size:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='charge-operator')
+        self._slots = BoundedSemaphore(self.pool_size + queue_size)
+        self._pending = 0
+        self._idle = Condition()
+
+    def submit(self, transaction_id):
+        """
+        Queue a reserved recharge for dispatch, return False when the queue is full.
+        """
+        if self._executor is None:
+            self.dispatch(transaction_id)
+            return True
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._idle:
+            self._pending += 1
+        self._executor.submit(self._run, transaction_id)
+        return True
+
+    def _run(self, transaction_id):
+        # Pool threads outlive requests, so open and close their connections like a request would
+        close_old_connections()
+        try:
+            self.dispatch(transaction_id)
+        except Exception:
+            logger.exception("Dispatching recharge %s failed.", transaction_id)
+        finally:
+            close_old_connections()
+            self._slots.release()
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def dispatch(self, transaction_id):
+        """
+        Send one reserved recharge to the operator and settle it. Returns the outcome, or
+        None when another worker claimed it or its hold was released.
+        """
+        recharge = RechargeReservationHandler.mark_dispatched(transaction_id)
+        if recharge is None:
+            return None
+        started = time.perf_counter()
+        try:
+            result = self.client.top_up(recharge.phone_number, recharge.amount, f'recharge-{recharge.id}',
+                                        get_setting('OPERATOR_TIMEOUT'))
+        except OperatorTimeout:
+            outcome = 'timeout'
+            RechargeReservationHandler.release(recharge, "no answer from the operator")
+        except Exception:
+            logger.exception("Operator call for recharge %s failed.", recharge.id)
+            outcome = 'error'
+            RechargeReservationHandler.release(recharge, "operator error")
+        else:
+            if not result.success:
+                outcome = 'rejected'
+                RechargeReservationHandler.release(recharge, result.detail or "rejected by the operator")
+            elif RechargeReservationHandler.capture(recharge, result.reference):
+                outcome = 'captured'
+            else:
+                # The hold expired while the operator was answering: the top-up went through unpaid
+                outcome = 'late'
+                logger.error("Operator confirmed recharge %s (%s) after its hold was released.",
+                             recharge.id, result.reference)
+        record_operator_call(outcome, time.perf_counter() - started)
+        return outcome
+
+    def sweep(self, older_than=5):
+        """
+        Release expired holds and queue the reservations older than `older_than` seconds
+        that no worker took, e.g. after a restart. Returns (released, queued).
+        """
+        released = RechargeReservationHandler.release_expired()
+        queued = 0
+        for transaction_id in RechargeReservationHandler.reserved_ids(older_than):
+            if not self.submit(transaction_id):
+                break
+            queued += 1
+        return released, queued
+
+    def wait(self, timeout=None):
+        """
+        Wait until every queued recharge is settled, return False on timeout.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+_dispatcher = None
+
+
+def get_operator_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = OperatorDispatcher()
+    return _dispatcher
+
+
+@receiver(setting_changed)
+def reset_operator_dispatcher(setting, **kwargs):
+    global _dispatcher
+    if setting == 'CHARGE_MANAGEMENT':
+        _dispatcher = None  # Queued recharges still finish on the old pool
@@ -0,0 +1,149 @@
+import logging
+import time
+from threading import Event, Lock, Thread
+
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .conf import get_setting
+from .instrumentation import stage
+from .models import CreditLog, CreditLogOutbox, LedgerCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxBackpressure(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Credit log backlog is too large, retry shortly."
+    default_code = 'outbox_backpressure'
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait  # DRF turns this into a Retry-After header
+
+
+class CreditLogWriter:
+    """
+    Writes CreditLog entries inside the caller's transaction: straight into CreditLog, or with
+    CREDIT_LOG_OUTBOX into the outbox table for OutboxDrainer to move in batches. When the
+    outbox backlog passes OUTBOX_MAX_PENDING new debits are refused until the drainer catches
+    up; credits, approvals and released holds are always written, they only return money.
+    """
+    _pending = 0
+    _checked_at = None
+    _lock = Lock()
+
+    @classmethod
+    def write(cls, logs, debit=False):
+        with stage('credit_log'):
+            if not get_setting('CREDIT_LOG_OUTBOX'):
+                return CreditLog.objects.bulk_create(logs, batch_size=get_setting('BULK_CREATE_BATCH_SIZE'))
+            if debit:
+                cls.check_backpressure()
+            return CreditLogOutbox.objects.bulk_create([
+                CreditLogOutbox(seller_id=log.seller_id, amount=log.amount, balance_snapshot=log.balance_snapshot,
+                                description=log.description, created_at=log.created_at)
+                for log in logs
+            ], batch_size=get_setting('BULK_CREATE_BATCH_SIZE'))
+
+    @classmethod
+    def check_backpressure(cls):
+        max_pending = get_setting('OUTBOX_MAX_PENDING')
+        if not max_pending:
+            return
+        interval = get_setting('OUTBOX_PENDING_CHECK_INTERVAL')
+        # Counting the backlog on every debit would cost more than the outbox saves, so sample it
+        with cls._lock:
+            now = time.monotonic()
+            if cls._checked_at is None or now - cls._checked_at >= interval:
+                cls._pending = CreditLogOutbox.objects.count()
+                cls._checked_at = now
+            pending = cls._pending
+        if pending > max_pending:
+            raise OutboxBackpressure(wait=max(1, round(interval)))
+
+
+class OutboxDrainer:
+    """
+    Moves outbox rows into CreditLog with bulk INSERTs on a background thread. Drains are
+    serialized on a LedgerCheckpoint row, across threads and processes, so CreditLog ids
+    commit in increasing order, which the reconciliation high-water mark relies on.
+    """
+    CHECKPOINT = 'credit_log_outbox'
+
+    def __init__(self, batch_size=1000, poll_interval=0.5):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.drained = 0
+        self.batches = 0
+        self.last_batch_seconds = 0.0
+        self._stop = Event()
+        self._thread = None
+
+    def drain_batch(self):
+        """
+        Move up to batch_size of the oldest outbox rows, return how many were moved.
+        """
+        started = time.perf_counter()
+        with transaction.atomic():
+            checkpoint, _ = LedgerCheckpoint.objects.select_for_update().get_or_create(name=self.CHECKPOINT)
+            rows = list(CreditLogOutbox.objects.order_by('id')[:self.batch_size])
+            if not rows:
+                return 0
+            CreditLog.objects.bulk_create([
+                CreditLog(seller_id=row.seller_id, amount=row.amount, balance_snapshot=row.balance_snapshot,
+                          description=row.description, created_at=row.created_at)
+                for row in rows
+            ])
+            CreditLogOutbox.objects.filter(id__in=[row.id for row in rows]).delete()
+            checkpoint.save(update_fields=['updated_at'])
+        self.drained += len(rows)
+        self.batches += 1
+        self.last_batch_seconds = time.perf_counter() - started
+        return len(rows)
+
+    def drain(self):
+        # Drain until the outbox is empty, return the number of rows moved
+        moved = 0
+        while True:
+            count = self.drain_batch()
+            moved += count
+            if count < self.batch_size:
+                return moved
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    if self.drain_batch() < self.batch_size:
+                        self._stop.wait(self.poll_interval)
+                except Exception:
+                    logger.exception("Draining the credit log outbox failed.")
+                    self._stop.wait(self.poll_interval)
+        finally:
+            connection.close()
+
+    def start(self):
+        self._thread = Thread(target=self.run, name='credit-log-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @staticmethod
+    def lag():
+        outbox = CreditLogOutbox.objects.aggregate(pending=Count('id'), oldest=Min('created_at'))
+        oldest = outbox['oldest']
+        return {
+            'pending': outbox['pending'],
+            'oldest_age_seconds': (timezone.now() - oldest).total_seconds() if oldest else 0.0,
+        }
+
+    def metrics(self):
+        return dict(self.lag(), drained=self.drained, batches=self.batches,
+                    last_batch_seconds=self.last_batch_seconds)
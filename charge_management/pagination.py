@@ -0,0 +1,172 @@
+import base64
+import binascii
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(created_at, pk):
+    payload = json.dumps([created_at.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = parse_datetime(created_at)
+    except (binascii.Error, ValueError, TypeError):
+        created_at = None
+    if created_at is None or not isinstance(pk, int):
+        raise NotFound("Invalid cursor.")
+    return created_at, pk
+
+
+def after_keyset(queryset, created_at, pk):
+    # Rows after (created_at, id) in newest-first order, served by the (seller, created_at, id) index
+    return queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+
+def iterate_keyset(queryset, batch_size=2000):
+    """
+    Yield every row of a values() queryset newest first, fetching keyset-bounded batches
+    so memory stays flat whatever the size of the result and the database driver.
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    batch = list(queryset[:batch_size])
+    while batch:
+        yield from batch
+        last = batch[-1]
+        batch = list(after_keyset(queryset, last['created_at'], last['id'])[:batch_size])
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (created_at, id), newest first. Unlike offset pagination the cost
+    of a page does not grow with its depth, and rows inserted meanwhile do not shift pages.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 100
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None, archived=None):
+        """
+        `archived` optionally returns the rows kept outside the queryset (e.g. archived ledger
+        rows) newest first, given the cursor's (created_at, id) key or None. Only the rows the
+        page needs are taken from it and merged into the page in the same order.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by('-created_at', '-id')
+        cursor = request.query_params.get(self.cursor_query_param)
+        before = None
+        if cursor:
+            before = decode_cursor(cursor)
+            queryset = after_keyset(queryset, *before)
+
+        rows = list(queryset[:page_size + 1])
+        if archived is not None:
+            rows += islice(archived(before), page_size + 1)
+            rows = sorted(rows, key=lambda row: (row.created_at, row.id), reverse=True)[:page_size + 1]
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if self.has_next else None
+        return rows
+
+    def get_page_size(self, request):
+        return self.clamp_page_size(request.query_params.get(self.page_size_query_param))
+
+    @classmethod
+    def clamp_page_size(cls, value):
+        # The requested page size within [1, max_page_size], the default when missing or invalid
+        try:
+            page_size = int(value)
+        except (TypeError, ValueError):
+            return cls.page_size
+        return min(max(page_size, 1), cls.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class SellerKeysetPagination(KeysetPagination):
+    """
+    Cursor pagination of seller values() rows on (ordering field, id), with ?ordering= one
+    of ORDERINGS. The cursor records its ordering, so it cannot be replayed under another.
+    """
+    ordering_query_param = 'ordering'
+    default_ordering = '-created_at'
+    # ordering -> (field, parse cursor value), each served by a (field, id) index
+    ORDERINGS = {
+        '-created_at': ('created_at', parse_datetime),
+        'credit': ('total_credit', Decimal),
+        '-credit': ('total_credit', Decimal),
+    }
+
+    def paginate_queryset(self, querysets, request, view=None):
+        """
+        `querysets` is a list of querysets of disjoint rows, e.g. split so that each can use its
+        own index. Each one is paged on the ordering and the pages are merged.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        self.ordering = request.query_params.get(self.ordering_query_param) or self.default_ordering
+        if self.ordering not in self.ORDERINGS:
+            raise ValidationError({self.ordering_query_param: [f"Must be one of {', '.join(self.ORDERINGS)}."]})
+        field, _ = self.ORDERINGS[self.ordering]
+        descending = self.ordering.startswith('-')
+        cursor = request.query_params.get(self.cursor_query_param)
+        value, pk = self.decode(cursor) if cursor else (None, None)
+
+        rows = []
+        for queryset in querysets:
+            queryset = queryset.order_by(f'-{field}' if descending else field, '-id' if descending else 'id')
+            if cursor:
+                lookup = 'lt' if descending else 'gt'
+                # The redundant bound on the field alone lets every backend seek the index instead of walking it
+                queryset = queryset.filter(Q(**{f'{field}__{lookup}e': value}),
+                                           Q(**{f'{field}__{lookup}': value}) | Q(**{f'id__{lookup}': pk}))
+            rows += queryset[:page_size + 1]
+        if len(querysets) > 1:
+            rows = sorted(rows, key=lambda row: (row[field], row['id']), reverse=descending)[:page_size + 1]
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_cursor = self.encode(rows[-1][field], rows[-1]['id']) if self.has_next else None
+        return rows
+
+    def encode(self, value, pk):
+        value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        return base64.urlsafe_b64encode(json.dumps([self.ordering, value, pk]).encode()).decode()
+
+    def decode(self, cursor):
+        try:
+            ordering, value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            value = self.ORDERINGS[ordering][1](value) if ordering == self.ordering else None
+        except (binascii.Error, ValueError, TypeError, KeyError, InvalidOperation):
+            value = None
+        if isinstance(value, Decimal) and not value.is_finite():
+            value = None  # NaN and Infinity cannot be compared in SQL
+        if value is None or not isinstance(pk, int):
+            raise NotFound("Invalid cursor.")
+        return value, pk
@@ -0,0 +1,121 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .conf import get_setting
+from .instrumentation import record_phone_cache
+
+
+class PhoneValidityCache:
+    """
+    Caches PhoneNumber.is_valid_phone_number() results: a process-local LRU with TTL,
+    optionally backed by a shared Django cache. Invalid numbers are cached too, with
+    their own (usually shorter) TTL.
+
+    Signals only reach the process that changed the row, so in other processes an entry
+    can be stale for at most its TTL unless the shared backend is used.
+    """
+    KEY_PREFIX = 'phone-valid:'
+
+    def __init__(self, max_entries, ttl, negative_ttl, alias=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.shared = caches[alias] if alias else None
+        self._entries = OrderedDict()  # phone_number -> (is_valid, expires_at)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+
+    def get(self, phone_number):
+        """
+        Return the cached validity of phone_number, or None on a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(phone_number)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(phone_number)
+                self.hits += 1
+                record_phone_cache('hit')
+                return entry[0]
+            if entry is not None:
+                del self._entries[phone_number]
+
+        if self.shared is not None:
+            value = self.shared.get(self.KEY_PREFIX + phone_number)
+            if value is not None:
+                self._store(phone_number, bool(value))
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                record_phone_cache('shared_hit')
+                return bool(value)
+
+        with self._lock:
+            self.misses += 1
+        record_phone_cache('miss')
+        return None
+
+    def set(self, phone_number, is_valid):
+        self._store(phone_number, is_valid)
+        if self.shared is not None:
+            self.shared.set(self.KEY_PREFIX + phone_number, int(is_valid), self._ttl(is_valid))
+
+    def invalidate(self, *phone_numbers):
+        with self._lock:
+            for phone_number in phone_numbers:
+                self._entries.pop(phone_number, None)
+        if self.shared is not None:
+            self.shared.delete_many([self.KEY_PREFIX + phone_number for phone_number in phone_numbers])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'size': len(self._entries),
+            }
+
+    def _ttl(self, is_valid):
+        return self.ttl if is_valid else self.negative_ttl
+
+    def _store(self, phone_number, is_valid):
+        with self._lock:
+            self._entries[phone_number] = (is_valid, time.monotonic() + self._ttl(is_valid))
+            self._entries.move_to_end(phone_number)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_phone_cache = None
+
+
+def get_phone_cache():
+    global _phone_cache
+    if _phone_cache is None:
+        _phone_cache = PhoneValidityCache(
+            max_entries=get_setting('PHONE_CACHE_MAX_ENTRIES'),
+            ttl=get_setting('PHONE_CACHE_TTL'),
+            negative_ttl=get_setting('PHONE_CACHE_NEGATIVE_TTL'),
+            alias=get_setting('PHONE_CACHE_ALIAS'),
+        )
+    return _phone_cache
+
+
+@receiver(setting_changed)
+def reset_phone_cache(setting, **kwargs):
+    # Rebuild the cache with the new configuration (override_settings in tests)
+    global _phone_cache
+    if setting in ('CHARGE_MANAGEMENT', 'CACHES'):
+        _phone_cache = None
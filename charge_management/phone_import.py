@@ -0,0 +1,185 @@
+import csv
+import time
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+
+from .conf import get_setting
+from .models import PhoneNumber
+from .phone_cache import get_phone_cache
+from .phone_index import add_to_phone_index
+
+SEPARATORS = str.maketrans('', '', ' -.()\t')
+
+
+def normalize_phone_number(value):
+    """
+    Return the national form of a phone number (e.g. '+98 912 123-4567' -> '09121234567'),
+    or None when it is not a plausible number.
+    """
+    number = value.strip().translate(SEPARATORS)
+    if number.startswith('+'):
+        number = '00' + number[1:]
+    if number.startswith('0098'):
+        number = '0' + number[4:]
+    elif number.startswith('98') and len(number) == 12:
+        number = '0' + number[2:]
+    if not number.isdigit() or not 7 <= len(number) <= PhoneNumber._meta.get_field('phone_number').max_length:
+        return None
+    return number
+
+
+def read_csv(lines, column=None):
+    """
+    Yield (phone_number, description) from CSV lines, one row at a time. With a header row
+    naming a phone_number column, that column and an optional description column are
+    read; otherwise the first column (or `column`, by position) holds the numbers.
+    """
+    reader = csv.reader(lines)
+    first = next(reader, None)
+    if first is None:
+        return
+    header = [name.strip().lower() for name in first]
+    if 'phone_number' in header:
+        number_at = header.index('phone_number')
+        description_at = header.index('description') if 'description' in header else None
+    else:
+        number_at, description_at = column or 0, None
+        reader = _chain_row(first, reader)
+    for row in reader:
+        if len(row) > number_at:
+            description = row[description_at] if description_at is not None and len(row) > description_at else None
+            yield row[number_at], description or None
+
+
+def _chain_row(first, reader):
+    yield first
+    yield from reader
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+class PhoneNumberImporter:
+    """
+    Maintains the PhoneNumber registry from streams of numbers in constant memory: rows
+    are normalized and handled in chunks of PHONE_IMPORT_CHUNK_SIZE, each with a few
+    set-based queries in its own transaction. Numbers repeated within a chunk are
+    counted as duplicates; repeats across chunks find their row and count as unchanged.
+
+    Bulk queries send no signals, so the validity cache and the phone index are updated
+    here once each chunk commits.
+    """
+
+    def __init__(self, chunk_size=None, progress=None):
+        self.chunk_size = chunk_size or get_setting('PHONE_IMPORT_CHUNK_SIZE')
+        self.progress = progress  # Called with the running stats after every chunk
+        self.stats = {'read': 0, 'invalid': 0, 'duplicates': 0, 'created': 0, 'updated': 0, 'unchanged': 0,
+                      'seconds': 0.0, 'rows_per_second': 0.0}
+        self._started = None
+
+    def import_rows(self, rows):
+        """
+        Register (phone_number, description) rows: create new numbers and reactivate (and
+        re-describe, when a description is given) existing ones. Returns the stats.
+        """
+        return self._run(rows, self._import_chunk)
+
+    def set_active(self, phone_numbers, active, normalize=True):
+        """
+        Deactivate (or reactivate) every registered number of an iterable. Returns the stats;
+        numbers that are not registered count as unchanged. Pass normalize=False for
+        numbers read from the registry itself.
+        """
+        return self._run(((phone_number, None) for phone_number in phone_numbers),
+                         lambda chunk: self._set_active_chunk(chunk, active), normalize)
+
+    def _run(self, rows, handle_chunk, normalize=True):
+        self._started = time.perf_counter()
+        for chunk in _chunks(rows, self.chunk_size):
+            numbers = {}
+            for value, description in chunk:
+                self.stats['read'] += 1
+                number = normalize_phone_number(value) if normalize else value
+                if number is None:
+                    self.stats['invalid'] += 1
+                elif number in numbers:
+                    self.stats['duplicates'] += 1
+                else:
+                    numbers[number] = description
+            if numbers:
+                with transaction.atomic():
+                    handle_chunk(numbers)
+            self._tick()
+        return self.stats
+
+    def _import_chunk(self, numbers):
+        existing = {row.phone_number: row for row in PhoneNumber.objects.filter(
+            phone_number__in=list(numbers)).only('id', 'phone_number', 'is_active', 'description')}
+        new = [PhoneNumber(phone_number=number, description=description)
+               for number, description in numbers.items() if number not in existing]
+        new = self._insert(new)
+
+        changed = []
+        for number, row in existing.items():
+            description = numbers[number]
+            if not row.is_active or (description is not None and description != row.description):
+                row.is_active = True
+                row.description = description if description is not None else row.description
+                changed.append(row)
+        PhoneNumber.objects.bulk_update(changed, ['is_active', 'description'], batch_size=1000)
+
+        self.stats['created'] += len(new)
+        self.stats['updated'] += len(changed)
+        self.stats['unchanged'] += len(numbers) - len(new) - len(changed)
+        added = [row.phone_number for row in new]
+        touched = added + [row.phone_number for row in changed]
+        transaction.on_commit(lambda: self._publish(touched, added))
+
+    @staticmethod
+    def _insert(rows):
+        """
+        Insert new numbers and return those this import inserted. A concurrent import may
+        have inserted some of them meanwhile: those are skipped, not an error, and since
+        ignore_conflicts cannot tell which rows were skipped, the chunk is then inserted
+        row by row.
+        """
+        try:
+            with transaction.atomic():
+                PhoneNumber.objects.bulk_create(rows, batch_size=1000)
+            return rows
+        except IntegrityError:
+            pass
+        inserted = []
+        for row in rows:
+            row.pk = None
+            try:
+                with transaction.atomic():
+                    PhoneNumber.objects.bulk_create([row])
+                inserted.append(row)
+            except IntegrityError:
+                pass
+        return inserted
+
+    def _set_active_chunk(self, numbers, active):
+        updated = PhoneNumber.objects.filter(phone_number__in=list(numbers), is_active=not active).update(
+            is_active=active)
+        self.stats['updated'] += updated
+        self.stats['unchanged'] += len(numbers) - updated
+        transaction.on_commit(lambda: self._publish(list(numbers), []))
+
+    @staticmethod
+    def _publish(touched, added):
+        # Cached answers (including "not registered") for these numbers are now wrong
+        get_phone_cache().invalidate(*touched)
+        for phone_number in added:
+            add_to_phone_index(phone_number)
+
+    def _tick(self):
+        self.stats['seconds'] = time.perf_counter() - self._started
+        self.stats['rows_per_second'] = self.stats['read'] / self.stats['seconds'] if self.stats['seconds'] else 0.0
+        if self.progress is not None:
+            self.progress(self.stats)
@@ -0,0 +1,227 @@
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from hashlib import blake2b
+from threading import Lock, Thread
+
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class PhoneNumberBloomFilter:
+    """
+    Bloom filter over phone numbers: `phone_number in bloom` is False only for numbers
+    that were never added, so it can reject unknown numbers without a DB round trip.
+    Snapshots are a small header followed by the bit array, loaded with mmap.
+    """
+    MAGIC = b'PHBLOOM1'
+    HEADER = struct.Struct('<8sQQQ')  # magic, number of bits, number of hashes, high-water PhoneNumber id
+
+    def __init__(self, num_bits, num_hashes, bits=None, offset=0, high_water_id=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.high_water_id = high_water_id
+        self._bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self._offset = offset
+        self._lock = Lock()
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        capacity = max(capacity, 1)
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, phone_number):
+        # Double hashing: position i is h1 + i * h2, both taken from one 128-bit digest
+        digest = blake2b(phone_number.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, phone_number):
+        with self._lock:
+            for position in self._positions(phone_number):
+                index = self._offset + (position >> 3)
+                self._bits[index] = self._bits[index] | (1 << (position & 7))
+
+    def __contains__(self, phone_number):
+        bits, offset = self._bits, self._offset
+        return all(bits[offset + (position >> 3)] & (1 << (position & 7))
+                   for position in self._positions(phone_number))
+
+    @property
+    def size_in_bytes(self):
+        return (self.num_bits + 7) // 8
+
+    def save(self, path):
+        # Write next to the target and rename, so running workers never map a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as snapshot:
+            snapshot.write(self.HEADER.pack(self.MAGIC, self.num_bits, self.num_hashes, self.high_water_id))
+            snapshot.write(self._bits[self._offset:self._offset + self.size_in_bytes])
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as snapshot:
+            # Copy-on-write mapping: pages are shared between workers until one of them adds a number
+            bits = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, num_bits, num_hashes, high_water_id = cls.HEADER.unpack_from(bits)
+        if magic != cls.MAGIC or len(bits) < cls.HEADER.size + (num_bits + 7) // 8:
+            raise ValueError(f"{path} is not a phone number index snapshot.")
+        return cls(num_bits, num_hashes, bits=bits, offset=cls.HEADER.size, high_water_id=high_water_id)
+
+
+class PhoneNumberIndex:
+    """
+    In-memory prefilter of registered phone numbers (active or not, is_active is left to the
+    database). Local changes are added through signals; rows added by other processes are
+    picked up by id high-water mark before a number is rejected, at most once per interval.
+    """
+
+    def __init__(self, bloom, refresh_interval, refresh_overlap):
+        self.bloom = bloom
+        self.refresh_interval = refresh_interval
+        self.refresh_overlap = refresh_overlap
+        self._refreshed_at = 0
+        self._lock = Lock()
+
+    @classmethod
+    def build(cls, capacity=None, error_rate=None, chunk_size=10000):
+        """
+        Build the bloom filter by streaming every PhoneNumber with iterator().
+        """
+        from .models import PhoneNumber
+
+        if capacity is None:
+            # Headroom for numbers added until the next rebuild
+            capacity = int(PhoneNumber.objects.count() * 1.5) + 10000
+        bloom = PhoneNumberBloomFilter.for_capacity(capacity, error_rate or get_setting('PHONE_INDEX_ERROR_RATE'))
+        rows = PhoneNumber.objects.order_by().values_list('id', 'phone_number').iterator(chunk_size=chunk_size)
+        for pk, phone_number in rows:
+            bloom.add(phone_number)
+            bloom.high_water_id = max(bloom.high_water_id, pk)
+        return bloom
+
+    def might_contain(self, phone_number):
+        if phone_number in self.bloom:
+            return True
+        # Only a rejection can be wrong, so catch up with other processes before giving one
+        if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+            return phone_number in self.bloom
+        return False
+
+    def add(self, phone_number):
+        self.bloom.add(phone_number)
+
+    def refresh(self):
+        from .models import PhoneNumber
+
+        with self._lock:
+            # Re-read a few ids below the mark, rows can commit out of id order
+            since = max(self.bloom.high_water_id - self.refresh_overlap, 0)
+            rows = PhoneNumber.objects.filter(id__gt=since).order_by().values_list('id', 'phone_number')
+            for pk, phone_number in rows.iterator():
+                self.bloom.add(phone_number)
+                self.bloom.high_water_id = max(self.bloom.high_water_id, pk)
+            self._refreshed_at = time.monotonic()
+
+
+_phone_index = None
+_phone_index_build = None  # Background build thread, while one runs
+_phone_index_generation = 0  # Bumped when the settings change, so a stale build is dropped
+_phone_index_lock = Lock()
+
+
+def _load_phone_index():
+    path = get_setting('PHONE_INDEX_PATH')
+    bloom = PhoneNumberBloomFilter.load(path) if path and os.path.exists(path) else PhoneNumberIndex.build()
+    index = PhoneNumberIndex(bloom, get_setting('PHONE_INDEX_REFRESH_INTERVAL'),
+                             get_setting('PHONE_INDEX_REFRESH_OVERLAP'))
+    index.refresh()
+    return index
+
+
+def warm_phone_index():
+    """
+    Load the snapshot, or build the index from the database, right away and return it (None
+    when the index is disabled). Call it from a worker's startup hook to have the index from
+    the first request on.
+    """
+    global _phone_index
+    if not get_setting('PHONE_INDEX_ENABLED'):
+        return None
+    if _phone_index is None:
+        generation = _phone_index_generation
+        index = _load_phone_index()  # Outside the lock, requests keep going to the database meanwhile
+        with _phone_index_lock:
+            if _phone_index is None and generation == _phone_index_generation:
+                _phone_index = index
+    return _phone_index
+
+
+def _build_phone_index():
+    global _phone_index_build
+    try:
+        warm_phone_index()
+    except Exception:
+        logger.exception("Building the phone number index failed.")
+    finally:
+        connection.close()
+        with _phone_index_lock:
+            _phone_index_build = None
+
+
+def get_phone_index():
+    """
+    Return the process-wide index, or None when it is disabled or not ready yet. A snapshot
+    is mapped on first use; without one the first call starts building the index from the
+    database in a background thread, and numbers are checked against the database until it
+    is done.
+    """
+    global _phone_index_build
+    if not get_setting('PHONE_INDEX_ENABLED'):
+        return None
+    if _phone_index is not None:
+        return _phone_index
+    path = get_setting('PHONE_INDEX_PATH')
+    if path and os.path.exists(path):
+        return warm_phone_index()  # Mapping a snapshot is cheap
+    with _phone_index_lock:
+        if _phone_index is None and _phone_index_build is None:
+            _phone_index_build = Thread(target=_build_phone_index, name='phone-index-build', daemon=True)
+            _phone_index_build.start()
+    return _phone_index
+
+
+def add_to_phone_index(phone_number):
+    # Keep an already loaded index current, never build one from a signal handler
+    if _phone_index is not None:
+        _phone_index.add(phone_number)
+
+
+def might_be_registered(phone_number):
+    # Without an index every number has to be checked against the database
+    index = get_phone_index()
+    return index is None or index.might_contain(phone_number)
+
+
+@receiver(setting_changed)
+def reset_phone_index(setting, **kwargs):
+    global _phone_index, _phone_index_generation
+    if setting == 'CHARGE_MANAGEMENT':
+        with _phone_index_lock:
+            _phone_index = None
+            _phone_index_generation += 1
@@ -0,0 +1,99 @@
+import re
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import connections
+
+from .models import CreditLog, CreditRequest, PhoneNumber, Transaction
+
+# Tables that grow without bound, where a full scan is a production incident
+LARGE_TABLES = [model._meta.db_table for model in (Transaction, CreditLog, CreditRequest, PhoneNumber)]
+
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def partial_indexes():
+    return {index.name for model in apps.get_app_config('charge_management').get_models()
+            for index in model._meta.indexes if index.condition is not None}
+
+
+class QueryPlanRecorder:
+    """
+    Records every SELECT, UPDATE and DELETE a block of code runs, then asks the database
+    how it would execute each one (EXPLAIN) and reports the full table scans of the large
+    tables. Understands the plans of SQLite, PostgreSQL and MySQL/MariaDB.
+    """
+
+    def __init__(self, using='default', tables=None):
+        self.connection = connections[using]
+        self.tables = set(LARGE_TABLES if tables is None else tables)
+        self.statements = []  # (sql, params)
+        self.plans = []  # (sql, plan lines)
+
+    @contextmanager
+    def record(self):
+        with self.connection.execute_wrapper(self._record):
+            yield self
+        # Explained afterwards, outside the wrapper, so EXPLAIN itself is not recorded
+        self.plans = [(sql, self.explain(sql, params)) for sql, params in self.statements]
+
+    def _record(self, execute, sql, params, many, context):
+        if not many and sql.lstrip().upper().startswith(EXPLAINABLE):
+            self.statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+    def explain(self, sql, params):
+        vendor = self.connection.vendor
+        prefix = 'EXPLAIN QUERY PLAN ' if vendor == 'sqlite' else 'EXPLAIN '
+        with self.connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        if vendor == 'sqlite':
+            return [row[-1] for row in rows]  # detail column, e.g. "SEARCH t USING INDEX i (a=?)"
+        if vendor == 'postgresql':
+            return [row[0] for row in rows]
+        # MySQL: one row per table, rendered as "table type key"
+        return ['{table} {type} {key}'.format(**dict(zip(columns, row))) for row in rows]
+
+    def full_scans(self):
+        """
+        Return (table, sql, plan) for every recorded statement scanning a whole large table.
+        """
+        scans = []
+        for sql, plan in self.plans:
+            for line in plan:
+                table = self._scanned_table(line)
+                if table in self.tables:
+                    scans.append((table, sql, plan))
+        return scans
+
+    def _scanned_table(self, line):
+        vendor = self.connection.vendor
+        if vendor == 'sqlite':
+            # SEARCH means an index range; walking a partial index only reads the rows it covers
+            match = re.match(r'\s*SCAN (?:TABLE )?"?(\w+)"?', line)
+            partial = re.search(r'USING (?:COVERING )?INDEX (\w+)', line)
+            if partial and partial.group(1) in partial_indexes():
+                return None
+        elif vendor == 'postgresql':
+            match = re.search(r'Seq Scan on "?(\w+)"?', line)
+        else:
+            match = re.match(r'(\w+) (?:ALL|index) ', line)  # Every row, or every index entry
+        return match.group(1) if match else None
+
+
+class QueryPlanAssertionsMixin:
+    """
+    TestCase mixin: `with self.assertNoFullScans(): ...` fails the test if a statement run
+    in the block scans a whole large table.
+    """
+
+    @contextmanager
+    def assertNoFullScans(self, tables=None, using='default'):
+        recorder = QueryPlanRecorder(using, tables)
+        with recorder.record():
+            yield recorder
+        scans = recorder.full_scans()
+        if scans:
+            self.fail('\n\n'.join(f"Full scan of {table}:\n{sql}\n" + '\n'.join(plan) for table, sql, plan in scans))
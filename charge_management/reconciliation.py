@@ -0,0 +1,131 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .conf import get_setting
+from .models import (
+    Seller, SellerBalanceShard, CreditLog, CreditLogOutbox, Transaction, DailyBalanceSnapshot, LedgerCheckpoint
+)
+
+ZERO = Value(0, output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+class LedgerReconciliationHandler:
+    """
+    Rolls CreditLog and Transaction rows up into DailyBalanceSnapshot rows past a stored
+    high-water mark, and verifies every seller's balance against its latest snapshot plus
+    the logs written since (or still in the outbox), in time proportional to the new rows.
+    """
+    CHECKPOINT = 'daily_snapshots'
+
+    @classmethod
+    def roll_up(cls, batch_size=10000):
+        """
+        Consume new ledger rows batch by batch until caught up, return the number of rows.
+        """
+        consumed = 0
+        while True:
+            with transaction.atomic():
+                checkpoint, _ = LedgerCheckpoint.objects.select_for_update().get_or_create(name=cls.CHECKPOINT)
+                logs = cls._next_batch(CreditLog, checkpoint.last_credit_log_id, batch_size)
+                recharges = cls._next_batch(Transaction, checkpoint.last_transaction_id, batch_size)
+                if not logs and not recharges:
+                    return consumed
+                if logs:
+                    cls._apply_logs(checkpoint.last_credit_log_id, logs[-1])
+                    checkpoint.last_credit_log_id = logs[-1]
+                if recharges:
+                    cls._apply_transactions(checkpoint.last_transaction_id, recharges[-1])
+                    checkpoint.last_transaction_id = recharges[-1]
+                checkpoint.save()
+                consumed += len(logs) + len(recharges)
+
+    @staticmethod
+    def _next_batch(model, last_id, batch_size):
+        # Leave recent rows alone: a lower id may still be uncommitted and would be skipped forever
+        settled_before = timezone.now() - timedelta(seconds=get_setting('RECONCILIATION_SETTLE_SECONDS'))
+        ids = []
+        rows = model.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'created_at')[:batch_size]
+        for pk, created_at in rows:
+            if created_at > settled_before:
+                break
+            ids.append(pk)
+        return ids
+
+    @classmethod
+    def _apply_logs(cls, after_id, up_to_id):
+        groups = CreditLog.objects.filter(id__gt=after_id, id__lte=up_to_id).annotate(
+            day=TruncDate('created_at')
+        ).values('seller_id', 'day').annotate(
+            credited=Coalesce(Sum('amount', filter=Q(amount__gt=0)), ZERO),
+            debited=Coalesce(Sum(-F('amount'), filter=Q(amount__lt=0)), ZERO),
+            count=Count('id'),
+            total=Sum('amount'),
+        ).order_by()
+        for group in groups:
+            cls._snapshot(group['seller_id'], group['day'])
+            DailyBalanceSnapshot.objects.filter(seller_id=group['seller_id'], day=group['day']).update(
+                credited=F('credited') + group['credited'],
+                debited=F('debited') + group['debited'],
+                log_count=F('log_count') + group['count'],
+            )
+            # Every later closing balance includes this day's movement
+            DailyBalanceSnapshot.objects.filter(seller_id=group['seller_id'], day__gte=group['day']).update(
+                closing_balance=F('closing_balance') + group['total']
+            )
+
+    @classmethod
+    def _apply_transactions(cls, after_id, up_to_id):
+        groups = Transaction.objects.filter(id__gt=after_id, id__lte=up_to_id).annotate(
+            day=TruncDate('created_at')
+        ).values('seller_id', 'day').annotate(count=Count('id'), total=Sum('amount')).order_by()
+        for group in groups:
+            cls._snapshot(group['seller_id'], group['day'])
+            DailyBalanceSnapshot.objects.filter(seller_id=group['seller_id'], day=group['day']).update(
+                transaction_amount=F('transaction_amount') + group['total'],
+                transaction_count=F('transaction_count') + group['count'],
+            )
+
+    @staticmethod
+    def _snapshot(seller_id, day):
+        # A new day opens with the closing balance of the seller's previous day
+        if DailyBalanceSnapshot.objects.filter(seller_id=seller_id, day=day).exists():
+            return
+        previous = DailyBalanceSnapshot.objects.filter(seller_id=seller_id, day__lt=day).order_by('-day').values_list(
+            'closing_balance', flat=True).first()
+        DailyBalanceSnapshot.objects.create(seller_id=seller_id, day=day, closing_balance=previous or 0)
+
+    @classmethod
+    def verify(cls):
+        """
+        Return a list of {'seller_id', 'expected', 'actual', 'drift'} for every seller whose
+        balance differs from its ledger. Runs in one transaction so that, under REPEATABLE
+        READ (the MySQL default), balances and logs are read from the same snapshot.
+        """
+        with transaction.atomic():
+            checkpoint = LedgerCheckpoint.objects.filter(name=cls.CHECKPOINT).first()
+            last_log_id = checkpoint.last_credit_log_id if checkpoint else 0
+            deltas = dict(CreditLog.objects.filter(id__gt=last_log_id).values('seller_id').annotate(
+                total=Sum('amount')).order_by().values_list('seller_id', 'total'))
+            # Entries still waiting in the outbox were committed together with their balance change
+            for seller_id, total in CreditLogOutbox.objects.values('seller_id').annotate(
+                    total=Sum('amount')).order_by().values_list('seller_id', 'total'):
+                deltas[seller_id] = deltas.get(seller_id, 0) + total
+            sellers = Seller.objects.annotate(
+                snapshot_balance=Subquery(DailyBalanceSnapshot.objects.filter(
+                    seller=OuterRef('pk')).order_by('-day').values('closing_balance')[:1]),
+                shard_credit=Subquery(SellerBalanceShard.objects.filter(
+                    seller=OuterRef('pk')).values('seller').annotate(total=Sum('credit')).values('total')),
+            ).values_list('id', 'credit', 'snapshot_balance', 'shard_credit')
+
+            drifts = []
+            for seller_id, credit, snapshot_balance, shard_credit in sellers.iterator():
+                expected = (snapshot_balance or 0) + deltas.get(seller_id, 0)
+                actual = credit + (shard_credit or 0)
+                if expected != actual:
+                    drifts.append({'seller_id': seller_id, 'expected': expected, 'actual': actual,
+                                   'drift': actual - expected})
+            return drifts
@@ -0,0 +1,190 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.dispatch import receiver
+
+from .conf import get_setting
+
+# The read scope of the current request or task: reads in it may go to a replica
+_read_scope = ContextVar('charge_management_read_scope', default=None)
+
+
+class ReadScope:
+    def __init__(self, seller_id):
+        self.seller_id = seller_id  # Seller whose own writes the reads must see, None for none
+        self.alias = None  # Chosen on the first read, so one request reads from one replica
+
+
+class ReplicaMonitor:
+    """
+    Measures the replication lag of each replica alias, at most once every
+    REPLICA_CHECK_INTERVAL seconds per process. The lag query doubles as the health
+    check: a replica whose query fails, or that does not replicate, is left out until
+    the next check.
+    """
+
+    def __init__(self):
+        self._checks = {}  # alias -> (lag in seconds or None when unhealthy, checked_at)
+        self._lock = Lock()
+
+    def lag(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._checks.get(alias)
+        if entry is not None and now - entry[1] < get_setting('REPLICA_CHECK_INTERVAL'):
+            return entry[0]
+        try:
+            lag = self.measure(alias)
+        except DatabaseError:
+            lag = None
+            connections[alias].close()  # Reconnect on the next check
+        with self._lock:
+            self._checks[alias] = (lag, now)
+        return lag
+
+    def measure(self, alias):
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                try:
+                    cursor.execute('SHOW REPLICA STATUS')
+                except DatabaseError:
+                    cursor.execute('SHOW SLAVE STATUS')  # MySQL before 8.0.22, MariaDB
+                columns = [column[0] for column in cursor.description]
+                row = cursor.fetchone()
+                if row is None:
+                    return 0  # Not a replica, e.g. the primary itself in development
+                status = dict(zip(columns, row))
+                return status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT CASE WHEN pg_is_in_recovery() '
+                    'THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) ELSE 0 END')
+                return cursor.fetchone()[0]
+            cursor.execute('SELECT 1')  # No replication to measure (SQLite): only check the connection
+            return 0
+
+    def healthy_replicas(self):
+        max_lag = get_setting('REPLICA_MAX_LAG')
+        healthy = []
+        for alias in get_setting('READ_REPLICAS'):
+            lag = self.lag(alias)
+            if lag is not None and lag <= max_lag:
+                healthy.append(alias)
+        return healthy
+
+    def forget(self):
+        with self._lock:
+            self._checks.clear()
+
+
+monitor = ReplicaMonitor()
+
+
+@receiver(setting_changed)
+def reset_replica_monitor(setting, **kwargs):
+    if setting in ('CHARGE_MANAGEMENT', 'DATABASES'):
+        monitor.forget()
+
+
+def _pin_cache():
+    return caches[get_setting('REPLICA_PIN_CACHE_ALIAS')]
+
+
+def pin_to_primary(seller_id):
+    """
+    Send the reads of a seller's own data to the primary for a while once the current
+    transaction commits: long enough for any replica still in use to have replayed it.
+    """
+    if get_setting('READ_REPLICAS'):
+        window = get_setting('REPLICA_MAX_LAG') + get_setting('REPLICA_CHECK_INTERVAL')
+        transaction.on_commit(lambda: _pin_cache().set(f'replica-pin:{seller_id}', True, window))
+
+
+def is_pinned(seller_id):
+    return seller_id is not None and bool(_pin_cache().get(f'replica-pin:{seller_id}'))
+
+
+@contextmanager
+def read_from_replica(seller_id=None):
+    """
+    Let the reads of the block go to a healthy replica, unless seller_id recently wrote.
+    """
+    token = _read_scope.set(ReadScope(seller_id))
+    try:
+        yield
+    finally:
+        _read_scope.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Sends reads made inside read_from_replica() to one of the READ_REPLICAS lagging at most
+    REPLICA_MAX_LAG seconds; everything else, writes and reads inside a transaction
+    included, goes to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        scope = _read_scope.get()
+        if scope is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        if scope.alias is None:
+            replicas = [] if is_pinned(scope.seller_id) else monitor.healthy_replicas()
+            scope.alias = random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+        return scope.alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Replicas hold the same rows as the primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_setting('READ_REPLICAS'):
+            return False  # Replicas get the schema through replication
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    DRF view mixin: GET and HEAD requests read from a replica, except for the seller
+    returned by get_pinned_seller_id() right after that seller's own writes.
+    """
+
+    def get_pinned_seller_id(self):
+        return None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in ('GET', 'HEAD') and get_setting('READ_REPLICAS'):
+            self._read_scope = _read_scope.set(ReadScope(self.get_pinned_seller_id()))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # Streamed exports are produced after this, on the primary
+        token = getattr(self, '_read_scope', None)
+        if token is not None:
+            self._read_scope = None
+            _read_scope.reset(token)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class ReplicaReadAdminMixin:
+    """
+    ModelAdmin mixin rendering changelist pages from a replica; actions posted from the
+    changelist still run on the primary.
+    """
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET' or not get_setting('READ_REPLICAS'):
+            return super().changelist_view(request, extra_context)
+        with read_from_replica():
+            response = super().changelist_view(request, extra_context)
+            if hasattr(response, 'render'):
+                response.render()  # The page's queries run while rendering
+        return response
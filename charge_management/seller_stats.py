@@ -0,0 +1,213 @@
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .archive import LedgerArchiveHandler
+from .conf import get_setting
+from .instrumentation import stage
+from .models import CreditRequest, LedgerCheckpoint, Seller, SellerDailyPhoneStats, SellerDailyStats, Transaction
+
+
+def _increment(model, keys, rows):
+    """
+    Add the counter deltas of `rows` (dicts of the `keys` fields and some counters) to the
+    rows of `model` they identify, inserting those that do not exist yet. One INSERT ...
+    ON CONFLICT (ON DUPLICATE KEY on MySQL) UPDATE per batch, so a concurrent first write of
+    the same row turns into an increment instead of an error.
+    """
+    if not rows:
+        return
+    connection = connections[router.db_for_write(model)]
+    key_fields = [model._meta.get_field(name) for name in keys]
+    counters = [field for field in model._meta.concrete_fields if not field.primary_key and field not in key_fields]
+    updated = [field for field in counters if field.attname in rows[0]]
+    if connection.vendor != 'mysql' and not connection.features.supports_update_conflicts_with_target:
+        for row in rows:
+            _increment_row(model, {name: row[name] for name in keys},
+                           {field.attname: row[field.attname] for field in updated})
+        return
+
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    fields = key_fields + counters
+    if connection.vendor == 'mysql':
+        conflict = 'ON DUPLICATE KEY UPDATE ' + ', '.join(
+            f'{qn(field.column)} = {qn(field.column)} + VALUES({qn(field.column)})' for field in updated)
+    else:
+        conflict = 'ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            ', '.join(qn(field.column) for field in key_fields),
+            ', '.join(f'{qn(field.column)} = {table}.{qn(field.column)} + EXCLUDED.{qn(field.column)}'
+                      for field in updated))
+    placeholders = '({})'.format(', '.join(['%s'] * len(fields)))
+    step = get_setting('BULK_CREATE_BATCH_SIZE')
+    if connection.features.max_query_params:
+        step = max(1, min(step, connection.features.max_query_params // len(fields)))
+    # Rows are locked in key order, so concurrent bulk writes cannot deadlock on each other
+    rows = sorted(rows, key=lambda row: tuple(row[name] for name in keys))
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), step):
+            batch = rows[start:start + step]
+            params = [field.get_db_prep_save(row.get(field.attname, 0), connection) for row in batch for field in fields]
+            cursor.execute('INSERT INTO {} ({}) VALUES {} {}'.format(
+                table, ', '.join(qn(field.column) for field in fields), ', '.join([placeholders] * len(batch)),
+                conflict), params)
+
+
+def _increment_row(model, keys, deltas):
+    # Backends without upserts: a savepoint lets a concurrent first write win, then increment its row
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**keys).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **deltas)
+    except IntegrityError:
+        model.objects.filter(**keys).update(**updates)
+
+
+class SellerStatsRecorder:
+    """
+    Keeps SellerDailyStats and SellerDailyPhoneStats up to date from inside the caller's
+    transaction, so the counters commit or roll back with the balance change they count.
+    Days are those of the current time zone, like the ledger rollups.
+    """
+
+    @staticmethod
+    def _slot(shards):
+        # Concurrent debits of a sharded seller do not queue on one counter row
+        return random.randrange(shards) if shards else 0
+
+    @classmethod
+    def record_debits(cls, seller_id, day, recharges, shards=0):
+        """
+        Count (phone_number, amount) recharges of a seller made on `day`. Negative amounts
+        take released recharges back out.
+        """
+        with stage('seller_stats'):
+            per_number = defaultdict(lambda: [0, 0])
+            for phone_number, amount in recharges:
+                per_number[phone_number][0] += amount
+                per_number[phone_number][1] += 1 if amount >= 0 else -1
+            _increment(SellerDailyStats, ['seller_id', 'day', 'slot'], [{
+                'seller_id': seller_id, 'day': day, 'slot': cls._slot(shards),
+                'spent': sum(amount for amount, _ in per_number.values()),
+                'transaction_count': sum(count for _, count in per_number.values()),
+            }])
+            _increment(SellerDailyPhoneStats, ['seller_id', 'day', 'phone_number'], [
+                {'seller_id': seller_id, 'day': day, 'phone_number': phone_number, 'amount': amount,
+                 'transaction_count': count}
+                for phone_number, (amount, count) in per_number.items()
+            ])
+
+    @staticmethod
+    def record_credit(seller_id, amount, count=1):
+        with stage('seller_stats'):
+            _increment(SellerDailyStats, ['seller_id', 'day', 'slot'], [{
+                'seller_id': seller_id, 'day': timezone.localdate(), 'slot': 0, 'credited': amount,
+                'credit_count': count,
+            }])
+
+    @classmethod
+    def rebuild(cls, seller_ids):
+        """
+        Recompute the counters of some sellers from their recharges, archived ones included,
+        and their approved credit requests, e.g. for the history made before the counters
+        existed. The archive is read once per call, so pass sellers in batches. Debits of a
+        sharded seller that run meanwhile may be counted twice or not at all, rebuild those
+        in a quiet period. Returns the number of days rebuilt per seller.
+        """
+        seller_ids = sorted(set(seller_ids))
+        with transaction.atomic():
+            # Holding the archive checkpoint keeps archive_ledger from moving rows meanwhile
+            LedgerCheckpoint.objects.select_for_update().get_or_create(name=LedgerArchiveHandler.CHECKPOINT)
+            list(Seller.objects.select_for_update().filter(id__in=seller_ids).order_by('id').values_list(
+                'id', flat=True))
+            SellerDailyStats.objects.filter(seller_id__in=seller_ids).delete()
+            SellerDailyPhoneStats.objects.filter(seller_id__in=seller_ids).delete()
+
+            days = defaultdict(lambda: [0, 0, 0, 0])  # (seller_id, day) -> spent, count, credited, credits
+            per_number = defaultdict(lambda: [0, 0])  # (seller_id, day, phone_number) -> amount, count
+            if LedgerArchiveHandler.enabled():
+                wanted = set(seller_ids)
+                for row in LedgerArchiveHandler().rows('transactions'):
+                    # Segments written before the status was archived hold no released recharges
+                    if row['seller_id'] not in wanted or row.get('status') == Transaction.RELEASED:
+                        continue
+                    day = timezone.localdate(row['created_at'])
+                    per_number[row['seller_id'], day, row['phone_number']][0] += row['amount']
+                    per_number[row['seller_id'], day, row['phone_number']][1] += 1
+
+            rows = Transaction.objects.filter(seller_id__in=seller_ids).exclude(status=Transaction.RELEASED).annotate(
+                day=TruncDate('created_at')
+            ).values('seller_id', 'day', 'phone_number').annotate(amount=Sum('amount'), count=Count('id')).order_by()
+            for row in rows.iterator():
+                counters = per_number[row['seller_id'], row['day'], row['phone_number']]
+                counters[0] += row['amount']
+                counters[1] += row['count']
+            phone_stats = []
+            for (seller_id, day, phone_number), (amount, count) in per_number.items():
+                days[seller_id, day][0] += amount
+                days[seller_id, day][1] += count
+                phone_stats.append(SellerDailyPhoneStats(seller_id=seller_id, day=day, phone_number=phone_number,
+                                                         amount=amount, transaction_count=count))
+
+            credits = CreditRequest.objects.filter(seller_id__in=seller_ids, is_approved=True).annotate(
+                day=TruncDate('approved_at')
+            ).values('seller_id', 'day').annotate(amount=Sum('amount'), count=Count('id')).order_by()
+            for row in credits:
+                days[row['seller_id'], row['day']][2] += row['amount']
+                days[row['seller_id'], row['day']][3] += row['count']
+
+            batch_size = get_setting('BULK_CREATE_BATCH_SIZE')
+            SellerDailyStats.objects.bulk_create([
+                SellerDailyStats(seller_id=seller_id, day=day, spent=spent, transaction_count=count,
+                                 credited=credited, credit_count=credit_count)
+                for (seller_id, day), (spent, count, credited, credit_count) in days.items()
+            ], batch_size=batch_size)
+            SellerDailyPhoneStats.objects.bulk_create(phone_stats, batch_size=batch_size)
+            rebuilt = dict.fromkeys(seller_ids, 0)
+            for seller_id, _ in days:
+                rebuilt[seller_id] += 1
+            return rebuilt
+
+
+class SellerStatsReader:
+    """
+    Answers statistics of a period from the daily counters: the cost depends on the number
+    of days (and of recharged numbers) in the period, not on the number of recharges.
+    """
+
+    FIELDS = ['spent', 'transaction_count', 'credited', 'credit_count']
+
+    @classmethod
+    def summary(cls, seller_id, start, end, top=10):
+        """
+        Totals, per-day counters (every day from start to end inclusive, zeros included)
+        and the `top` phone numbers by recharged amount of a seller's period.
+        """
+        per_day = {row['day']: row for row in SellerDailyStats.objects.filter(
+            seller_id=seller_id, day__gte=start, day__lte=end
+        ).values('day').annotate(**{field: Sum(field) for field in cls.FIELDS}).order_by()}
+
+        days = []
+        totals = {field: 0 for field in cls.FIELDS}
+        day = start
+        while day <= end:
+            row = per_day.get(day, {})
+            counters = {field: row.get(field) or 0 for field in cls.FIELDS}
+            for field in cls.FIELDS:
+                totals[field] += counters[field]
+            days.append({'day': day, **counters})
+            day += timedelta(days=1)
+
+        top_numbers = list(SellerDailyPhoneStats.objects.filter(
+            seller_id=seller_id, day__gte=start, day__lte=end
+        ).values('phone_number').annotate(
+            amount=Sum('amount'), transaction_count=Sum('transaction_count')
+        ).filter(transaction_count__gt=0).order_by('-amount', 'phone_number')[:top])
+        return {'start': start, 'end': end, 'totals': totals, 'days': days, 'top_phone_numbers': top_numbers}
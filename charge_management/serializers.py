@@ -1,12 +1,29 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+
+from .authentication import SELLER_ID_CLAIM
+from .conf import get_setting
+from .context import get_request_seller
+from .handlers import BulkTransactionHandler
+from .instrumentation import stage
 from .models import Seller, CreditRequest, Transaction, CreditLog, PhoneNumber
 
 
 # Serializer for Seller model
 class SellerSerializer(serializers.ModelSerializer):
+    # credit is only the reserve of a sharded seller, total_credit adds its shards
+    total_credit = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+
     class Meta:
         model = Seller
-        fields = ['id', 'name', 'email', 'phone_number', 'credit', 'created_at', 'updated_at']
+        fields = ['id', 'name', 'email', 'phone_number', 'credit', 'total_credit', 'held', 'credit_shards',
+                  'created_at', 'updated_at']
+        # Changed through ShardedBalanceHandler.configure() and RechargeReservationHandler
+        read_only_fields = ['credit_shards', 'held']
 
 
 # Serializer for CreditRequest model
@@ -17,6 +34,17 @@ class CreditRequestSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'is_approved', 'approved_by', 'approved_at', 'seller']
 
 
+# Serializer for a bulk approval request, the ids are checked by CreditApprovalHandler
+class CreditRequestBulkApprovalSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_ids(self, value):
+        max_items = get_setting('CREDIT_APPROVAL_MAX_ITEMS')
+        if len(value) > max_items:
+            raise serializers.ValidationError(f"A bulk approval can hold at most {max_items} credit requests.")
+        return value
+
+
 # Serializer for Transaction model
 class TransactionSerializer(serializers.ModelSerializer):
     class Meta:
@@ -24,6 +52,10 @@ class TransactionSerializer(serializers.ModelSerializer):
         fields = ['id', 'seller', 'phone_number', 'amount', 'created_at']
         read_only_fields = ['seller', 'created_at']
 
+    def is_valid(self, *args, **kwargs):
+        with stage('validate'):
+            return super().is_valid(*args, **kwargs)
+
     def validate_phone_number(self, value):
         """
         Custom validation for phone_number field.
@@ -37,18 +69,101 @@ class TransactionSerializer(serializers.ModelSerializer):
         """
         Validate that seller has sufficient credit
         """
-        seller = self.context['request'].user.seller
-        if seller.credit < value:
+        seller = get_request_seller(self.context['request'])
+        if seller.total_credit < value:
             raise serializers.ValidationError("Insufficient credit for this transaction.")
         return value
 
     def validate(self, data):
-        data['seller'] = self.context['request'].user.seller
+        data['seller'] = get_request_seller(self.context['request'])
         return data
 
 
+# Serializer for a two-phase recharge, the operator settles it after the response
+class RechargeReservationSerializer(TransactionSerializer):
+    class Meta(TransactionSerializer.Meta):
+        fields = ['id', 'seller', 'phone_number', 'amount', 'status', 'hold_expires_at', 'operator_reference',
+                  'created_at']
+        read_only_fields = ['seller', 'status', 'hold_expires_at', 'operator_reference', 'created_at']
+
+
+# Serializer for one item of a bulk recharge request
+class BulkTransactionItemSerializer(serializers.Serializer):
+    phone_number = serializers.CharField(max_length=15)
+    amount = serializers.DecimalField(max_digits=12, decimal_places=2, min_value=Decimal('0.01'))
+
+
+# Serializer for a bulk recharge request, phone numbers and credit are checked by BulkTransactionHandler
+class BulkTransactionSerializer(serializers.Serializer):
+    mode = serializers.ChoiceField(
+        choices=[BulkTransactionHandler.ALL_OR_NOTHING, BulkTransactionHandler.BEST_EFFORT],
+        default=BulkTransactionHandler.ALL_OR_NOTHING
+    )
+    transactions = BulkTransactionItemSerializer(many=True, allow_empty=False)
+
+    def validate_transactions(self, value):
+        max_items = get_setting('BULK_TRANSACTION_MAX_ITEMS')
+        if len(value) > max_items:
+            raise serializers.ValidationError(f"A bulk request can hold at most {max_items} transactions.")
+        return value
+
+
 # Serializer for CreditLog model
 class CreditLogSerializer(serializers.ModelSerializer):
     class Meta:
         model = CreditLog
         fields = ['id', 'seller', 'balance_snapshot', 'amount', 'description', 'created_at']
+
+
+# Query of the seller statistics endpoint: an inclusive day range, by default the last
+# SELLER_STATS_DEFAULT_DAYS days, and the number of top phone numbers
+class SellerStatsQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    top = serializers.IntegerField(min_value=0, max_value=100, default=10)
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.localdate())
+        attrs.setdefault('start', attrs['end'] - timedelta(days=get_setting('SELLER_STATS_DEFAULT_DAYS') - 1))
+        if attrs['start'] > attrs['end']:
+            raise serializers.ValidationError({"start": ["Must not be after end."]})
+        max_days = get_setting('SELLER_STATS_MAX_DAYS')
+        if (attrs['end'] - attrs['start']).days >= max_days:
+            raise serializers.ValidationError({"start": [f"A period can span at most {max_days} days."]})
+        return attrs
+
+
+# Counters of one day, or of a whole period without the day
+class SellerDayStatsSerializer(serializers.Serializer):
+    day = serializers.DateField(required=False)
+    spent = serializers.DecimalField(max_digits=14, decimal_places=2)
+    transaction_count = serializers.IntegerField()
+    credited = serializers.DecimalField(max_digits=14, decimal_places=2)
+    credit_count = serializers.IntegerField()
+
+
+class SellerPhoneStatsSerializer(serializers.Serializer):
+    phone_number = serializers.CharField()
+    amount = serializers.DecimalField(max_digits=14, decimal_places=2)
+    transaction_count = serializers.IntegerField()
+
+
+# Statistics of a seller's period, as returned by SellerStatsReader.summary()
+class SellerStatsSerializer(serializers.Serializer):
+    start = serializers.DateField()
+    end = serializers.DateField()
+    totals = SellerDayStatsSerializer()
+    days = SellerDayStatsSerializer(many=True)
+    top_phone_numbers = SellerPhoneStatsSerializer(many=True)
+
+
+# Access and refresh tokens that carry the user's seller id
+class SellerTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        # Views that only need the seller's id read it from the token
+        token = super().get_token(user)
+        seller_id = Seller.objects.filter(user=user).values_list('id', flat=True).first()
+        if seller_id is not None:
+            token[SELLER_ID_CLAIM] = seller_id
+        return token
@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .admission import forget_admission_limits
+from .authentication import CachedJWTAuthentication
+from .balance_cache import BalanceCache
+from .models import Seller, PhoneNumber
+from .phone_cache import get_phone_cache
+from .phone_index import add_to_phone_index
+
+
+@receiver(pre_save, sender=PhoneNumber)
+def remember_previous_phone_number(sender, instance, raw=False, **kwargs):
+    # A renamed number must also drop the cache entry of its old value
+    if instance.pk and not raw:
+        instance._previous_phone_number = sender.objects.filter(pk=instance.pk).values_list(
+            'phone_number', flat=True).first()
+
+
+@receiver(post_save, sender=PhoneNumber)
+@receiver(post_delete, sender=PhoneNumber)
+def invalidate_phone_cache(sender, instance, **kwargs):
+    phone_numbers = {instance.phone_number, getattr(instance, '_previous_phone_number', None)} - {None}
+    # Dropped now for the writing transaction's own checks, and again once it commits: until
+    # then a concurrent check still reads the old row and may cache it for the whole TTL
+    get_phone_cache().invalidate(*phone_numbers)
+    transaction.on_commit(lambda: get_phone_cache().invalidate(*phone_numbers))
+
+
+@receiver(post_save, sender=PhoneNumber)
+def add_phone_number_to_index(sender, instance, **kwargs):
+    add_to_phone_index(instance.phone_number)
+
+
+@receiver(post_save, sender=Seller)
+@receiver(post_delete, sender=Seller)
+def invalidate_balance_cache(sender, instance, **kwargs):
+    # Covers credit edited outside the debit/credit paths, e.g. in the admin
+    BalanceCache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Seller)
+def reload_admission_limits(sender, instance, **kwargs):
+    # Other processes pick up edited limits after ADMISSION_LIMITS_TTL
+    forget_admission_limits(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Password, is_active and staff changes must reach authentication at once. Dropped again on
+    # commit, a concurrent request may have cached the old row until then for AUTH_CACHE_TTL
+    CachedJWTAuthentication.invalidate(instance.pk)
+    transaction.on_commit(lambda: CachedJWTAuthentication.invalidate(instance.pk))
+
+
+@receiver(pre_save, sender=Seller)
+def remember_previous_seller_user(sender, instance, raw=False, update_fields=None, **kwargs):
+    # A seller moved to another user must also drop the cached user it left; the credit
+    # paths save with update_fields and never move it, so they skip the lookup
+    if instance.pk and not raw and (update_fields is None or 'user' in update_fields):
+        instance._previous_user_id = sender.objects.filter(pk=instance.pk).values_list(
+            'user_id', flat=True).first()
+
+
+@receiver(post_save, sender=Seller)
+@receiver(post_delete, sender=Seller)
+def invalidate_cached_seller(sender, instance, **kwargs):
+    user_ids = {instance.user_id, getattr(instance, '_previous_user_id', None)} - {None}
+
+    def invalidate():
+        for user_id in user_ids:
+            CachedJWTAuthentication.invalidate(user_id)
+
+    invalidate()
+    transaction.on_commit(invalidate)
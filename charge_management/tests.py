@@ -1,11 +1,61 @@
-from .models import Seller, CreditLog, Transaction, CreditRequest
-from threading import Thread
-from django.db import models
+from .admission import AdmissionController, LocalAdmissionBackend, get_admission_controller, reset_admission_controller
+from .analytics import LedgerAnalytics, LedgerExportHandler
+from .archive import LedgerArchiveHandler
+from .async_views import run_blocking
+from .authentication import CachedJWTAuthentication
+from .benchmark import BenchmarkRunner, percentile
+from .handlers import (
+    BulkTransactionHandler, CreditApprovalHandler, CreditTransactionHandler, DebitTransactionHandler, RechargeReservationHandler,
+    ShardedBalanceHandler
+)
+from .idempotency import IdempotencyHandler
+from .instrumentation import get_registry
+from .operators import FakeOperatorClient, OperatorDispatcher
+from .outbox import CreditLogWriter, OutboxBackpressure, OutboxDrainer
+from .models import (
+    Seller, SellerBalanceShard, CreditLog, Transaction, CreditRequest, PhoneNumber, DailyBalanceSnapshot,
+    IdempotencyKey, CreditLogOutbox, LedgerCheckpoint, SellerDailyStats, SellerDailyPhoneStats
+)
+from .phone_cache import get_phone_cache
+from .phone_import import PhoneNumberImporter, normalize_phone_number, read_csv
+from .phone_index import PhoneNumberBloomFilter, PhoneNumberIndex, get_phone_index, warm_phone_index
+from .query_plans import QueryPlanAssertionsMixin, QueryPlanRecorder
+from .reconciliation import LedgerReconciliationHandler
+from .replicas import ReplicaRouter, monitor, read_from_replica
+from .seller_stats import SellerStatsRecorder
+from .serializers import SellerSerializer
+from threading import Thread, current_thread
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from django.db import models, OperationalError
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from datetime import timedelta
+import base64
+import hashlib
+import io
 from decimal import Decimal
+import json
+import os
+import tempfile
+import zipfile
 from django.contrib.auth.models import User
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class CreditTransactionTestCase(TestCase):
     def test_credit_increase(self):
@@ -142,3 +192,1955 @@ class SellerTransactionTest(TestCase):
         # Ensure all transactions are logged
         self.assertEqual(self.seller1.transactions.count(), 1000)
         self.assertEqual(self.seller2.transactions.count(), 1000)
+
+
+class DebitTransactionHandlerTest(TestCase):
+    def setUp(self):
+        self.seller = Seller.objects.create(
+            user=User.objects.create_user(username="debit", password="pass"),
+            name="Debit Seller",
+            email="debit@example.com",
+            phone_number="1112223333",
+            credit=Decimal("100.00")
+        )
+
+    def test_debit_writes_transaction_and_log(self):
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("30.00"))
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("70.00"))
+        log = CreditLog.objects.get(seller=self.seller)
+        self.assertEqual(log.amount, Decimal("-30.00"))
+        self.assertEqual(log.balance_snapshot, Decimal("70.00"))
+
+    def test_insufficient_credit_leaves_no_rows(self):
+        with self.assertRaises(ValueError):
+            Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("100.01"))
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("100.00"))
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(CreditLog.objects.exists())
+
+    def test_saving_an_existing_transaction_does_not_debit_again(self):
+        recharge = Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("30.00"))
+        recharge.operator_reference = "manual"
+        recharge.save()
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("70.00"))
+        self.assertEqual(CreditLog.objects.filter(seller=self.seller).count(), 1)
+        self.assertEqual(SellerDailyStats.objects.get(seller=self.seller).transaction_count, 1)
+
+        admin_user = User.objects.create_superuser(username="debit-admin", password="secret")
+        self.client.force_login(admin_user)
+        response = self.client.post(reverse('admin:charge_management_transaction_change', args=[recharge.pk]),
+                                    {'seller': self.seller.pk, 'phone_number': "09121234567", 'amount': "30.00"})
+        self.assertEqual(response.status_code, 403)
+
+    def test_debit_outrun_since_validation_is_a_bad_request(self):
+        PhoneNumber.objects.create(phone_number="09121234567")
+        client = APIClient()
+        client.force_authenticate(self.seller.user)
+        # A concurrent debit took the credit between validation and the conditional UPDATE
+        with mock.patch.object(DebitTransactionHandler, 'withdraw', return_value=None):
+            response = client.post(reverse('transaction-create'), {'phone_number': '09121234567', 'amount': '30.00'},
+                                   format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('amount', response.data)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_retries_with_jittered_backoff(self):
+        withdraw = DebitTransactionHandler.withdraw
+        calls = []
+
+        def flaky_withdraw(seller_id, amount, shards=0):
+            calls.append(amount)
+            if len(calls) == 1:
+                raise OperationalError("deadlock detected")
+            return withdraw(seller_id, amount, shards)
+
+        with mock.patch.object(DebitTransactionHandler, 'withdraw', side_effect=flaky_withdraw), \
+                mock.patch('charge_management.handlers.sleep') as sleep:
+            Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("10.00"))
+
+        self.assertEqual(len(calls), 2)
+        sleep.assert_called_once()
+        self.assertLessEqual(sleep.call_args[0][0], 0.2)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        with mock.patch.object(DebitTransactionHandler, 'withdraw', side_effect=OperationalError("locked")), \
+                mock.patch('charge_management.handlers.sleep') as sleep:
+            with self.assertRaises(OperationalError):
+                Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("10.00"))
+
+        self.assertEqual(sleep.call_count, 2)
+        self.assertFalse(Transaction.objects.exists())
+
+
+class ShardedBalanceTest(TestCase):
+    def setUp(self):
+        self.seller = Seller.objects.create(
+            user=User.objects.create_user(username="hot", password="pass"),
+            name="Hot Seller",
+            email="hot@example.com",
+            phone_number="4445556666",
+            credit=Decimal("100.01")
+        )
+        ShardedBalanceHandler.configure(self.seller.id, 4)
+        self.seller.refresh_from_db()
+
+    def shard_credits(self):
+        return list(self.seller.balance_shards.order_by('index').values_list('credit', flat=True))
+
+    def test_configure_splits_credit(self):
+        self.assertEqual(self.seller.credit, Decimal("0.00"))
+        self.assertEqual(self.shard_credits(), [Decimal("25.01"), Decimal("25.00"), Decimal("25.00"), Decimal("25.00")])
+        self.assertEqual(self.seller.total_credit, Decimal("100.01"))
+
+    def test_debit_falls_back_to_rebalance(self):
+        # No shard holds 60 on its own, so the debit pools the shards first
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("60.00"))
+
+        self.assertEqual(self.seller.total_credit, Decimal("40.01"))
+        self.assertEqual(CreditLog.objects.get(seller=self.seller).balance_snapshot, Decimal("40.01"))
+        with self.assertRaises(ValueError):
+            Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("40.02"))
+        self.assertEqual(self.seller.total_credit, Decimal("40.01"))
+
+    def test_add_credit_and_merge_back(self):
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("10.00"))
+        result = CreditTransactionHandler.add_credit(self.seller.id, Decimal("20.00"))
+
+        self.assertTrue(result['success'])
+        self.assertEqual(self.seller.total_credit, Decimal("110.01"))
+        self.assertEqual(CreditLog.objects.filter(amount__gt=0).get().balance_snapshot, Decimal("110.01"))
+
+        ShardedBalanceHandler.configure(self.seller.id, 0)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("110.01"))
+        self.assertFalse(SellerBalanceShard.objects.exists())
+
+
+    def test_admin_lists_the_total_credit(self):
+        self.client.force_login(User.objects.create_superuser(username="shard-admin", password="secret"))
+        response = self.client.get(reverse('admin:charge_management_seller_changelist'))
+        self.assertContains(response, '<td class="field-total_credit">100.01</td>', html=True)
+
+
+class BulkTransactionTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="partner", password="pass")
+        self.seller = Seller.objects.create(
+            user=user,
+            name="Partner",
+            email="partner@example.com",
+            phone_number="7778889999",
+            credit=Decimal("50.00")
+        )
+        PhoneNumber.objects.bulk_create([PhoneNumber(phone_number=f"0912000000{i}") for i in range(5)])
+        get_phone_cache().clear()  # bulk_create sends no signals
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.url = reverse('transaction-bulk-create')
+
+    def post(self, items, mode='all_or_nothing'):
+        return self.client.post(self.url, {
+            'mode': mode,
+            'transactions': [{'phone_number': phone, 'amount': amount} for phone, amount in items],
+        }, format='json')
+
+    def test_all_or_nothing_creates_every_row_with_one_debit(self):
+        # Phone lookup, debit, balance read, two bulk INSERTs and two stats upserts, plus the savepoint pair
+        with self.assertNumQueries(9):
+            response = self.post([("09120000000", "10.00"), ("09120000001", "15.00")])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 2)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("25.00"))
+        snapshots = list(CreditLog.objects.order_by('id').values_list('balance_snapshot', flat=True))
+        self.assertEqual(snapshots, [Decimal("40.00"), Decimal("25.00")])
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_all_or_nothing_rejects_batch_with_invalid_phone(self):
+        response = self.post([("09120000000", "10.00"), ("09990000000", "1.00")])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([r['status'] for r in response.data['results']], ['rejected', 'invalid_phone_number'])
+        self.assertFalse(Transaction.objects.exists())
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("50.00"))
+
+    def test_best_effort_accepts_what_fits(self):
+        response = self.post([
+            ("09120000000", "30.00"),
+            ("09990000000", "1.00"),
+            ("09120000001", "30.00"),
+            ("09120000002", "20.00"),
+        ], mode='best_effort')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([r['status'] for r in response.data['results']],
+                         ['created', 'invalid_phone_number', 'insufficient_credit', 'created'])
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("0.00"))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class PhoneValidityCacheTest(TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+        self.phone = PhoneNumber.objects.create(phone_number="09121112233")
+
+    def test_repeated_validations_hit_the_cache(self):
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09121112233"))
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09999999999"))
+        before = get_phone_cache().stats()
+
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                self.assertTrue(PhoneNumber.is_valid_phone_number("09121112233"))
+                self.assertFalse(PhoneNumber.is_valid_phone_number("09999999999"))
+
+        after = get_phone_cache().stats()
+        self.assertEqual(after['hits'] - before['hits'], 20)
+        self.assertEqual(after['misses'], before['misses'])
+
+    def test_changes_invalidate_entries(self):
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09121112233"))
+        self.phone.deactivate()
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09121112233"))
+
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09124445566"))
+        PhoneNumber.objects.create(phone_number="09124445566")
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09124445566"))
+
+        self.phone.is_active = True
+        self.phone.phone_number = "09127778899"
+        self.phone.save()
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09121112233"))
+
+    def test_entries_cached_before_commit_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.phone.deactivate()
+            # A concurrent check still sees the committed, active row and caches it
+            get_phone_cache().set("09121112233", True)
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09121112233"))
+
+    @override_settings(CHARGE_MANAGEMENT={'PHONE_CACHE_NEGATIVE_TTL': 0})
+    def test_negative_ttl_expires_entries(self):
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09999999999"))
+        with self.assertNumQueries(1):
+            self.assertFalse(PhoneNumber.is_valid_phone_number("09999999999"))
+
+    @override_settings(
+        CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'phones'}},
+        CHARGE_MANAGEMENT={'PHONE_CACHE_ALIAS': 'shared'}
+    )
+    def test_shared_backend_fills_local_cache(self):
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09121112233"))
+        get_phone_cache().clear()  # Another process: empty local cache, same shared cache
+
+        with self.assertNumQueries(0):
+            self.assertTrue(PhoneNumber.is_valid_phone_number("09121112233"))
+        self.assertEqual(get_phone_cache().stats()['shared_hits'], 1)
+
+
+@override_settings(CHARGE_MANAGEMENT={'PHONE_INDEX_ENABLED': True, 'PHONE_INDEX_REFRESH_INTERVAL': 3600})
+class PhoneNumberIndexTest(TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+        PhoneNumber.objects.bulk_create([PhoneNumber(phone_number=f"0912{i:07d}") for i in range(200)])
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = PhoneNumberIndex.build(capacity=200, error_rate=0.01)
+        self.assertTrue(all(f"0912{i:07d}" in bloom for i in range(200)))
+        false_positives = sum(f"0935{i:07d}" in bloom for i in range(2000))
+        self.assertLess(false_positives, 100)
+
+    def test_unknown_numbers_are_rejected_without_queries(self):
+        warm_phone_index()
+
+        with self.assertNumQueries(0):
+            for i in range(50):
+                self.assertFalse(PhoneNumber.is_valid_phone_number(f"0999{i:07d}"))
+        with self.assertNumQueries(1):
+            self.assertTrue(PhoneNumber.is_valid_phone_number("09120000007"))
+
+    def test_admin_changes_update_the_index(self):
+        warm_phone_index()
+        PhoneNumber.objects.create(phone_number="09350000001")
+
+        with self.assertNumQueries(1):
+            self.assertTrue(PhoneNumber.is_valid_phone_number("09350000001"))
+
+    @override_settings(CHARGE_MANAGEMENT={'PHONE_INDEX_ENABLED': True})  # Drops an index loaded by another test
+    def test_requests_never_wait_for_a_build(self):
+        with mock.patch('charge_management.phone_index.Thread') as thread:
+            with self.assertNumQueries(0):
+                self.assertIsNone(get_phone_index())
+                self.assertIsNone(get_phone_index())  # One build at a time
+            thread.assert_called_once()
+            thread.return_value.start.assert_called_once()
+            with self.assertNumQueries(1):  # Checked against the database meanwhile
+                self.assertFalse(PhoneNumber.is_valid_phone_number("09990000001"))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'phones.bin')
+            PhoneNumberIndex.build().save(path)
+            with override_settings(CHARGE_MANAGEMENT={'PHONE_INDEX_ENABLED': True, 'PHONE_INDEX_PATH': path}):
+                self.assertIn("09120000199", get_phone_index().bloom)  # A snapshot is mapped right away
+
+    def test_snapshot_roundtrip(self):
+        bloom = PhoneNumberIndex.build()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'phones.bin')
+            bloom.save(path)
+            loaded = PhoneNumberBloomFilter.load(path)
+
+            self.assertEqual(loaded.high_water_id, bloom.high_water_id)
+            self.assertIn("09120000199", loaded)
+            loaded.add("09350000002")  # Copy-on-write, the snapshot file stays untouched
+            self.assertIn("09350000002", loaded)
+            self.assertNotIn("09350000002", PhoneNumberBloomFilter.load(path))
+
+
+class PhoneNumberImportTest(TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+
+    def test_numbers_are_normalized(self):
+        self.assertEqual(normalize_phone_number("+98 912 123-4567"), "09121234567")
+        self.assertEqual(normalize_phone_number("00989121234567"), "09121234567")
+        self.assertEqual(normalize_phone_number("989121234567"), "09121234567")
+        self.assertEqual(normalize_phone_number(" (0912) 123.4567 "), "09121234567")
+        self.assertIsNone(normalize_phone_number("0912abc4567"))
+        self.assertIsNone(normalize_phone_number("123"))
+
+    def test_csv_with_and_without_header(self):
+        with_header = io.StringIO("description,phone_number\nOffice,09121234567\n,09121234568\n")
+        self.assertEqual(list(read_csv(with_header)), [("09121234567", "Office"), ("09121234568", None)])
+        without_header = io.StringIO("a,09121234567\nb,09121234568\n")
+        self.assertEqual([number for number, _ in read_csv(without_header, column=1)],
+                         ["09121234567", "09121234568"])
+
+    def test_import_creates_and_reactivates_in_chunks(self):
+        PhoneNumber.objects.create(phone_number="09120000001", is_active=False)
+        PhoneNumber.objects.create(phone_number="09120000002")
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09120000001"))
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09120000009"))  # Cached as unknown
+        rows = [(f"0912000000{i}", None) for i in range(10)] + [("+989120000003", None), ("oops", None)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = PhoneNumberImporter(chunk_size=4).import_rows(rows)
+
+        self.assertEqual(stats['read'], 12)
+        self.assertEqual(stats['created'], 8)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['unchanged'], 2)  # The active number, and 09120000003 repeated in another chunk
+        self.assertEqual(stats['invalid'], 1)
+        self.assertEqual(PhoneNumber.objects.filter(is_active=True).count(), 10)
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09120000001"))
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09120000009"))
+
+    def test_duplicates_within_a_chunk_and_existing_rows(self):
+        PhoneNumber.objects.create(phone_number="09120000001", description="Old")
+        rows = [("09120000001", "New"), ("0912 000 0001", None), ("09120000002", None)]
+
+        stats = PhoneNumberImporter().import_rows(rows)
+
+        self.assertEqual(stats['duplicates'], 1)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(PhoneNumber.objects.get(phone_number="09120000001").description, "New")
+
+    def test_numbers_inserted_concurrently_are_not_counted(self):
+        rows = [("09120000001", None), ("09120000002", None), ("09120000003", None)]
+        bulk_create = PhoneNumber.objects.bulk_create
+
+        def racing_bulk_create(objs, *args, **kwargs):
+            # Another import registers 09120000002 between our lookup and our INSERT
+            if not PhoneNumber.objects.filter(phone_number="09120000002").exists():
+                PhoneNumber.objects.create(phone_number="09120000002")
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(PhoneNumber.objects, 'bulk_create', side_effect=racing_bulk_create), \
+                mock.patch('charge_management.phone_import.add_to_phone_index') as add_to_index, \
+                self.captureOnCommitCallbacks(execute=True):
+            stats = PhoneNumberImporter().import_rows(rows)
+
+        self.assertEqual((stats['created'], stats['unchanged']), (2, 1))
+        self.assertEqual(sorted(call.args[0] for call in add_to_index.call_args_list),
+                         ["09120000001", "09120000003"])
+        self.assertEqual(PhoneNumber.objects.count(), 3)
+
+    def test_bulk_deactivate_and_reactivate(self):
+        PhoneNumber.objects.bulk_create([PhoneNumber(phone_number=f"0912{i:07d}") for i in range(20)])
+        self.assertTrue(PhoneNumber.is_valid_phone_number("09120000005"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = PhoneNumberImporter(chunk_size=8).set_active((f"0912{i:07d}" for i in range(10)), False)
+
+        self.assertEqual((stats['updated'], stats['unchanged']), (10, 0))
+        self.assertEqual(PhoneNumber.objects.filter(is_active=False).count(), 10)
+        self.assertFalse(PhoneNumber.is_valid_phone_number("09120000005"))
+
+        stats = PhoneNumberImporter().set_active(["09120000005", "09120000015", "09350000000"], True)
+        self.assertEqual((stats['updated'], stats['unchanged']), (1, 2))
+
+    def test_command_imports_and_deactivates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'phones.csv')
+            with open(path, 'w', encoding='utf-8-sig') as f:
+                f.write("phone_number,description\n09120000001,A\n09120000002,B\n")
+            out = io.StringIO()
+            call_command('import_phone_numbers', path, stdout=out, stderr=io.StringIO())
+            self.assertIn("created=2", out.getvalue())
+            self.assertEqual(PhoneNumber.objects.get(phone_number="09120000002").description, "B")
+
+            call_command('import_phone_numbers', path, '--deactivate', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertFalse(PhoneNumber.objects.filter(is_active=True).exists())
+
+    def test_admin_upload_and_actions(self):
+        self.client.force_login(User.objects.create_superuser(username="importer", password="secret"))
+        upload = SimpleUploadedFile('phones.csv', b"09120000001\n09120000002\n09120000002\n")
+
+        response = self.client.post(reverse('admin:charge_management_phonenumber_upload'),
+                                    {'file': upload, 'mode': 'import'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(PhoneNumber.objects.count(), 2)
+        response = self.client.post(reverse('admin:charge_management_phonenumber_changelist'), {
+            'action': 'deactivate_numbers',
+            '_selected_action': list(PhoneNumber.objects.values_list('pk', flat=True)),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(PhoneNumber.objects.filter(is_active=True).exists())
+        self.assertEqual(self.client.get(reverse('admin:charge_management_phonenumber_upload')).status_code, 200)
+
+
+class CreditLogListTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="logs", password="pass")
+        self.seller = Seller.objects.create(
+            user=user,
+            name="Logs Seller",
+            email="logs@example.com",
+            phone_number="1231231234",
+            credit=Decimal("0.00")
+        )
+        CreditLog.objects.bulk_create([
+            CreditLog(seller=self.seller, amount=Decimal(i), balance_snapshot=Decimal(i), description=f"log {i}")
+            for i in range(25)
+        ])
+        # Identical timestamps force the id tie-breaker of the keyset
+        CreditLog.objects.filter(id__lte=CreditLog.objects.order_by('id')[10].id).update(created_at=timezone.now())
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_cursor_pages_cover_every_row_once(self):
+        url = reverse('credit-log-list') + '?page_size=7'
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(row['id'] for row in response.data['results'])
+            url = response.data['next']
+
+        expected = list(CreditLog.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('credit-log-list') + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_ndjson_export_streams_every_row(self):
+        response = self.client.get(reverse('credit-log-list') + '?export=ndjson')
+
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['seller_id'], self.seller.id)
+
+    def test_csv_export_for_admin(self):
+        admin = User.objects.create_user(username="staff", password="pass", is_staff=True)
+        self.client.force_authenticate(admin)
+        url = reverse('credit-log-list', kwargs={'seller_id': self.seller.id})
+        response = self.client.get(url + '?export=csv')
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,seller_id,balance_snapshot,amount,description,created_at')
+        self.assertEqual(len(lines), 26)
+
+
+@override_settings(CHARGE_MANAGEMENT={'RECONCILIATION_SETTLE_SECONDS': 0})
+class LedgerReconciliationTest(TestCase):
+    def setUp(self):
+        self.seller = Seller.objects.create(
+            user=User.objects.create_user(username="ledger", password="pass"),
+            name="Ledger Seller",
+            email="ledger@example.com",
+            phone_number="9879879876",
+        )
+        CreditTransactionHandler.add_credit(self.seller.id, Decimal("100.00"))
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("30.00"))
+        # Move the first day's rows into the past
+        yesterday = timezone.now() - timedelta(days=1)
+        CreditLog.objects.update(created_at=yesterday)
+        Transaction.objects.update(created_at=yesterday)
+
+    def test_roll_up_builds_daily_snapshots_incrementally(self):
+        self.assertEqual(LedgerReconciliationHandler.roll_up(), 3)
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("5.00"))
+        self.assertEqual(LedgerReconciliationHandler.roll_up(), 2)
+        self.assertEqual(LedgerReconciliationHandler.roll_up(), 0)
+
+        first, second = DailyBalanceSnapshot.objects.filter(seller=self.seller).order_by('day')
+        self.assertEqual((first.credited, first.debited, first.log_count), (Decimal("100.00"), Decimal("30.00"), 2))
+        self.assertEqual((first.transaction_amount, first.transaction_count), (Decimal("30.00"), 1))
+        self.assertEqual(first.closing_balance, Decimal("70.00"))
+        self.assertEqual(second.closing_balance, Decimal("65.00"))
+
+    def test_verify_uses_snapshot_plus_delta(self):
+        LedgerReconciliationHandler.roll_up()
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("5.00"))
+        self.assertEqual(LedgerReconciliationHandler.verify(), [])
+
+        Seller.objects.filter(id=self.seller.id).update(credit=Decimal("1000.00"))
+        drifts = LedgerReconciliationHandler.verify()
+        self.assertEqual(len(drifts), 1)
+        self.assertEqual(drifts[0]['expected'], Decimal("65.00"))
+        self.assertEqual(drifts[0]['drift'], Decimal("935.00"))
+
+    def test_late_rows_update_later_closing_balances(self):
+        LedgerReconciliationHandler.roll_up()
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("5.00"))
+        LedgerReconciliationHandler.roll_up()
+        # A row landing on the earlier day after the later day was rolled up
+        CreditLog.objects.create(seller=self.seller, amount=Decimal("1.00"), balance_snapshot=0, description="late")
+        CreditLog.objects.filter(description="late").update(created_at=timezone.now() - timedelta(days=1))
+        LedgerReconciliationHandler.roll_up()
+
+        closings = list(DailyBalanceSnapshot.objects.order_by('day').values_list('closing_balance', flat=True))
+        self.assertEqual(closings, [Decimal("71.00"), Decimal("66.00")])
+
+
+class LedgerArchiveTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = override_settings(CHARGE_MANAGEMENT={
+            'RECONCILIATION_SETTLE_SECONDS': 0, 'ARCHIVE_PATH': self.directory.name, 'ARCHIVE_BATCH_SIZE': 2,
+        })
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.user = User.objects.create_user(username="archive", password="pass")
+        self.seller = Seller.objects.create(
+            user=self.user,
+            name="Archive Seller",
+            email="archive@example.com",
+            phone_number="4564564567",
+        )
+        CreditTransactionHandler.add_credit(self.seller.id, Decimal("100.00"))
+        for _ in range(3):
+            Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("10.00"))
+        # Spread the history over the last two months
+        for days, log_id in zip((60, 50, 40, 30), CreditLog.objects.order_by('id').values_list('id', flat=True)):
+            CreditLog.objects.filter(id=log_id).update(created_at=timezone.now() - timedelta(days=days))
+        for days, transaction_id in zip((50, 40, 30), Transaction.objects.order_by('id').values_list('id', flat=True)):
+            Transaction.objects.filter(id=transaction_id).update(created_at=timezone.now() - timedelta(days=days))
+        self.before = timezone.now() - timedelta(days=7)
+
+    def test_only_rolled_up_rows_are_archived(self):
+        self.assertEqual(LedgerArchiveHandler().archive(self.before), {'credit_logs': 0, 'transactions': 0})
+
+        LedgerReconciliationHandler.roll_up()
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("5.00"))
+        moved = LedgerArchiveHandler().archive(self.before)
+
+        self.assertEqual(moved, {'credit_logs': 4, 'transactions': 3})
+        self.assertEqual(CreditLog.objects.count(), 1)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(len(list(LedgerArchiveHandler().rows('transactions', self.seller.id))), 3)
+        # The snapshots still account for every archived row
+        self.assertEqual(LedgerReconciliationHandler.verify(), [])
+        LedgerReconciliationHandler.roll_up()
+        self.assertEqual(DailyBalanceSnapshot.objects.order_by('-day').first().closing_balance, Decimal("65.00"))
+
+    def test_uncommitted_segments_are_ignored_and_rewritten(self):
+        LedgerReconciliationHandler.roll_up()
+        with mock.patch.object(LedgerCheckpoint, 'save', side_effect=OperationalError("lost")):
+            with self.assertRaises(OperationalError):
+                LedgerArchiveHandler().archive_batch('credit_logs', self.before, 2)
+        self.assertEqual(CreditLog.objects.count(), 4)
+        self.assertEqual(list(LedgerArchiveHandler().rows('credit_logs')), [])
+
+        LedgerArchiveHandler().archive(self.before)
+        archived = [row['id'] for row in LedgerArchiveHandler().rows('credit_logs')]
+        self.assertEqual(sorted(archived), sorted(set(archived)))
+        self.assertEqual(len(archived), 4)
+
+    def test_log_list_covers_archived_rows_for_a_date_range(self):
+        expected = list(CreditLog.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        LedgerReconciliationHandler.roll_up()
+        # Keep the two newest logs hot
+        CreditLog.objects.filter(id__in=expected[:2]).update(created_at=timezone.now())
+        LedgerArchiveHandler().archive(self.before)
+        self.assertEqual(CreditLog.objects.count(), 2)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(len(client.get(reverse('credit-log-list')).data['results']), 2)
+
+        url = reverse('credit-log-list') + '?page_size=3&created_after=' + (timezone.now() - timedelta(days=90)).date().isoformat()
+        seen = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(row['id'] for row in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(seen, expected)
+
+        response = client.get(reverse('credit-log-list') + '?export=ndjson&created_after=2000-01-01')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], expected)
+
+        response = client.get(reverse('credit-log-list') + '?created_after=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_archived_rows_are_read_lazily_newest_first(self):
+        LedgerReconciliationHandler.roll_up()
+        LedgerArchiveHandler().archive(self.before)
+        handler = LedgerArchiveHandler()
+        rows = list(handler.rows_newest_first('credit_logs', self.seller.id))
+        self.assertEqual([row['id'] for row in rows],
+                         sorted((row['id'] for row in handler.rows('credit_logs')), reverse=True))
+        months = [timezone.localtime(row['created_at']).strftime('%Y-%m') for row in rows]
+
+        read = []
+        original = LedgerArchiveHandler._read
+
+        def reading(archive, path, *args):
+            read.append(os.path.basename(os.path.dirname(path)))
+            return original(archive, path, *args)
+
+        with mock.patch.object(LedgerArchiveHandler, '_read', reading):
+            self.assertEqual(next(handler.rows_newest_first('credit_logs', self.seller.id))['id'], rows[0]['id'])
+            self.assertEqual(set(read), {months[0]})  # Older months are never opened
+            read.clear()
+            oldest = (rows[-1]['created_at'], rows[-1]['id'])
+            self.assertEqual(list(handler.rows_newest_first('credit_logs', self.seller.id, before=oldest)), [])
+            self.assertEqual(set(read), {months[-1]})  # Months after the cursor are skipped
+
+    def test_rebuilding_seller_stats_keeps_archived_history(self):
+        released = RechargeReservationHandler.reserve(self.seller, "09121234568", Decimal("20.00"))
+        RechargeReservationHandler.release(released, "operator error")
+        Transaction.objects.filter(id=released.id).update(created_at=timezone.now() - timedelta(days=30))
+        LedgerReconciliationHandler.roll_up()
+        LedgerArchiveHandler().archive(self.before)
+        self.assertFalse(Transaction.objects.exists())
+
+        call_command('rebuild_seller_stats', stdout=io.StringIO())
+
+        days = {stats.day: stats for stats in SellerDailyStats.objects.filter(seller=self.seller)}
+        self.assertEqual({timezone.localdate() - day for day in days},
+                         {timedelta(days=50), timedelta(days=40), timedelta(days=30)})
+        self.assertEqual(sum(stats.spent for stats in days.values()), Decimal("30.00"))  # Not the released one
+        self.assertEqual(sum(stats.transaction_count for stats in days.values()), 3)
+        phone_stats = SellerDailyPhoneStats.objects.filter(seller=self.seller).values_list('phone_number', 'amount')
+        self.assertEqual(set(phone_stats), {("09121234567", Decimal("10.00"))})
+
+
+class LedgerAnalyticsExportTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = override_settings(CHARGE_MANAGEMENT={
+            'RECONCILIATION_SETTLE_SECONDS': 0, 'ANALYTICS_EXPORT_PATH': self.directory.name,
+            'ANALYTICS_EXPORT_BATCH_SIZE': 2, 'ARCHIVE_PATH': os.path.join(self.directory.name, 'archive'),
+        })
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.sellers = [
+            Seller.objects.create(
+                user=User.objects.create_user(username=f"analytics{i}", password="pass"),
+                name=f"Analytics Seller {i}",
+                email=f"analytics{i}@example.com",
+                phone_number=f"777000000{i}",
+            )
+            for i in range(2)
+        ]
+        for seller in self.sellers:
+            CreditTransactionHandler.add_credit(seller.id, Decimal("100.00"))
+        for seller, phone_number, amount in [(self.sellers[0], "09121234567", "10.25"),
+                                             (self.sellers[0], "09351234567", "0.10"),
+                                             (self.sellers[1], "09121230000", "7.00")]:
+            Transaction.objects.create(seller=seller, phone_number=phone_number, amount=Decimal(amount))
+        Transaction.objects.filter(amount=Decimal("7.00")).update(created_at=timezone.now() - timedelta(days=1))
+
+    def test_export_is_incremental(self):
+        self.assertEqual(LedgerExportHandler().export(), {'transactions': 3, 'credit_logs': 5})
+        self.assertEqual(LedgerExportHandler().export(), {'transactions': 0, 'credit_logs': 0})
+        Transaction.objects.create(seller=self.sellers[1], phone_number="09121230000", amount=Decimal("1.00"))
+        self.assertEqual(LedgerExportHandler().export(), {'transactions': 1, 'credit_logs': 1})
+
+        segments = LedgerExportHandler().segments('transactions')
+        self.assertEqual(len(segments), 3)
+        with zipfile.ZipFile(segments[0][1]) as segment:
+            self.assertEqual(sorted(segment.namelist()), [
+                'amount_cents.npy', 'created_at.npy', 'id.npy', 'phone_number.npy', 'seller_id.npy'])
+
+    def test_archive_waits_for_the_export(self):
+        LedgerExportHandler().export_batch('transactions', 1)
+        LedgerReconciliationHandler.roll_up()
+        moved = LedgerArchiveHandler().archive(timezone.now())
+        self.assertEqual(moved, {'credit_logs': 0, 'transactions': 1})
+
+    @skipUnless(numpy, "NumPy is not installed")
+    def test_vectorized_totals(self):
+        LedgerExportHandler().export()
+        analytics = LedgerAnalytics()
+
+        by_seller = analytics.totals_by_seller()
+        self.assertEqual(by_seller, [
+            {'seller_id': self.sellers[0].id, 'amount': Decimal("10.35"), 'count': 2},
+            {'seller_id': self.sellers[1].id, 'amount': Decimal("7.00"), 'count': 1},
+        ])
+        by_day = analytics.totals_by_day()
+        self.assertEqual([row['amount'] for row in by_day], [Decimal("7.00"), Decimal("10.35")])
+        by_prefix = analytics.totals_by_phone_prefix(4)
+        self.assertEqual(by_prefix, [
+            {'prefix': '0912', 'amount': Decimal("17.25"), 'count': 2},
+            {'prefix': '0935', 'amount': Decimal("0.10"), 'count': 1},
+        ])
+        logs = analytics.totals_by_seller('credit_logs', since=timezone.now() - timedelta(hours=1))
+        self.assertEqual(logs[0]['amount'], Decimal("89.65"))
+        self.assertEqual(analytics.load('credit_logs')['created_at'].dtype, numpy.dtype('datetime64[us]'))
+
+
+@override_settings(CHARGE_MANAGEMENT={'IDEMPOTENCY_WAIT_SECONDS': 0})
+class IdempotencyKeyTest(TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+        self.user = User.objects.create_user(username="retry", password="pass")
+        self.seller = Seller.objects.create(
+            user=self.user,
+            name="Retrying Seller",
+            email="retry@example.com",
+            phone_number="5550001111",
+            credit=Decimal("100.00")
+        )
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('transaction-create')
+        self.payload = {'phone_number': '09121234567', 'amount': '10.00'}
+
+    def post(self, key, payload=None):
+        return self.client.post(self.url, payload or self.payload, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self):
+        first = self.post('key-1')
+        # The colliding INSERT (in a savepoint) and the key lookup, nothing touches the seller
+        with self.assertNumQueries(5):
+            second = self.post('key-1')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("90.00"))
+
+    def test_key_reused_for_other_payload(self):
+        self.post('key-1')
+        response = self.post('key-1', {'phone_number': '09121234567', 'amount': '20.00'})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_in_flight_duplicate_is_rejected(self):
+        IdempotencyHandler._claim(self._request(), 'key-1', self._hash())
+        response = self.post('key-1')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_abandoned_key_is_taken_over(self):
+        IdempotencyHandler._claim(self._request(), 'key-1', self._hash())
+        IdempotencyKey.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        response = self.post('key-1')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 201)
+
+    def test_request_commits_with_its_stored_response(self):
+        # Storing the response fails after the debit: the debit is rolled back with it
+        with mock.patch.object(IdempotencyKey, 'save', side_effect=OperationalError("connection lost")):
+            with self.assertRaises(OperationalError):
+                self.post('key-1')
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("100.00"))
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.post('key-1').status_code, 201)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_deadlock_retries_the_whole_request(self):
+        withdraw = DebitTransactionHandler.withdraw
+        attempts = []
+
+        def deadlocking_withdraw(*args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise OperationalError("deadlock")
+            return withdraw(*args)
+
+        with mock.patch.object(DebitTransactionHandler, 'withdraw', side_effect=deadlocking_withdraw), \
+                mock.patch('charge_management.idempotency.time.sleep') as sleep, \
+                mock.patch('charge_management.handlers.sleep') as inner_sleep:
+            response = self.post('key-1')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(attempts), 2)  # Once per run of the idempotent unit, no retry inside it
+        sleep.assert_called_once()
+        inner_sleep.assert_not_called()
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("90.00"))
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 201)
+
+        with mock.patch.object(DebitTransactionHandler, 'withdraw', side_effect=OperationalError("deadlock")), \
+                mock.patch('charge_management.idempotency.time.sleep'):
+            with self.assertRaises(OperationalError):
+                self.post('key-2')
+        self.assertFalse(IdempotencyKey.objects.filter(key='key-2').exists())  # Released for a retry
+
+    def test_failed_request_releases_key(self):
+        response = self.post('key-1', {'phone_number': '09999999999', 'amount': '10.00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_purge_expired(self):
+        self.post('key-1')
+        self.post('key-2')
+        IdempotencyKey.objects.filter(key='key-1').update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(IdempotencyHandler.purge_expired(), 1)
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['key-2'])
+
+    def _request(self):
+        return mock.Mock(user=self.user, path=self.url)
+
+    def _hash(self):
+        # Same bytes as the body APIClient sends
+        return hashlib.sha256(JSONRenderer().render(self.payload)).hexdigest()
+
+
+@override_settings(CHARGE_MANAGEMENT={'CREDIT_LOG_OUTBOX': True, 'RECONCILIATION_SETTLE_SECONDS': 0})
+class CreditLogOutboxTest(TestCase):
+    def setUp(self):
+        self.seller = Seller.objects.create(
+            user=User.objects.create_user(username="outbox", password="pass"),
+            name="Outbox Seller",
+            email="outbox@example.com",
+            phone_number="3213213210",
+        )
+        CreditTransactionHandler.add_credit(self.seller.id, Decimal("100.00"))
+
+    def test_debit_commits_outbox_row_and_drainer_moves_it(self):
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("25.00"))
+        self.assertFalse(CreditLog.objects.exists())
+        pending = list(CreditLogOutbox.objects.order_by('id'))
+        self.assertEqual(OutboxDrainer.lag()['pending'], 2)
+
+        drainer = OutboxDrainer(batch_size=1)
+        self.assertEqual(drainer.drain(), 2)
+
+        logs = list(CreditLog.objects.order_by('id'))
+        self.assertEqual([log.amount for log in logs], [Decimal("100.00"), Decimal("-25.00")])
+        self.assertEqual([log.created_at for log in logs], [row.created_at for row in pending])
+        self.assertEqual(logs[1].balance_snapshot, Decimal("75.00"))
+        self.assertFalse(CreditLogOutbox.objects.exists())
+        self.assertEqual(drainer.metrics()['drained'], 2)
+
+    def test_reconciliation_counts_pending_entries(self):
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("25.00"))
+        self.assertEqual(LedgerReconciliationHandler.verify(), [])
+        OutboxDrainer().drain()
+        LedgerReconciliationHandler.roll_up()
+        self.assertEqual(LedgerReconciliationHandler.verify(), [])
+
+    def test_backlog_over_limit_refuses_debits(self):
+        with override_settings(CHARGE_MANAGEMENT={'CREDIT_LOG_OUTBOX': True, 'OUTBOX_MAX_PENDING': 1}):
+            CreditLogOutbox.objects.create(seller=self.seller, amount=1, balance_snapshot=1, description="backlog")
+            CreditLogWriter._checked_at = None  # Force a fresh backlog count
+            self.seller.refresh_from_db()
+            client = APIClient()
+            client.force_authenticate(self.seller.user)
+            PhoneNumber.objects.create(phone_number="09121234567")
+            get_phone_cache().clear()
+            response = client.post(reverse('transaction-create'),
+                                   {'phone_number': '09121234567', 'amount': '10.00'}, format='json')
+            # Money coming in is never refused
+            self.assertTrue(CreditTransactionHandler.add_credit(self.seller.id, Decimal("5.00"))['success'])
+            credit_request = CreditRequest.objects.create(seller=self.seller, amount=Decimal("7.00"))
+            admin = User.objects.create_superuser(username="outbox-admin")
+            self.assertEqual(CreditApprovalHandler.approve_requests([credit_request.id], admin)[0]['status'],
+                             CreditApprovalHandler.APPROVED)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(CreditLogOutbox.objects.filter(amount__in=[Decimal("5.00"), Decimal("7.00")]).count(), 2)
+
+
+class BenchmarkHarnessTest(TestCase):
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.95), 0.0)
+
+    def test_inline_run_reports_scenarios_and_keeps_invariants(self):
+        get_phone_cache().clear()
+        runner = BenchmarkRunner(requests=30, concurrency=1, sellers=3, seed=7, host='testserver')
+        result = runner.run()
+
+        self.assertEqual(result['total']['requests'], 30)
+        self.assertEqual(result['total']['errors'], 0)
+        self.assertTrue(result['invariants']['ok'], result['invariants']['violations'])
+        self.assertGreater(result['scenarios']['transactions']['queries_per_request'], 0)
+        self.assertFalse(Seller.objects.exists())  # Benchmark data is removed afterwards
+
+
+@override_settings(CHARGE_MANAGEMENT={'OPERATOR_POOL_SIZE': 0, 'FAKE_OPERATOR_LATENCY': 0})
+class RechargeReservationTest(TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="reserver")
+        self.seller = Seller.objects.create(user=self.user, name="Reserver", email="reserver@example.com",
+                                            phone_number="09120000060", credit=Decimal("100.00"))
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def reserve(self, amount='30.00'):
+        with self.captureOnCommitCallbacks(execute=True):  # Inline dispatch once the hold commits
+            response = self.client.post(reverse('recharge-reserve'), {'phone_number': '09121234567', 'amount': amount},
+                                        format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], Transaction.RESERVED)
+        return Transaction.objects.get(id=response.data['id'])
+
+    def test_confirmed_top_up_captures_the_hold(self):
+        recharge = self.reserve()
+        self.seller.refresh_from_db()
+        self.assertEqual(recharge.status, Transaction.CAPTURED)
+        self.assertEqual(recharge.operator_reference, f'fake-recharge-{recharge.id}')
+        self.assertEqual((self.seller.credit, self.seller.held), (Decimal("70.00"), Decimal("0.00")))
+        self.assertEqual(list(CreditLog.objects.values_list('amount', 'balance_snapshot')),
+                         [(Decimal("-30.00"), Decimal("70.00"))])
+
+        response = self.client.get(reverse('recharge-detail', args=[recharge.id]))
+        self.assertEqual(response.data['status'], Transaction.CAPTURED)
+
+    @override_settings(CHARGE_MANAGEMENT={'OPERATOR_POOL_SIZE': 0, 'FAKE_OPERATOR_LATENCY': 0,
+                                          'FAKE_OPERATOR_FAILURE_RATE': 1})
+    def test_rejected_top_up_releases_the_hold(self):
+        recharge = self.reserve()
+        self.seller.refresh_from_db()
+        self.assertEqual(recharge.status, Transaction.RELEASED)
+        self.assertEqual((self.seller.credit, self.seller.held), (Decimal("100.00"), Decimal("0.00")))
+        self.assertEqual(sum(CreditLog.objects.values_list('amount', flat=True)), 0)
+        self.assertEqual(CreditLog.objects.latest('id').balance_snapshot, Decimal("100.00"))
+
+    @override_settings(CHARGE_MANAGEMENT={'OPERATOR_POOL_SIZE': 0, 'FAKE_OPERATOR_LATENCY': 5,
+                                          'OPERATOR_TIMEOUT': 0.01})
+    def test_operator_timeout_releases_the_hold(self):
+        recharge = self.reserve()
+        self.assertEqual(recharge.status, Transaction.RELEASED)
+        self.assertEqual(get_registry().counter('charge_operator_calls_total', outcome='timeout'), 1)
+
+    def test_expired_holds_are_released_and_late_answers_are_not_captured(self):
+        with self.captureOnCommitCallbacks(execute=False):  # Never dispatched, e.g. the process died
+            response = self.client.post(reverse('recharge-reserve'),
+                                        {'phone_number': '09121234567', 'amount': '40.00'}, format='json')
+        recharge = Transaction.objects.get(id=response.data['id'])
+        self.seller.refresh_from_db()
+        self.assertEqual((self.seller.credit, self.seller.held), (Decimal("60.00"), Decimal("40.00")))
+        self.assertEqual(RechargeReservationHandler.release_expired(), 0)
+
+        dispatched = RechargeReservationHandler.mark_dispatched(recharge.id)
+        self.assertIsNone(RechargeReservationHandler.mark_dispatched(recharge.id))  # Claimed once
+        # Past the hold and the operator timeout: the operator call has given up by now
+        Transaction.objects.filter(id=recharge.id).update(hold_expires_at=timezone.now() - timedelta(seconds=11))
+        self.assertEqual(OperatorDispatcher(FakeOperatorClient(0, 0), pool_size=0).sweep(), (1, 0))
+        self.assertFalse(RechargeReservationHandler.capture(dispatched, 'late'))
+        self.seller.refresh_from_db()
+        self.assertEqual((self.seller.credit, self.seller.held), (Decimal("100.00"), Decimal("0.00")))
+
+    @override_settings(CHARGE_MANAGEMENT={'OPERATOR_TIMEOUT': 10})
+    def test_claim_near_expiry_then_sweep(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            response = self.client.post(reverse('recharge-reserve'),
+                                        {'phone_number': '09121234567', 'amount': '40.00'}, format='json')
+        recharge = Transaction.objects.get(id=response.data['id'])
+
+        # The hold would expire before an operator call times out: not claimed, released once expired
+        Transaction.objects.filter(id=recharge.id).update(hold_expires_at=timezone.now() + timedelta(seconds=5))
+        self.assertIsNone(RechargeReservationHandler.mark_dispatched(recharge.id))
+        self.assertEqual(Transaction.objects.get(id=recharge.id).status, Transaction.RESERVED)
+
+        # A claimed recharge whose hold just expired may still be at the operator: not released yet
+        Transaction.objects.filter(id=recharge.id).update(hold_expires_at=timezone.now() + timedelta(seconds=60))
+        dispatched = RechargeReservationHandler.mark_dispatched(recharge.id)
+        Transaction.objects.filter(id=recharge.id).update(hold_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(OperatorDispatcher(FakeOperatorClient(0, 0), pool_size=0).sweep(), (0, 0))
+        self.assertTrue(RechargeReservationHandler.capture(dispatched, 'on-time'))
+        self.seller.refresh_from_db()
+        self.assertEqual((self.seller.credit, self.seller.held), (Decimal("60.00"), Decimal("0.00")))
+
+    def test_sweep_dispatches_leftover_reservations(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            response = self.client.post(reverse('recharge-reserve'),
+                                        {'phone_number': '09121234567', 'amount': '10.00'}, format='json')
+        dispatcher = OperatorDispatcher(FakeOperatorClient(0, 0), pool_size=0)
+        self.assertEqual(dispatcher.sweep(), (0, 0))  # Too recent, still on its way to a worker
+        self.assertEqual(dispatcher.sweep(older_than=-1), (0, 1))
+        self.assertEqual(Transaction.objects.get(id=response.data['id']).status, Transaction.CAPTURED)
+
+    def test_reservation_needs_credit_and_only_shows_own_recharges(self):
+        response = self.client.post(reverse('recharge-reserve'), {'phone_number': '09121234567', 'amount': '150.00'},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        recharge = self.reserve()
+        other = User.objects.create_user(username="reserver-other")
+        Seller.objects.create(user=other, name="Other", email="reserver-other@example.com", phone_number="09120000061")
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(other)}")
+        self.assertEqual(self.client.get(reverse('recharge-detail', args=[recharge.id])).status_code, 404)
+
+    def test_benchmark_settles_reservations(self):
+        runner = BenchmarkRunner(requests=20, concurrency=1, sellers=2, seed=3, host='testserver',
+                                 mix={'reservations': 1}, operator_latency=0, operator_failure_rate=0.5)
+        result = runner.run()
+        self.assertEqual(result['scenarios']['reservations']['status_codes'], {'202': 20})
+        settlement = result['settlement']
+        self.assertEqual((settlement['captured'] + settlement['released'], settlement['unsettled']), (20, 0))
+        self.assertTrue(result['invariants']['ok'], result['invariants']['violations'])
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        get_registry().clear()
+        get_phone_cache().clear()
+        user = User.objects.create_user(username="instrumented")
+        self.seller = Seller.objects.create(user=user, name="Instrumented", email="instrumented@example.com",
+                                            phone_number="09120000010", credit=Decimal("100.00"))
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def recharge(self):
+        return self.client.post(reverse('transaction-create'),
+                                {'phone_number': '09121234567', 'amount': '10.00'}, format='json')
+
+    def test_recharge_stages_are_exposed_on_metrics_endpoint(self):
+        self.assertEqual(self.recharge().status_code, 201)
+        with override_settings(CHARGE_MANAGEMENT={'METRICS_TOKEN': 'secret'}):
+            metrics = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').content.decode()
+
+        for name in ('validate', 'phone_lookup', 'debit_update', 'transaction_insert', 'credit_log'):
+            self.assertIn(f'charge_stage_duration_seconds_count{{stage="{name}"}} 1', metrics)
+        self.assertIn('charge_requests_total{method="POST",status="201",view="transaction-create"} 1', metrics)
+        self.assertIn('charge_request_queries_count{method="POST",view="transaction-create"} 1', metrics)
+
+    def test_phone_cache_lookups_are_exposed_on_metrics_endpoint(self):
+        self.recharge()  # Miss, then cached
+        self.recharge()
+        with override_settings(CHARGE_MANAGEMENT={'METRICS_TOKEN': 'secret'}):
+            metrics = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').content.decode()
+
+        self.assertIn('# TYPE charge_phone_cache_lookups_total counter', metrics)
+        self.assertIn('charge_phone_cache_lookups_total{result="miss"} 1', metrics)
+        self.assertIn('charge_phone_cache_lookups_total{result="hit"} 1', metrics)
+
+    def test_metrics_token(self):
+        with override_settings(CHARGE_MANAGEMENT={'METRICS_TOKEN': 'secret'}):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    def test_metrics_without_token_are_staff_only(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.client.force_login(User.objects.create_user(username="metrics-staff", is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_slow_request_log_includes_stage_breakdown(self):
+        with override_settings(CHARGE_MANAGEMENT={'SLOW_REQUEST_THRESHOLD': 0, 'SLOW_REQUEST_SAMPLE_RATE': 1}):
+            with self.assertLogs('charge_management.slow_requests', 'WARNING') as logs:
+                self.recharge()
+        self.assertIn('"debit_update"', logs.output[0])
+        self.assertIn('"queries"', logs.output[0])
+
+    def test_debit_retries_are_counted(self):
+        attempts = []
+
+        def operation():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise OperationalError("deadlock")
+            return True
+
+        with mock.patch('charge_management.handlers.sleep'):
+            DebitTransactionHandler.run_with_retries(operation)
+        self.assertEqual(get_registry().counter('charge_retries_total', operation='debit'), 1)
+
+
+class QueryBudgetTest(TestCase):
+    """
+    Per-endpoint query budgets, with real JWT authentication on a cold cache (one query for
+    the user and their seller).
+    """
+
+    def setUp(self):
+        get_phone_cache().clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="budget")
+        self.seller = Seller.objects.create(user=self.user, name="Budget", email="budget@example.com",
+                                            phone_number="09120000020", credit=Decimal("100.00"))
+        self.admin = User.objects.create_superuser(username="budget-admin", password="secret")
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_credit_balance(self):
+        with self.assertNumQueries(2):  # user with seller, balance
+            response = self.client.get(reverse('credit_balance_view'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_recharge(self):
+        # user with seller, phone number, balance, savepoint, UPDATE, balance, INSERT transaction, INSERT log,
+        # upsert daily stats, upsert phone stats, release
+        with self.assertNumQueries(11):
+            response = self.client.post(reverse('transaction-create'),
+                                        {'phone_number': '09121234567', 'amount': '10.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_credit_request(self):
+        with self.assertNumQueries(2):  # user with seller, INSERT
+            response = self.client.post(reverse('credit-request-create'), {'amount': '10.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_approval(self):
+        credit_request = CreditRequest.objects.create(seller=self.seller, amount=Decimal("10.00"))
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.admin)}")
+        # user, request, savepoint, seller lock, request lock, UPDATE seller, INSERT log, upsert daily stats,
+        # UPDATE request, release
+        with self.assertNumQueries(10):
+            response = self.client.post(reverse('credit-request-approve', args=[credit_request.pk]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_credit_log_list(self):
+        for _ in range(5):
+            CreditTransactionHandler.add_credit(self.seller.id, Decimal("1.00"))
+        with self.assertNumQueries(2):  # user with seller, page
+            response = self.client.get(reverse('credit-log-list'))
+        self.assertEqual(len(response.json()['results']), 5)
+
+    def test_admin_changelists_do_not_query_per_row(self):
+        self.client.force_login(self.admin)
+        for name in ('creditrequest', 'transaction', 'creditlog'):
+            url = reverse(f'admin:charge_management_{name}_changelist')
+            counts = []
+            for _ in range(2):
+                CreditRequest.objects.create(seller=self.seller, amount=Decimal("1.00"), approved_by=self.admin)
+                Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("1.00"))
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                counts.append(len(queries))
+            self.assertEqual(counts[0], counts[1], name)
+
+
+class QueryPlanTest(QueryPlanAssertionsMixin, TestCase):
+    """
+    Every query of the hot endpoints must reach the large tables through an index.
+    """
+
+    def setUp(self):
+        get_phone_cache().clear()
+        cache.clear()
+        self.user = User.objects.create_user(username="plans")
+        self.seller = Seller.objects.create(user=self.user, name="Plans", email="plans@example.com",
+                                            phone_number="09120000090", credit=Decimal("100.00"))
+        self.admin = User.objects.create_superuser(username="plans-admin", password="secret")
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_seller_endpoints(self):
+        for index in range(3):
+            CreditTransactionHandler.add_credit(self.seller.id, Decimal("1.00"))
+        with self.assertNoFullScans():
+            self.client.get(reverse('credit_balance_view'))
+            self.client.post(reverse('transaction-create'), {'phone_number': '09121234567', 'amount': '1.00'},
+                             format='json')
+            self.client.post(reverse('transaction-bulk-create'), {'transactions': [
+                {'phone_number': '09121234567', 'amount': '1.00'}]}, format='json')
+            self.client.post(reverse('credit-request-create'), {'amount': '10.00'}, format='json')
+            response = self.client.get(reverse('credit-log-list') + '?page_size=2')
+            self.client.get(response.data['next'])
+
+    def test_admin_endpoints(self):
+        credit_request = CreditRequest.objects.create(seller=self.seller, amount=Decimal("10.00"))
+        CreditRequest.objects.create(seller=self.seller, amount=Decimal("20.00"))
+        Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("1.00"))
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.admin)}")
+        self.client.force_login(self.admin)
+        with self.assertNoFullScans():
+            self.client.post(reverse('credit-request-approve', args=[credit_request.pk]))
+            self.client.get(reverse('credit-log-list', kwargs={'seller_id': self.seller.id}))
+            response = self.client.get(reverse('admin:charge_management_transaction_changelist') + '?q=09121234567')
+            self.assertContains(response, '09121234567')
+            response = self.client.get(reverse('admin:charge_management_creditrequest_changelist') + '?is_approved=0')
+            self.assertContains(response, '1 credit request')
+            self.assertContains(response, '20.00')
+
+    def test_recorder_reports_full_scans(self):
+        recorder = QueryPlanRecorder()
+        with recorder.record():
+            CreditLog.objects.filter(description="unindexed").exists()
+            CreditLog.objects.filter(seller=self.seller).exists()
+        scans = recorder.full_scans()
+        self.assertEqual(len(recorder.plans), 2)
+        self.assertEqual([table for table, _, _ in scans], [CreditLog._meta.db_table])
+
+
+class SellerListTest(QueryPlanAssertionsMixin, TestCase):
+    SELLERS = 100000
+
+    @classmethod
+    def setUpTestData(cls):
+        # Plain executemany() INSERTs: bulk_create() takes most of a minute for 200k rows on SQLite
+        now = timezone.now()
+        cls.insert(User, ['username', 'password', 'first_name', 'last_name', 'email', 'is_superuser', 'is_staff',
+                          'is_active', 'date_joined'],
+                   ([f"list-{index}", '!', '', '', '', False, False, True, now] for index in range(cls.SELLERS)))
+        user_ids = User.objects.filter(username__startswith="list-").values_list('username', 'id')
+        user_ids = {int(username[5:]): pk for username, pk in user_ids}
+        cls.insert(Seller, ['user_id', 'name', 'email', 'phone_number', 'credit', 'credit_shards', 'held',
+                            'created_at', 'updated_at'],
+                   ([user_ids[index], f"Seller {index:06d}", f"list-{index}@example.com", f"0913{index:07d}",
+                     Decimal(index % 1000), 0, Decimal(0), now, now] for index in range(cls.SELLERS)))
+        cls.admin = User.objects.create_superuser(username="list-admin")
+
+    @staticmethod
+    def insert(model, names, rows):
+        fields = [model._meta.get_field(name) for name in names]
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        sql = (f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} ({columns}) "
+               f"VALUES ({', '.join(['%s'] * len(fields))})")
+        prepared = {}  # Few distinct values need a conversion (decimals, datetimes, booleans)
+
+        def prepare(field, value):
+            if isinstance(value, str) or type(value) is int:
+                return value
+            key = (field.name, value)
+            if key not in prepared:
+                prepared[key] = field.get_db_prep_save(value, connection)
+            return prepared[key]
+
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [[prepare(field, value) for field, value in zip(fields, row)] for row in rows])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_pages_take_one_query_and_stay_small(self):
+        url = reverse('seller-list-create')
+        seen = set()
+        for _ in range(3):
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(len(response.data['results']), 100)
+            self.assertLess(len(response.content), 30000)  # One page, whatever the number of sellers
+            seen |= {row['id'] for row in response.data['results']}
+            url = response.data['next']
+        self.assertEqual(len(seen), 300)
+
+        row = response.data['results'][0]
+        self.assertEqual(row, SellerSerializer(Seller.objects.get(id=row['id'])).data)
+
+    def test_filters_and_credit_sort_are_served_by_indexes(self):
+        url = reverse('seller-list-create')
+        with self.assertNoFullScans(tables=[Seller._meta.db_table]):
+            response = self.client.get(url, {'name': 'Seller 00001'})
+            self.assertEqual(sorted(row['name'] for row in response.data['results']),
+                             [f"Seller {index:06d}" for index in range(10, 20)])
+            response = self.client.get(url, {'email': 'list-42@example.com'})
+            self.assertEqual([row['phone_number'] for row in response.data['results']], ["09130000042"])
+            response = self.client.get(url, {'phone_number': '09130000042'})
+            self.assertEqual(len(response.data['results']), 1)
+
+            response = self.client.get(url, {'credit_min': '10', 'credit_max': '10.50', 'ordering': 'credit',
+                                             'page_size': 60})
+            ids = [row['id'] for row in response.data['results']]
+            response = self.client.get(response.data['next'])
+            ids += [row['id'] for row in response.data['results']]
+            self.assertEqual({row['credit'] for row in response.data['results']}, {'10.00'})
+            self.assertIsNone(response.data['next'])
+            self.assertEqual(ids, sorted(set(ids)))  # 100 sellers hold 10.00, in id order
+            self.assertEqual(len(ids), 100)
+
+        # The first page walks the index from its end and stops at the page size
+        response = self.client.get(url, {'ordering': '-credit', 'page_size': 1000})
+        credits = [Decimal(row['credit']) for row in response.data['results']]
+        with self.assertNoFullScans(tables=[Seller._meta.db_table]):
+            response = self.client.get(response.data['next'])
+        credits += [Decimal(row['credit']) for row in response.data['results']]
+        self.assertEqual(len(credits), 2000)
+        self.assertEqual(credits, sorted(credits, reverse=True))
+        self.assertEqual(credits[0], Decimal("999.00"))
+
+    def test_sharded_sellers_are_filtered_and_sorted_by_their_total(self):
+        url = reverse('seller-list-create')
+        seller = Seller.objects.get(phone_number="09130000042")
+        ShardedBalanceHandler.configure(seller.id, 4)
+        with self.assertNumQueries(1):
+            row, = self.client.get(url, {'email': 'list-42@example.com'}).data['results']
+        self.assertEqual((row['credit'], row['total_credit']), ("0.00", "42.00"))
+        self.assertEqual(row, SellerSerializer(Seller.objects.get(id=seller.id)).data)
+
+        ids = {row['id'] for row in self.client.get(url, {'credit_max': '0', 'page_size': 1000}).data['results']}
+        self.assertNotIn(seller.id, ids)  # Its reserve is 0, its total is not
+        with self.assertNoFullScans(tables=[Seller._meta.db_table]):
+            response = self.client.get(url, {'credit_min': '41', 'credit_max': '42', 'ordering': '-credit',
+                                             'page_size': 150})
+            rows = response.data['results']
+            rows += self.client.get(response.data['next']).data['results']
+        self.assertEqual(len(rows), 200)
+        self.assertEqual([row['total_credit'] for row in rows], ["42.00"] * 100 + ["41.00"] * 100)
+        self.assertIn(seller.id, [row['id'] for row in rows[:100]])
+        self.assertEqual([row['id'] for row in rows[:100]], sorted((row['id'] for row in rows[:100]), reverse=True))
+
+    def test_invalid_parameters(self):
+        url = reverse('seller-list-create')
+        self.assertEqual(self.client.get(url, {'ordering': 'email'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'credit_min': 'lots'}).status_code, 400)
+        for value in ('NaN', 'sNaN', 'Infinity', '-inf'):
+            self.assertEqual(self.client.get(url, {'credit_max': value}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cursor': 'bogus'}).status_code, 404)
+        cursor = self.client.get(url, {'ordering': 'credit'}).data['next'].split('cursor=')[1]
+        self.assertEqual(self.client.get(url, {'cursor': cursor}).status_code, 404)  # Other ordering
+        for value in ('NaN', 'Infinity', '-Infinity'):
+            cursor = base64.urlsafe_b64encode(json.dumps(['credit', value, 1]).encode()).decode()
+            self.assertEqual(self.client.get(url, {'ordering': 'credit', 'cursor': cursor}).status_code, 404)
+
+
+class SellerStatsTest(QueryPlanAssertionsMixin, TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+        user = User.objects.create_user(username="stats")
+        self.seller = Seller.objects.create(user=user, name="Stats", email="stats@example.com",
+                                            phone_number="09120000040", credit=Decimal("1000.00"))
+        PhoneNumber.objects.bulk_create([PhoneNumber(phone_number=f"0912123456{i}") for i in range(3)])
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.today = timezone.localdate()
+
+    def stats(self, **params):
+        return self.client.get(reverse('seller-stats'), params)
+
+    def counters(self):
+        return SellerDailyStats.objects.filter(seller=self.seller).aggregate(
+            spent=models.Sum('spent'), transactions=models.Sum('transaction_count'),
+            credited=models.Sum('credited'), credits=models.Sum('credit_count'))
+
+    def test_debits_and_credits_update_the_counters(self):
+        Transaction.objects.create(seller=self.seller, phone_number="09121234560", amount=Decimal("10.00"))
+        Transaction.objects.create(seller=self.seller, phone_number="09121234560", amount=Decimal("5.00"))
+        Transaction.objects.create(seller=self.seller, phone_number="09121234561", amount=Decimal("20.00"))
+        CreditTransactionHandler.add_credit(self.seller.id, Decimal("50.00"))
+
+        self.assertEqual(self.counters(), {'spent': Decimal("35.00"), 'transactions': 3,
+                                           'credited': Decimal("50.00"), 'credits': 1})
+        phone = SellerDailyPhoneStats.objects.get(seller=self.seller, phone_number="09121234560")
+        self.assertEqual((phone.day, phone.amount, phone.transaction_count), (self.today, Decimal("15.00"), 2))
+
+    def test_failed_debits_are_not_counted(self):
+        with self.assertRaises(ValueError):
+            Transaction.objects.create(seller=self.seller, phone_number="09121234560", amount=Decimal("5000.00"))
+        self.assertFalse(SellerDailyStats.objects.exists())
+
+    def test_bulk_recharges_and_approvals(self):
+        BulkTransactionHandler.create_bulk(self.seller, [
+            {'phone_number': "09121234560", 'amount': Decimal("10.00")},
+            {'phone_number': "09121234561", 'amount': Decimal("15.00")},
+            {'phone_number': "09121234560", 'amount': Decimal("1.00")},
+        ])
+        admin_user = User.objects.create_superuser(username="stats-admin")
+        ids = [CreditRequest.objects.create(seller=self.seller, amount=Decimal(amount)).id for amount in ("20", "30")]
+        CreditApprovalHandler.approve_requests(ids, admin_user)
+
+        self.assertEqual(self.counters(), {'spent': Decimal("26.00"), 'transactions': 3,
+                                           'credited': Decimal("50.00"), 'credits': 2})
+        self.assertEqual(SellerDailyPhoneStats.objects.get(phone_number="09121234560").transaction_count, 2)
+
+    def test_released_recharges_are_taken_back_out(self):
+        recharge = RechargeReservationHandler.reserve(self.seller, "09121234562", Decimal("30.00"))
+        self.assertEqual(self.counters()['spent'], Decimal("30.00"))
+
+        RechargeReservationHandler.release(recharge, "rejected by the operator")
+
+        self.assertEqual(self.counters()['spent'], Decimal("0.00"))
+        self.assertEqual(self.counters()['transactions'], 0)
+        self.assertEqual(self.stats().data['top_phone_numbers'], [])
+
+    def test_sharded_sellers_spread_over_slots(self):
+        ShardedBalanceHandler.configure(self.seller.id, 4)
+        self.seller.refresh_from_db()
+        for _ in range(20):
+            Transaction.objects.create(seller=self.seller, phone_number="09121234560", amount=Decimal("1.00"))
+
+        self.assertGreater(SellerDailyStats.objects.filter(seller=self.seller).count(), 1)
+        self.assertEqual(self.stats().data['totals']['spent'], "20.00")
+
+    def test_endpoint_reads_the_range_from_the_counters(self):
+        for days_ago, phone_number, amount in [(0, "09121234560", "10.00"), (2, "09121234561", "40.00"),
+                                               (2, "09121234560", "5.00"), (9, "09121234562", "100.00")]:
+            SellerStatsRecorder.record_debits(self.seller.id, self.today - timedelta(days=days_ago),
+                                              [(phone_number, Decimal(amount))])
+        start = self.today - timedelta(days=6)
+
+        with self.assertNoFullScans(tables=[SellerDailyStats._meta.db_table, SellerDailyPhoneStats._meta.db_table]):
+            with self.assertNumQueries(2):  # days, top phone numbers
+                response = self.stats(start=start.isoformat(), end=self.today.isoformat(), top=1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['totals'], {'spent': "55.00", 'transaction_count': 3,
+                                                   'credited': "0.00", 'credit_count': 0})
+        self.assertEqual(len(response.data['days']), 7)
+        self.assertEqual(response.data['days'][4], {'day': (self.today - timedelta(days=2)).isoformat(),
+                                                    'spent': "45.00", 'transaction_count': 2,
+                                                    'credited': "0.00", 'credit_count': 0})
+        self.assertEqual(response.data['top_phone_numbers'],
+                         [{'phone_number': "09121234561", 'amount': "40.00", 'transaction_count': 1}])
+        self.assertEqual(len(self.stats().data['days']), 30)
+
+    def test_invalid_ranges(self):
+        self.assertEqual(self.stats(start=self.today.isoformat(),
+                                    end=(self.today - timedelta(days=1)).isoformat()).status_code, 400)
+        self.assertEqual(self.stats(start=(self.today - timedelta(days=400)).isoformat()).status_code, 400)
+        self.assertEqual(self.stats(start="yesterday").status_code, 400)
+
+    def test_rebuild_matches_the_incremental_counters(self):
+        Transaction.objects.create(seller=self.seller, phone_number="09121234560", amount=Decimal("10.00"))
+        BulkTransactionHandler.create_bulk(self.seller, [
+            {'phone_number': "09121234561", 'amount': Decimal("15.00")},
+            {'phone_number': "09121234560", 'amount': Decimal("1.00")},
+        ])
+        RechargeReservationHandler.release(
+            RechargeReservationHandler.reserve(self.seller, "09121234562", Decimal("30.00")), "operator error")
+        expected = self.stats().data
+
+        call_command('rebuild_seller_stats', stdout=io.StringIO())
+
+        self.assertEqual(self.stats().data, expected)
+
+
+class CachedAuthenticationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="cached-auth", password="secret")
+        self.seller = Seller.objects.create(user=self.user, name="Cached", email="cached@example.com",
+                                            phone_number="09120000080", credit=Decimal("50.00"))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_warm_requests_need_no_authentication_queries(self):
+        self.client.get(reverse('credit_balance_view'))
+        with self.assertNumQueries(0):  # User, seller and balance all cached
+            response = self.client.get(reverse('credit_balance_view'))
+        self.assertEqual(response.data['current_balance'], Decimal("50.00"))
+        with self.assertNumQueries(1):  # page
+            self.client.get(reverse('credit-log-list'))
+
+    def test_balance_fields_are_never_served_from_the_cache(self):
+        self.client.get(reverse('credit-log-list'))
+        Seller.objects.filter(id=self.seller.id).update(credit=Decimal("20.00"))  # No signal
+        get_phone_cache().clear()
+        PhoneNumber.objects.create(phone_number="09121234567")
+        response = self.client.post(reverse('transaction-create'), {'phone_number': '09121234567', 'amount': '30.00'},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('phone_number', response.data)
+        self.assertEqual(Seller.objects.get(id=self.seller.id).credit, Decimal("20.00"))
+
+    def test_user_changes_reach_authentication_at_once(self):
+        self.client.get(reverse('credit-log-list'))
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('credit-log-list')).status_code, 401)
+
+    def test_users_cached_before_commit_are_dropped(self):
+        self.client.get(reverse('credit-log-list'))
+        committed = CachedJWTAuthentication().load_user(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+            # A concurrent request still reads the committed, active user and caches it
+            CachedJWTAuthentication.cache_user(self.user.pk, committed)
+        self.assertEqual(self.client.get(reverse('credit-log-list')).status_code, 401)
+
+    def test_token_carries_the_seller_id(self):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'cached-auth', 'password': 'secret'},
+                                    format='json')
+        self.assertEqual(AccessToken(response.data['access'])['seller_id'], self.seller.id)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.client.get(reverse('credit-log-list'))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('credit-log-list'))
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_stale_seller_id_claim_falls_back_to_the_users_seller(self):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'cached-auth', 'password': 'secret'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        CreditTransactionHandler.add_credit(self.seller.id, Decimal("5.00"))
+        self.assertEqual(len(self.client.get(reverse('credit-log-list')).data['results']), 1)
+
+        # The seller moves to another user; the token still claims it until it expires
+        self.seller.user = User.objects.create_user(username="cached-auth-other")
+        self.seller.save()
+        self.assertEqual(self.client.get(reverse('credit-log-list')).status_code, 404)
+
+        Seller.objects.create(user=self.user, name="Replacement", email="replacement@example.com",
+                              phone_number="09120000081")
+        response = self.client.get(reverse('credit-log-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [])
+
+@override_settings(CHARGE_MANAGEMENT={'READ_REPLICAS': ['replica']})
+class ReadReplicaTest(TransactionTestCase):
+    # Committed data, so the replica connection (a mirror of the test database) sees it
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        monitor.forget()
+        self.user = User.objects.create_user(username="replica")
+        self.seller = Seller.objects.create(user=self.user, name="Replica", email="replica@example.com",
+                                            phone_number="09120000070", credit=Decimal("100.00"))
+        PhoneNumber.objects.create(phone_number="09121234567")
+        CreditTransactionHandler.add_credit(self.seller.id, Decimal("5.00"))
+        cache.clear()  # Drop the pin of the credit above
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def log_queries(self, request):
+        # The credit log queries the request ran on each alias
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = request()
+        self.assertEqual(response.status_code, 200)
+        table = CreditLog._meta.db_table
+        return ([query for query in primary if table in query['sql']],
+                [query for query in replica if table in query['sql']])
+
+    def test_log_list_reads_from_the_replica(self):
+        primary, replica = self.log_queries(lambda: self.client.get(reverse('credit-log-list')))
+        self.assertEqual(len(primary), 0)
+        self.assertEqual(len(replica), 1)
+
+    def test_reads_follow_the_sellers_own_writes_to_the_primary(self):
+        response = self.client.post(reverse('transaction-create'), {'phone_number': '09121234567', 'amount': '1.00'},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        primary, replica = self.log_queries(lambda: self.client.get(reverse('credit-log-list')))
+        self.assertEqual((len(primary), len(replica)), (1, 0))
+        self.assertEqual(len(self.client.get(reverse('credit-log-list')).data['results']), 2)
+
+        # Other sellers' reads still go to the replica
+        other = Seller.objects.create(user=User.objects.create_user(username="replica-other"), name="Other",
+                                      email="other@example.com", phone_number="09120000071")
+        admin_client = APIClient()
+        admin_client.force_authenticate(User.objects.create_superuser(username="replica-admin"))
+        primary, replica = self.log_queries(
+            lambda: admin_client.get(reverse('credit-log-list', kwargs={'seller_id': other.id})))
+        self.assertEqual((len(primary), len(replica)), (0, 1))
+
+    def test_lagging_or_unreachable_replicas_are_skipped(self):
+        with mock.patch.object(monitor, 'measure', return_value=60):
+            primary, replica = self.log_queries(lambda: self.client.get(reverse('credit-log-list')))
+        self.assertEqual((len(primary), len(replica)), (1, 0))
+
+        monitor.forget()
+        with mock.patch.object(monitor, 'measure', side_effect=OperationalError("gone")):
+            primary, replica = self.log_queries(lambda: self.client.get(reverse('credit-log-list')))
+        self.assertEqual((len(primary), len(replica)), (1, 0))
+
+        # Results are kept for REPLICA_CHECK_INTERVAL seconds
+        with mock.patch.object(monitor, 'measure', return_value=0) as measure:
+            self.client.get(reverse('credit-log-list'))
+        measure.assert_not_called()
+
+    def test_writes_and_transactions_stay_on_the_primary(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(CreditLog))
+        with read_from_replica():
+            self.assertEqual(router.db_for_read(CreditLog), 'replica')
+            self.assertEqual(router.db_for_write(CreditLog), 'default')
+        with read_from_replica(), transaction.atomic():
+            self.assertIsNone(router.db_for_read(Seller))  # e.g. select_for_update()
+        self.assertFalse(router.allow_migrate('replica', 'charge_management'))
+
+    def test_admin_changelist_reads_from_the_replica(self):
+        admin_user = User.objects.create_superuser(username="replica-admin", password="secret")
+        self.client.force_login(admin_user)
+        primary, replica = self.log_queries(
+            lambda: self.client.get(reverse('admin:charge_management_creditlog_changelist')))
+        self.assertEqual(len(primary), 0)
+        self.assertGreaterEqual(len(replica), 1)
+
+
+class CreditRequestAdminTest(TestCase):
+    def test_approve_action_records_the_admin(self):
+        admin_user = User.objects.create_superuser(username="approver", password="secret")
+        seller = Seller.objects.create(user=User.objects.create_user(username="requester"), name="Requester",
+                                       email="requester@example.com", phone_number="09120000030")
+        credit_request = CreditRequest.objects.create(seller=seller, amount=Decimal("40.00"))
+        self.client.force_login(admin_user)
+
+        response = self.client.post(reverse('admin:charge_management_creditrequest_changelist'), {
+            'action': 'approve_requests', '_selected_action': [credit_request.pk],
+        })
+
+        self.assertEqual(response.status_code, 302)
+        credit_request.refresh_from_db()
+        seller.refresh_from_db()
+        self.assertTrue(credit_request.is_approved)
+        self.assertEqual(credit_request.approved_by, admin_user)
+        self.assertEqual(seller.credit, Decimal("40.00"))
+
+
+class BalanceCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_phone_cache().clear()
+        self.user = User.objects.create_user(username="poller")
+        self.seller = Seller.objects.create(user=self.user, name="Poller", email="poller@example.com",
+                                            phone_number="09120000040", credit=Decimal("100.00"))
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def balance(self, **headers):
+        return self.client.get(reverse('credit_balance_view'), **headers)
+
+    def test_polls_are_served_from_cache_and_revalidated_with_etag(self):
+        first = self.balance()
+        with self.assertNumQueries(0):
+            second = self.balance()
+            not_modified = self.balance(HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], first['ETag'])
+
+    def test_debit_and_credit_write_through_on_commit(self):
+        etag = self.balance()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('transaction-create'),
+                                        {'phone_number': '09121234567', 'amount': '30.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        with self.assertNumQueries(0):
+            response = self.balance(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(response.json()['current_balance']), Decimal("70.00"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CreditTransactionHandler.add_credit(self.seller.id, Decimal("5.00"))
+        self.assertEqual(Decimal(self.balance().json()['current_balance']), Decimal("75.00"))
+
+    def test_rolled_back_debit_is_not_published(self):
+        self.balance()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError):
+                Transaction.objects.create(seller=self.seller, phone_number="09121234567", amount=Decimal("500.00"))
+        self.assertEqual(Decimal(self.balance().json()['current_balance']), Decimal("100.00"))
+
+    def test_out_of_band_change_is_stale_for_at_most_the_ttl(self):
+        self.balance()
+        Seller.objects.filter(pk=self.seller.pk).update(credit=Decimal("1.00"))  # No signals
+        self.assertEqual(Decimal(self.balance().json()['current_balance']), Decimal("100.00"))
+
+        expired = timezone.now().timestamp() + 31
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))  # As a new request would load it
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=expired):
+            self.assertEqual(Decimal(self.balance().json()['current_balance']), Decimal("1.00"))
+
+    def test_saving_the_seller_invalidates(self):
+        self.balance()
+        self.seller.refresh_from_db()
+        self.seller.credit = Decimal("2.00")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seller.save()
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        self.assertEqual(Decimal(self.balance().json()['current_balance']), Decimal("2.00"))
+
+
+class BulkApprovalTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username="finance", password="secret")
+        self.sellers = [
+            Seller.objects.create(user=User.objects.create_user(username=f"bulk-approval-{index}"),
+                                  name=f"Seller {index}", email=f"bulk-approval-{index}@example.com",
+                                  phone_number=f"0912000005{index}", credit=Decimal("10.00"))
+            for index in range(2)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_requests_are_grouped_per_seller(self):
+        first, second = self.sellers
+        requests = [CreditRequest.objects.create(seller=seller, amount=amount) for seller, amount in [
+            (first, Decimal("5.00")), (second, Decimal("7.00")), (first, Decimal("15.00")),
+        ]]
+        approved = CreditRequest.objects.create(seller=first, amount=Decimal("1.00"), is_approved=True)
+
+        response = self.client.post(reverse('credit-request-bulk-approve'), {
+            'ids': [request.pk for request in requests] + [approved.pk, 999999],
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['approved'], 3)
+        self.assertEqual(Decimal(body['total_amount']), Decimal("27.00"))
+        self.assertEqual([result['status'] for result in body['results']],
+                         ['approved', 'approved', 'approved', 'already_approved', 'not_found'])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.credit, Decimal("30.00"))
+        self.assertEqual(second.credit, Decimal("17.00"))
+        self.assertEqual(list(CreditLog.objects.filter(seller=first).order_by('id').values_list(
+            'amount', 'balance_snapshot')), [(Decimal("5.00"), Decimal("15.00")), (Decimal("15.00"), Decimal("30.00"))])
+        self.assertFalse(CreditRequest.objects.filter(is_approved=False).exists())
+        self.assertEqual(set(CreditRequest.objects.values_list('approved_by', flat=True)), {self.admin.pk, None})
+
+    def test_failing_seller_does_not_affect_the_others(self):
+        first, second = self.sellers
+        requests = [CreditRequest.objects.create(seller=seller, amount=Decimal("5.00")) for seller in self.sellers]
+        write = CreditLogWriter.write
+
+        def failing_write(logs):
+            if logs[0].seller_id == first.pk:
+                raise OperationalError("disk full")
+            return write(logs)
+
+        with mock.patch.object(CreditLogWriter, 'write', side_effect=failing_write):
+            results = CreditApprovalHandler.approve_requests([request.pk for request in requests], self.admin)
+
+        self.assertEqual([result['status'] for result in results], ['failed', 'approved'])
+        first.refresh_from_db()
+        self.assertEqual(first.credit, Decimal("10.00"))
+        self.assertFalse(CreditRequest.objects.get(pk=requests[0].pk).is_approved)
+
+    def test_single_approval_failure_leaves_request_pending(self):
+        credit_request = CreditRequest.objects.create(seller=self.sellers[0], amount=Decimal("5.00"))
+        with mock.patch.object(CreditLogWriter, 'write', side_effect=OperationalError("disk full")):
+            result = credit_request.approve(self.admin)
+
+        self.assertEqual(result['status'], 'failed')
+        credit_request.refresh_from_db()
+        self.sellers[0].refresh_from_db()
+        self.assertFalse(credit_request.is_approved)
+        self.assertEqual(self.sellers[0].credit, Decimal("10.00"))
+
+
+@override_settings(CHARGE_MANAGEMENT={'ASYNC_DB_POOL_SIZE': 0})  # The test transaction is not visible to pool threads
+class AsyncEndpointTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_phone_cache().clear()
+        self.user = User.objects.create_user(username="async-seller")
+        self.seller = Seller.objects.create(user=self.user, name="Async", email="async@example.com",
+                                            phone_number="09120000060", credit=Decimal("100.00"))
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.auth = {'headers': {'Authorization': f"Bearer {AccessToken.for_user(self.user)}"}}
+
+    async def test_balance_with_etag(self):
+        response = await self.async_client.get(reverse('async-credit-balance'), **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'seller_name': 'Async', 'current_balance': 100.0})
+
+        response = await self.async_client.get(reverse('async-credit-balance'), headers={
+            **self.auth['headers'], 'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_requires_authentication(self):
+        response = await self.async_client.get(reverse('async-credit-balance'))
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get(reverse('async-credit-balance'), headers={'Authorization': "Bearer invalid"})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_recharge(self):
+        url = reverse('async-transaction-create')
+        response = await self.async_client.post(url, {'phone_number': '09121234567', 'amount': '30.00'},
+                                                content_type='application/json', **self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['amount'], '30.00')
+
+        response = await self.async_client.post(url, {'phone_number': '09121234567', 'amount': '80.00'},
+                                                content_type='application/json', **self.auth)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('amount', response.json())
+        response = await self.async_client.post(url, {'phone_number': '09129999999', 'amount': '1.00'},
+                                                content_type='application/json', **self.auth)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('phone_number', response.json())
+
+        await self.seller.arefresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("70.00"))
+        self.assertEqual(await CreditLog.objects.filter(seller=self.seller).acount(), 1)
+
+    async def test_recharge_with_idempotency_key(self):
+        url = reverse('async-transaction-create')
+        headers = {**self.auth['headers'], 'Idempotency-Key': 'async-key-1'}
+        payload = {'phone_number': '09121234567', 'amount': '30.00'}
+        first = await self.async_client.post(url, payload, content_type='application/json', headers=headers)
+        second = await self.async_client.post(url, payload, content_type='application/json', headers=headers)
+
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.json(), first.json())
+        await self.seller.arefresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("70.00"))
+
+        response = await self.async_client.post(url, {**payload, 'amount': '1.00'}, content_type='application/json',
+                                                headers=headers)
+        self.assertEqual(response.status_code, 422)
+        response = await self.async_client.post(url, {**payload, 'amount': '80.00'}, content_type='application/json',
+                                                headers={**headers, 'Idempotency-Key': 'async-key-2'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(await IdempotencyKey.objects.filter(key='async-key-2').aexists())  # Released for a retry
+
+    async def test_recharge_under_outbox_backpressure(self):
+        url = reverse('async-transaction-create')
+        payload = {'phone_number': '09121234567', 'amount': '30.00'}
+        with override_settings(CHARGE_MANAGEMENT={'ASYNC_DB_POOL_SIZE': 0, 'CREDIT_LOG_OUTBOX': True}), \
+                mock.patch.object(CreditLogWriter, 'check_backpressure', side_effect=OutboxBackpressure(wait=5)):
+            for key in (None, 'async-key-1'):
+                headers = {**self.auth['headers'], **({'Idempotency-Key': key} if key else {})}
+                response = await self.async_client.post(url, payload, content_type='application/json',
+                                                        headers=headers)
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response['Retry-After'], '5')
+                self.assertEqual(response.json()['detail'], OutboxBackpressure.default_detail)
+
+        await self.seller.arefresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal("100.00"))
+        self.assertFalse(await IdempotencyKey.objects.aexists())  # Released for a retry
+
+    async def test_log_list_pages_by_cursor(self):
+        await CreditLog.objects.abulk_create([
+            CreditLog(seller=self.seller, amount=index, balance_snapshot=index, description="log") for index in range(5)
+        ])
+        url = reverse('async-credit-log-list')
+        first = (await self.async_client.get(url, {'page_size': 3}, **self.auth)).json()
+        second = (await self.async_client.get(first['next'], **self.auth)).json()
+
+        self.assertEqual(len(first['results']), 3)
+        self.assertEqual(len(second['results']), 2)
+        self.assertIsNone(second['next'])
+        self.assertEqual(len({log['id'] for log in first['results'] + second['results']}), 5)
+
+    def test_blocking_sections_run_on_the_bounded_pool(self):
+        with override_settings(CHARGE_MANAGEMENT={'ASYNC_DB_POOL_SIZE': 2}):
+            thread_name = async_to_sync(run_blocking)(lambda: current_thread().name)
+        self.assertTrue(thread_name.startswith('charge-db'))
+
+
+@override_settings(CHARGE_MANAGEMENT={
+    'ADMISSION_CONTROL_ENABLED': True, 'RECHARGE_RATE_LIMIT': 1, 'RECHARGE_BURST': 2, 'RECHARGE_MAX_IN_FLIGHT': 1,
+    'ASYNC_DB_POOL_SIZE': 0,
+})
+class AdmissionControlTest(TestCase):
+    def setUp(self):
+        get_phone_cache().clear()
+        get_registry().clear()
+        reset_admission_controller('CHARGE_MANAGEMENT')  # Buckets are keyed by user ids, which tests reuse
+        self.user = User.objects.create_user(username="admission")
+        self.seller = Seller.objects.create(user=self.user, name="Admission", email="admission@example.com",
+                                            phone_number="09120000070", credit=Decimal("100.00"))
+        PhoneNumber.objects.create(phone_number="09121234567")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def recharge(self):
+        return self.client.post(reverse('transaction-create'), {'phone_number': '09121234567', 'amount': '1.00'},
+                                format='json')
+
+    def test_rate_limit_rejects_before_database_work(self):
+        self.assertEqual(self.recharge().status_code, 201)
+        self.assertEqual(self.recharge().status_code, 201)
+        with self.assertNumQueries(0):
+            response = self.recharge()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(Transaction.objects.filter(seller=self.seller).count(), 2)
+        self.assertEqual(get_registry().counter('charge_admission_total', outcome='rate_limited'), 1)
+        self.assertEqual(get_registry().counter('charge_admission_total', outcome='admitted'), 2)
+
+    def test_per_seller_limits_override_the_defaults(self):
+        self.seller.recharge_rate_limit = 1000
+        self.seller.recharge_burst = 1000
+        self.seller.save()  # Drops the cached limits
+        for _ in range(5):
+            self.assertEqual(self.recharge().status_code, 201)
+
+    def test_in_flight_cap(self):
+        Seller.objects.filter(id=self.seller.id).update(recharge_rate_limit=0.001, recharge_burst=3)
+        controller = get_admission_controller()
+        self.assertTrue(controller.admit(self.user.id).holds_slot)  # A recharge still running
+
+        response = self.recharge()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Too many recharges in flight", response.data['detail'])
+
+        controller.release(self.user.id)
+        self.assertEqual(self.recharge().status_code, 201)
+        self.assertEqual(self.recharge().status_code, 429)  # Out of tokens, the slot was released
+        self.assertEqual(controller.backend._in_flight, {})
+
+    def test_token_bucket_refills(self):
+        backend = LocalAdmissionBackend()
+        with mock.patch('charge_management.admission.time.monotonic', return_value=100.0):
+            self.assertEqual([backend.take('seller', 2, 2) for _ in range(3)], [0, 0, 0.5])
+        with mock.patch('charge_management.admission.time.monotonic', return_value=100.5):
+            self.assertEqual(backend.take('seller', 2, 2), 0)
+        controller = AdmissionController(backend)
+        self.assertEqual(controller.load_limits(self.user.id), (1, 2, 1))
+
+    async def test_async_recharge_is_limited(self):
+        url = reverse('async-transaction-create')
+        auth = {'headers': {'Authorization': f"Bearer {AccessToken.for_user(self.user)}"}}
+        statuses = []
+        for _ in range(3):
+            response = await self.async_client.post(url, {'phone_number': '09121234567', 'amount': '1.00'},
+                                                    content_type='application/json', **auth)
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [201, 201, 429])
+        self.assertEqual(response['Retry-After'], '1')
@@ -15,10 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path
+from charge_management.async_views import AsyncCreditBalanceView, AsyncTransactionCreateView, AsyncCreditLogListView
 from charge_management.views import (
     SellerListCreateView, SellerDetailView, CreditRequestCreateView,
-    CreditRequestApprovalView, TransactionCreateView, CreditLogsListView,
-    CreditBalanceView, CreditLogListView
+    CreditRequestApprovalView, CreditRequestBulkApprovalView, TransactionCreateView, BulkTransactionCreateView,
+    CreditLogsListView, CreditBalanceView, CreditLogListView, RechargeReservationView, RechargeDetailView,
+    SellerStatsView
 )
 
 urlpatterns = [
@@ -27,7 +29,15 @@ urlpatterns = [
     path('sellers/<int:pk>/', SellerDetailView.as_view(), name='seller-detail'),
     path('credit-requests/', CreditRequestCreateView.as_view(), name='credit-request-create'),
     path('credit-requests/<int:pk>/approve/', CreditRequestApprovalView.as_view(), name='credit-request-approve'),
+    path('credit-requests/approve/', CreditRequestBulkApprovalView.as_view(), name='credit-request-bulk-approve'),
     path('transactions/', TransactionCreateView.as_view(), name='transaction-create'),
+    path('transactions/bulk/', BulkTransactionCreateView.as_view(), name='transaction-bulk-create'),
+    path('recharges/', RechargeReservationView.as_view(), name='recharge-reserve'),
+    path('recharges/<int:pk>/', RechargeDetailView.as_view(), name='recharge-detail'),
     path('sellers/<int:seller_id>/logs/', CreditLogsListView.as_view(), name='credit-log-list'),
     path('seller/logs/', CreditLogListView.as_view(), name='credit-log-list'),
+    path('seller/stats/', SellerStatsView.as_view(), name='seller-stats'),
+    path('async/credit_balance/', AsyncCreditBalanceView.as_view(), name='async-credit-balance'),
+    path('async/transactions/', AsyncTransactionCreateView.as_view(), name='async-transaction-create'),
+    path('async/seller/logs/', AsyncCreditLogListView.as_view(), name='async-credit-log-list'),
 ]
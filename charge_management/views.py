@@ -1,60 +1,147 @@
+import csv
+import heapq
+import hmac
+import json
+from datetime import datetime, time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
-from django.http import Http404
+from django.db.models import F
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 from rest_framework import generics, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
-from rest_framework_simplejwt.authentication import JWTAuthentication
-
-from .handlers import CreditTransactionHandler
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+from .admission import AdmissionControlMixin
+from .archive import LedgerArchiveHandler
+from .authentication import CachedJWTAuthentication
+from .balance_cache import BalanceCache
+from .conf import get_setting
+from .context import get_request_seller, get_request_seller_id
+from .handlers import CreditApprovalHandler, BulkTransactionHandler, RechargeReservationHandler, ShardedBalanceHandler
+from .idempotency import IdempotentViewMixin
+from .instrumentation import get_registry
 from .models import Seller, CreditRequest, Transaction, CreditLog
-from .serializers import SellerSerializer, CreditRequestSerializer, TransactionSerializer, CreditLogSerializer
+from .operators import get_operator_dispatcher
+from .pagination import KeysetPagination, SellerKeysetPagination, iterate_keyset
+from .replicas import ReplicaReadMixin
+from .seller_stats import SellerStatsReader
+from .serializers import (
+    SellerSerializer, CreditRequestSerializer, CreditRequestBulkApprovalSerializer, TransactionSerializer,
+    BulkTransactionSerializer, CreditLogSerializer, SellerTokenObtainPairSerializer, RechargeReservationSerializer,
+    SellerStatsQuerySerializer, SellerStatsSerializer
+)
 
 
 class CreditBalanceView(APIView):
     """
-    Return the current credit balance of the authenticated user.
+    Return the current credit balance of the authenticated user, from the balance cache
+    when possible, with an ETag so pollers can send If-None-Match and get a 304.
     """
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
     permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
     def get(self, request):
-        try:
-            user = request.user
-            seller = Seller.objects.get(user=user)  # Assuming Seller is tied to User
-        except Seller.DoesNotExist:
-            return Response(
-                {"error": "The Seller associated with this user was not found."},
-                status=status.HTTP_404_NOT_FOUND
-            )
-        except Exception as e:
-            return Response(
-                {"error": f"An unexpected error occurred: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+        entry = BalanceCache.get(request.user.id)
+        if entry is None:
+            try:
+                seller = get_request_seller(request)
+                entry = BalanceCache.fill(request.user.id, seller.name, seller.total_credit)
+            except Http404 as e:
+                return Response(
+                    {"error": str(e)},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            except Exception as e:
+                return Response(
+                    {"error": f"An unexpected error occurred: {str(e)}"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+        headers = {'ETag': entry['etag'], 'Cache-Control': 'private, no-cache'}
+        if BalanceCache.matches(entry, request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
         return Response({
-            "seller_name": seller.name,
-            "current_balance": seller.credit
-        })
+            "seller_name": entry['seller_name'],
+            "current_balance": entry['current_balance']
+        }, headers=headers)
 
 
-# View to list and create Sellers
-class SellerListCreateView(generics.ListCreateAPIView):
+# View to list and create Sellers, the list is cursor paginated and filtered with
+# ?name= (prefix), ?email=, ?phone_number=, ?credit_min=, ?credit_max= and ?ordering=
+class SellerListCreateView(ReplicaReadMixin, generics.ListCreateAPIView):
     queryset = Seller.objects.all()
     serializer_class = SellerSerializer
+    pagination_class = SellerKeysetPagination
 
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
     permission_classes = [IsAdminUser]  # Ensure user is IsAdminUser
 
+    def list(self, request, *args, **kwargs):
+        # Rows are read with values() and rendered by the serializer's fields, no serializer per row
+        fields = SellerSerializer().fields
+        parts = self.total_credit_parts(self.filter_queryset(self.get_queryset()))
+        rows = self.paginate_queryset([part.values(*fields) for part in parts])
+        return self.get_paginated_response([
+            {name: None if value is None else fields[name].to_representation(value) for name, value in row.items()}
+            for row in rows
+        ])
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+        if params.get('name'):
+            # A prefix as a range, which every backend serves from seller_name_idx (LIKE may not)
+            queryset = queryset.filter(name__gte=params['name'], name__lt=params['name'] + '\uffff')
+        if params.get('email'):
+            queryset = queryset.filter(email=params['email'])
+        if params.get('phone_number'):
+            queryset = queryset.filter(phone_number=params['phone_number'])
+        return queryset
+
+    def total_credit_parts(self, queryset):
+        """
+        The queryset annotated with total_credit and filtered on it, split in two when it is
+        filtered or sorted on it: an unsharded seller's total_credit is its credit column, which
+        seller_shards_credit_idx serves, and only the few sharded sellers need their shards summed.
+        """
+        params = self.request.query_params
+        total_credit = ShardedBalanceHandler.total_credit_expression()
+        if not any(params.get(name) for name in ('credit_min', 'credit_max')) and \
+                params.get('ordering') not in ('credit', '-credit'):
+            return [queryset.annotate(total_credit=total_credit)]
+        parts = [queryset.filter(credit_shards=0).annotate(total_credit=F('credit')),
+                 queryset.filter(credit_shards__gt=0).annotate(total_credit=total_credit)]
+        for name, lookup in (('credit_min', 'total_credit__gte'), ('credit_max', 'total_credit__lte')):
+            if params.get(name):
+                amount = self._parse_amount(name, params[name])
+                parts = [part.filter(**{lookup: amount}) for part in parts]
+        return parts
+
+    @staticmethod
+    def _parse_amount(name, value):
+        try:
+            amount = Decimal(value)
+        except InvalidOperation:
+            amount = None
+        if amount is None or not amount.is_finite():  # NaN and Infinity cannot be compared in SQL
+            raise ValidationError({name: ["Enter a valid number."]})
+        return amount
+
 
 # View to retrieve, update, or delete a Seller
 class SellerDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Seller.objects.all()
     serializer_class = SellerSerializer
 
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
     permission_classes = [IsAdminUser]  # Ensure user is IsAdminUser
 
 
@@ -63,89 +150,268 @@ class CreditRequestCreateView(generics.CreateAPIView):
     queryset = CreditRequest.objects.all()
     serializer_class = CreditRequestSerializer
 
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
     permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
     # Handle custom logic to approve the credit request
     def perform_create(self, serializer):
-        serializer.validated_data['seller'] = self.request.user.seller
+        serializer.validated_data['seller'] = get_request_seller(self.request)
         serializer.save()  # Save credit request as pending
 
 
 # View to approve a Credit Request
-class CreditRequestApprovalView(APIView):
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
+class CreditRequestApprovalView(IdempotentViewMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
     permission_classes = [IsAdminUser]  # Ensure user is IsAdminUser
 
     def post(self, request, pk):
-        try:
-            credit_request = CreditRequest.objects.get(pk=pk, is_approved=False)
-        except CreditRequest.DoesNotExist:
-            return Response({"detail": "Credit request not found or already approved."},
-                            status=status.HTTP_404_NOT_FOUND)
-        try:
-            with transaction.atomic():
-                # Approve the request and update seller's credit
-                credit_request.is_approved = True
-                credit_request.approved_by = request.user
-                credit_request.approved_at = timezone.now()
+        # Credit and approval are written in one transaction
+        result = CreditApprovalHandler.approve_requests([pk], request.user)[0]
+        if result['status'] == CreditApprovalHandler.APPROVED:
+            return Response({"detail": "Credit request approved successfully."}, status=status.HTTP_200_OK)
+        if result['status'] == CreditApprovalHandler.FAILED:
+            return Response({"detail": result['detail']}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"detail": "Credit request not found or already approved."},
+                        status=status.HTTP_404_NOT_FOUND)
+
 
-                # Update seller's credit
-                result = CreditTransactionHandler.add_credit(seller_id=credit_request.seller.id,
-                                                             amount=credit_request.amount)
+# View to approve many Credit Requests at once, grouped per seller
+class CreditRequestBulkApprovalView(IdempotentViewMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAdminUser]  # Ensure user is IsAdminUser
 
-        except Exception as e:
-            result = {"success": False, "message": f"An error occurred: {e}"}
+    def post(self, request):
+        serializer = CreditRequestBulkApprovalSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
-        if result['success']:
-            credit_request.save()
-            return Response({"detail": "Credit request approved successfully."}, status=status.HTTP_200_OK)
-        else:
-            return Response({"detail": result['message']}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        results = CreditApprovalHandler.approve_requests(serializer.validated_data['ids'], request.user)
+        approved = [result for result in results if result['status'] == CreditApprovalHandler.APPROVED]
+        return Response({
+            "approved": len(approved),
+            "rejected": len(results) - len(approved),
+            "total_amount": sum(result['amount'] for result in approved),
+            "results": results,
+        }, status=status.HTTP_200_OK)
 
 
 # View to handle recharge transactions
-class TransactionCreateView(generics.CreateAPIView):
+class TransactionCreateView(AdmissionControlMixin, IdempotentViewMixin, generics.CreateAPIView):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
 
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
     permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
-    # Override perform_create to deduct credit after successful transaction
+    # Transaction.save() deducts the credit and logs it in the same database transaction
     def perform_create(self, serializer):
-        transaction = serializer.save()  # Save the transaction
-        # Log the deduction in credit history
-        CreditLog.objects.create(
-            seller=transaction.seller,
-            amount=-transaction.amount,
-            balance_snapshot=transaction.seller.credit,
-            description=f"Recharge transaction to {transaction.phone_number}"
-        )
+        try:
+            serializer.save()
+        except ValueError as e:  # Outrun by a concurrent debit since validation
+            raise ValidationError({"amount": [str(e)]})
 
 
-# View to list all credit logs for a specific seller
-class CreditLogsListView(generics.ListAPIView):
-    serializer_class = CreditLogSerializer
+# View to handle a batch of recharge transactions with a single debit
+class BulkTransactionCreateView(AdmissionControlMixin, IdempotentViewMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
-    permission_classes = [IsAdminUser]  # Ensure user is authenticated
+    def post(self, request):
+        seller = get_request_seller(request)
+        serializer = BulkTransactionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        mode = serializer.validated_data['mode']
+        created, results = BulkTransactionHandler.create_bulk(seller, serializer.validated_data['transactions'], mode)
+        accepted = [result for result in results if result['status'] == 'created']
+        return Response({
+            "mode": mode,
+            "created": len(accepted),
+            "rejected": len(results) - len(accepted),
+            "total_amount": sum(result['amount'] for result in accepted),
+            "results": results,
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+
+# View to reserve a recharge, answered before the operator is contacted
+class RechargeReservationView(AdmissionControlMixin, IdempotentViewMixin, generics.CreateAPIView):
+    serializer_class = RechargeReservationSerializer
+
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAuthenticated]  # Ensure user is authenticated
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED  # Settled later, poll the recharge for its status
+        return response
+
+    # The credit is held in one short transaction, the operator is called by the dispatcher once it commits
+    def perform_create(self, serializer):
+        try:
+            recharge = RechargeReservationHandler.reserve(**serializer.validated_data)
+        except ValueError as e:  # Outrun by a concurrent debit since validation
+            raise ValidationError({"amount": [str(e)]})
+        serializer.instance = recharge
+        transaction.on_commit(lambda: get_operator_dispatcher().submit(recharge.id))
+
+
+# View to follow a recharge of the authenticated seller
+class RechargeDetailView(generics.RetrieveAPIView):
+    serializer_class = RechargeReservationSerializer
+
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
     def get_queryset(self):
-        seller_id = self.kwargs['seller_id']
-        return CreditLog.objects.filter(seller_id=seller_id)
+        return Transaction.objects.filter(seller_id=get_request_seller_id(self.request))
 
 
-# View to list credit logs for a seller
-class CreditLogListView(generics.ListAPIView):
+# Spending statistics of the authenticated seller over ?start=&end= (inclusive dates), with the
+# ?top= most recharged phone numbers, read from the daily counters instead of the transactions
+class SellerStatsView(ReplicaReadMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAuthenticated]  # Ensure user is authenticated
+
+    def get_pinned_seller_id(self):
+        return get_request_seller_id(self.request)
+
+    def get(self, request):
+        query = SellerStatsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        stats = SellerStatsReader.summary(get_request_seller_id(request), **query.validated_data)
+        return Response(SellerStatsSerializer(stats).data)
+
+
+class _Echo:
+    # File-like object handing each CSV row back to the streaming generator
+    def write(self, value):
+        return value
+
+
+# Paginated credit log listing with a streaming ?export=ndjson|csv mode and an optional
+# ?created_after=&created_before= range, which also covers archived logs when it has a start
+class CreditLogListMixin(ReplicaReadMixin):
     serializer_class = CreditLogSerializer
+    pagination_class = KeysetPagination
+    export_fields = ['id', 'seller_id', 'balance_snapshot', 'amount', 'description', 'created_at']
 
-    authentication_classes = [JWTAuthentication]  # Enforce OAuth2 authentication
-    permission_classes = [IsAuthenticated]  # Ensure user is authenticated
+    def get_seller_id(self):
+        raise NotImplementedError
+
+    def get_pinned_seller_id(self):
+        return self.get_seller_id()
 
     def get_queryset(self):
+        return CreditLog.objects.filter(seller_id=self.get_seller_id())
+
+    def list(self, request, *args, **kwargs):
+        export = request.query_params.get('export')
+        if export is None:
+            return super().list(request, *args, **kwargs)
+        if export not in ('ndjson', 'csv'):
+            return Response({"detail": "Export format must be 'ndjson' or 'csv'."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Rows are fetched in keyset batches and never materialized as model instances
+        rows = iterate_keyset(self.filter_queryset(self.get_queryset()).values(*self.export_fields))
+        archived = self.get_archived_rows()
+        if archived is not None:
+            rows = heapq.merge(rows, archived, key=lambda row: (row['created_at'], row['id']), reverse=True)
+        if export == 'ndjson':
+            lines = (json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows)
+            response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        else:
+            response = StreamingHttpResponse(self._csv_lines(rows), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="credit_logs.{export}"'
+        return response
+
+    def _csv_lines(self, rows):
+        writer = csv.writer(_Echo())
+        yield writer.writerow(self.export_fields)
+        for row in rows:
+            yield writer.writerow([row[field] for field in self.export_fields])
+
+    def get_date_range(self):
+        if not hasattr(self, '_date_range'):
+            self._date_range = (self._parse_bound('created_after'), self._parse_bound('created_before'))
+        return self._date_range
+
+    def _parse_bound(self, name):
+        # An ISO datetime, or a date meaning its midnight in the current time zone
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
         try:
-            seller = self.request.user.seller
-        except Seller.DoesNotExist:
-            raise Http404('The Seller associated with this user was not found.')
-        return CreditLog.objects.filter(seller=seller)
+            bound = parse_datetime(value)
+            if bound is None and parse_date(value) is not None:
+                bound = datetime.combine(parse_date(value), time.min)
+        except ValueError:
+            bound = None
+        if bound is None:
+            raise ValidationError({name: ["Enter a valid date or datetime."]})
+        return timezone.make_aware(bound) if timezone.is_naive(bound) else bound
+
+    def filter_queryset(self, queryset):
+        created_after, created_before = self.get_date_range()
+        if created_after is not None:
+            queryset = queryset.filter(created_at__gte=created_after)
+        if created_before is not None:
+            queryset = queryset.filter(created_at__lt=created_before)
+        return queryset
+
+    def reads_archive(self):
+        # The archive is only read for ranges with a start
+        return self.get_date_range()[0] is not None and LedgerArchiveHandler.enabled()
+
+    def get_archived_rows(self, before=None):
+        # Lazily read, newest first like the hot rows, optionally only those before a cursor key
+        if not self.reads_archive():
+            return None
+        created_after, created_before = self.get_date_range()
+        return LedgerArchiveHandler().rows_newest_first('credit_logs', self.get_seller_id(), created_after,
+                                                        created_before, before=before)
+
+    def paginate_queryset(self, queryset):
+        archived = None
+        if self.reads_archive():
+            archived = lambda before: (CreditLog(**row) for row in self.get_archived_rows(before))
+        return self.paginator.paginate_queryset(queryset, self.request, view=self, archived=archived)
+
+
+# View to list all credit logs for a specific seller
+class CreditLogsListView(CreditLogListMixin, generics.ListAPIView):
+
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAdminUser]  # Ensure user is authenticated
+
+    def get_seller_id(self):
+        return self.kwargs['seller_id']
+
+
+# View to list credit logs for a seller
+class CreditLogListView(CreditLogListMixin, generics.ListAPIView):
+
+    authentication_classes = [CachedJWTAuthentication]  # Enforce OAuth2 authentication
+    permission_classes = [IsAuthenticated]  # Ensure user is authenticated
+
+    def get_seller_id(self):
+        return get_request_seller_id(self.request)
+
+
+# Token endpoint issuing tokens with the seller_id claim
+class SellerTokenObtainPairView(TokenObtainPairView):
+    serializer_class = SellerTokenObtainPairSerializer
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of this process's metrics registry. A plain Django view so
+    scrapers need no JWT: they send METRICS_TOKEN as a bearer token. Without a token it is
+    only served to staff sessions, or to anyone with DEBUG on, and is a 404 otherwise.
+    """
+    token = get_setting('METRICS_TOKEN')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    elif not settings.DEBUG and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(get_registry().render(), content_type='text/plain; version=0.0.4; charset=utf-8')